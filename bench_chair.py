@@ -0,0 +1,543 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the smart chair control path.
+Runs against the simulated GPIO backend and the in-memory datastore and
+prints machine-readable JSON, so runs can be compared with --compare.
+
+Usage:
+    python3 bench_chair.py kinematics [--events N]
+    python3 bench_chair.py suite [--events N] [--output results.json] [--compare old.json]
+    python3 bench_chair.py pipeline [--events N] [--rate 50] [--latency 0.02] [--jitter 0.01]
+    python3 bench_chair.py lan [--events N]
+    python3 bench_chair.py pwm [--events N] [--hold 2]
+    python3 bench_chair.py rtdb [--events N] [--latency 0.02] [--jitter 0.01]
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+
+import chair
+import chair_gpio
+from chair_kinematics import KinematicsTable, mix_joystick
+from chair_lan import LanClient, LanCommandServer
+from chair_log import setup_logging
+from chair_metrics import LatencyHistogram
+from chair_rtdb import POOL_SIZE, open_datastore
+
+MIN_SPEED = 20
+MAX_SPEED = 100
+
+DIRECTIONS = ('forward', 'forward-right', 'right', 'backward-right',
+              'backward', 'backward-left', 'left', 'forward-left')
+
+
+def random_joystick_events(count, seed=1):
+    """Generate reproducible (x, y, speed) joystick events"""
+    rng = random.Random(seed)
+    return [(rng.randint(-100, 100), rng.randint(-100, 100), rng.randint(MIN_SPEED, MAX_SPEED))
+            for _ in range(count)]
+
+
+def time_per_event(fn, events, repeat=5):
+    """Best time per event in nanoseconds over a few runs"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        for x, y, speed in events:
+            fn(x, y, speed)
+        elapsed = (time.perf_counter_ns() - start) / len(events)
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_kinematics(args):
+    """Compare per-event joystick mixing against the precomputed table"""
+    events = random_joystick_events(args.events)
+
+    start = time.perf_counter()
+    table = KinematicsTable(MIN_SPEED, MAX_SPEED, cache_path=None)
+    build_seconds = time.perf_counter() - start
+
+    computed = time_per_event(lambda x, y, s: mix_joystick(x, y, s, MIN_SPEED), events)
+    lookup = time_per_event(table.lookup, events)
+    return {
+        'benchmark': 'kinematics',
+        'events': len(events),
+        'table_build_seconds': round(build_seconds, 4),
+        'table_available': table._duties is not None,
+        'computed_ns_per_event': round(computed, 1),
+        'lookup_ns_per_event': round(lookup, 1),
+        'speedup': round(computed / lookup, 2)
+    }
+
+
+# Scenarios: each returns a list of (command, value) pairs
+
+def joystick_sweep(count):
+    """Joystick moving continuously around the circle at varying deflection"""
+    events = []
+    for i in range(count):
+        angle = math.radians(i % 360)
+        radius = 40 + (i % 61)
+        events.append(('joystick', {'x': round(radius * math.cos(angle)), 'y': round(radius * math.sin(angle))}))
+    return events
+
+
+def direction_spam(count):
+    """Direction buttons hammered in rotation"""
+    return [('direction', DIRECTIONS[i % len(DIRECTIONS)]) for i in range(count)]
+
+
+def speed_changes(count):
+    """Speed slider dragged while the chair is moving"""
+    events = [('direction', 'forward')]
+    for i in range(count - 1):
+        events.append(('speed', MIN_SPEED + (i * 7) % (MAX_SPEED - MIN_SPEED + 1)))
+    return events
+
+
+def stop_bursts(count):
+    """Short motion bursts interrupted by repeated stops"""
+    events = []
+    for i in range(count):
+        phase = i % 10
+        if phase < 6:
+            events.append(('joystick', {'x': (i * 13) % 201 - 100, 'y': 80}))
+        else:
+            events.append(('stop', None))
+    return events
+
+
+SCENARIOS = {
+    'joystick-sweep': joystick_sweep,
+    'direction-spam': direction_spam,
+    'speed-changes': speed_changes,
+    'stop-bursts': stop_bursts
+}
+
+
+def load_chair(latency=0.0, jitter=0.0):
+    """Create a chair on the simulated GPIO and memory datastore"""
+    # Log lines go through the chair's queued logger into /dev/null
+    setup_logging(stream=open(os.devnull, 'w'))
+    chair.kinematics.load()
+    chair.init_datastore('memory', latency=latency, jitter=jitter, seed=1)
+    wheelchair = chair.Chair()
+    # Duties are applied by the commands themselves, without the ramp's control loop
+    wheelchair.init_motors('sim', rate=0)
+    wheelchair.chair_id = 'bench-chair'
+    wheelchair.bind_references()
+    # The memory datastore stamps commands with the local clock
+    chair.scheduler.clock_offset_ms = 0
+    wheelchair.init_telemetry({'status': 'ready', 'movement_state': {'direction': 'stop', 'x': 0, 'y': 0}})
+    chair.publisher.start()
+    return wheelchair
+
+
+def reset_chair(wheelchair):
+    """Put the chair back into a stopped state at the default speed"""
+    def reset():
+        wheelchair.stop()
+        wheelchair.current_speed = chair.DEFAULT_SPEED
+    # Runs on the control thread when it is started, directly otherwise
+    chair.scheduler.call(reset)
+    chair.publisher.flush()
+
+
+def run_scenario(wheelchair, name, events):
+    """Run events straight through handle_command and time each call"""
+    reset_chair(wheelchair)
+    histogram = LatencyHistogram(name)
+    calls_before = wheelchair.motors.stats()
+
+    start = time.perf_counter()
+    for command, value in events:
+        call_start = time.perf_counter()
+        wheelchair.handle_command(command, value)
+        histogram.record(time.perf_counter() - call_start)
+    elapsed = time.perf_counter() - start
+
+    calls_after = wheelchair.motors.stats()
+    return {
+        'scenario': name,
+        'events': len(events),
+        'seconds': round(elapsed, 4),
+        'events_per_sec': round(len(events) / elapsed, 1),
+        'p50_us': round(histogram.percentile(0.5) * 1e6, 1),
+        'p99_us': round(histogram.percentile(0.99) * 1e6, 1),
+        'max_us': histogram.max or 0,
+        'pwm_calls_made': calls_after['calls_made'] - calls_before['calls_made'],
+        'pwm_calls_skipped': calls_after['calls_skipped'] - calls_before['calls_skipped']
+    }
+
+
+def environment(**extra):
+    """Describe where a benchmark ran"""
+    info = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+        'gpio': 'sim',
+        'datastore': 'memory'
+    }
+    info.update(extra)
+    return info
+
+
+def bench_suite(args):
+    """Run every scenario directly through handle_command"""
+    wheelchair = load_chair()
+    results = [run_scenario(wheelchair, name, scenario(args.events))
+               for name, scenario in SCENARIOS.items()]
+    chair.publisher.close()
+    return {
+        'benchmark': 'suite',
+        'environment': environment(),
+        'results': results
+    }
+
+
+def bench_pipeline(args):
+    """Push commands through the memory datastore, listener and scheduler"""
+    wheelchair = load_chair(args.latency, args.jitter)
+
+    # The chair keeps its cursor and table cache in the working directory
+    workdir = tempfile.mkdtemp(prefix='chair-bench-')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    results = []
+    try:
+        wheelchair.listen_for_commands()
+        commands_ref = wheelchair.commands_ref
+        interval = 1.0 / args.rate if args.rate > 0 else 0
+
+        for name, scenario in SCENARIOS.items():
+            reset_chair(wheelchair)
+            chair.command_age.reset()
+            before = chair.scheduler.stats()
+            telemetry_before = chair.publisher.stats()
+            events = scenario(args.events)
+
+            start = time.perf_counter()
+            for command, value in events:
+                data = {'command': command, 'timestamp': {'.sv': 'timestamp'}}
+                if value is not None:
+                    data['value'] = value
+                commands_ref.push(data)
+                if interval:
+                    time.sleep(interval)
+            chair.store.wait_idle(10)
+            chair.scheduler.wait_idle(10)
+            elapsed = time.perf_counter() - start
+            chair.publisher.flush()
+
+            after = chair.scheduler.stats()
+            telemetry_after = chair.publisher.stats()
+            results.append({
+                'scenario': name,
+                'events': len(events),
+                'seconds': round(elapsed, 4),
+                'events_per_sec': round(len(events) / elapsed, 1),
+                'dispatched': after['dispatched'] - before['dispatched'],
+                'coalesced': after['coalesced'] - before['coalesced'],
+                'preempted': after['preempted'] - before['preempted'],
+                'telemetry_writes': telemetry_after['updates_sent'] - telemetry_before['updates_sent'],
+                'telemetry_bytes': telemetry_after['bytes_sent'] - telemetry_before['bytes_sent'],
+                'p50_us': round(chair.command_age.percentile(0.5) * 1e6, 1),
+                'p99_us': round(chair.command_age.percentile(0.99) * 1e6, 1)
+            })
+    finally:
+        chair.scheduler.close()
+        chair.publisher.close()
+        chair.store.close()
+        os.chdir(cwd)
+
+    return {
+        'benchmark': 'pipeline',
+        'environment': environment(rate=args.rate, latency=args.latency, jitter=args.jitter),
+        'results': results
+    }
+
+
+def bench_lan(args):
+    """Send commands over the LAN channel from a loopback client"""
+    wheelchair = load_chair()
+    key = os.urandom(32)
+    server = LanCommandServer(key, wheelchair.submit_lan_command, host='127.0.0.1', port=0)
+    server.start()
+    chair.scheduler.start()
+    client = LanClient(key, server.address)
+    client.connect()
+
+    results = []
+    try:
+        for name, scenario in SCENARIOS.items():
+            reset_chair(wheelchair)
+            histogram = LatencyHistogram(name)
+            before = chair.scheduler.stats()
+            events = scenario(args.events)
+
+            # Each command waits for its ack, so this is the round trip the app sees
+            start = time.perf_counter()
+            for command, value in events:
+                histogram.record(client.request(command, value))
+            chair.scheduler.wait_idle(10)
+            elapsed = time.perf_counter() - start
+
+            after = chair.scheduler.stats()
+            results.append({
+                'scenario': name,
+                'events': len(events),
+                'seconds': round(elapsed, 4),
+                'events_per_sec': round(len(events) / elapsed, 1),
+                'dispatched': after['dispatched'] - before['dispatched'],
+                'coalesced': after['coalesced'] - before['coalesced'],
+                'p50_us': round(histogram.percentile(0.5) * 1e6, 1),
+                'p99_us': round(histogram.percentile(0.99) * 1e6, 1)
+            })
+    finally:
+        client.close()
+        server.close()
+        chair.scheduler.close()
+        chair.publisher.close()
+
+    return {
+        'benchmark': 'lan',
+        'environment': environment(channel='udp loopback'),
+        'results': results
+    }
+
+
+PWM_PINS = (chair.L_RPWM, chair.L_LPWM, chair.R_RPWM, chair.R_LPWM)
+
+
+def pwm_backends():
+    """Create every PWM backend that can run here, and the reasons the others cannot"""
+    backends = {'sim': chair_gpio.SimulatedGPIOBackend()}
+    skipped = {}
+
+    # Real hardware channels when they are configured, a fake sysfs tree otherwise
+    channels = chair_gpio.parse_pwm_channels(chair_gpio.PWM_CHANNELS)
+    if os.path.isdir(chair_gpio.SYSFS_PWM_ROOT) and all(pin in channels for pin in PWM_PINS):
+        root = chair_gpio.SYSFS_PWM_ROOT
+    else:
+        root = chair_gpio.create_fake_sysfs_pwm(tempfile.mkdtemp(prefix='chair-pwm-'))
+        channels = {pin: (0, channel) for channel, pin in enumerate(PWM_PINS)}
+    backends['sysfs'] = chair_gpio.SysfsPWMBackend(root, channels, outputs=chair_gpio.SimulatedGPIOBackend())
+
+    try:
+        backends['rpi'] = chair_gpio.RPiGPIOBackend()
+    except (ImportError, RuntimeError) as e:
+        skipped['rpi'] = str(e)
+    return backends, skipped
+
+
+def busy_listener(stop):
+    """Keep a thread busy decoding payloads, like the Firebase listener under load"""
+    payload = json.dumps([{'command': 'joystick', 'value': {'x': i, 'y': -i}} for i in range(50)])
+    while not stop.is_set():
+        json.loads(payload)
+
+
+def bench_pwm(args):
+    """Compare the CPU cost and duty change latency of the PWM backends"""
+    backends, skipped = pwm_backends()
+    results = []
+    for name, backend in backends.items():
+        channels = [backend.pwm(pin, chair.PWM_FREQUENCY) for pin in PWM_PINS]
+        for channel in channels:
+            channel.start(0)
+
+        # Holding a duty: software PWM keeps toggling pins from a thread, hardware PWM costs nothing
+        for channel in channels:
+            channel.ChangeDutyCycle(50)
+        cpu_start = time.process_time()
+        time.sleep(args.hold)
+        hold_cpu = (time.process_time() - cpu_start) / args.hold
+
+        # Changing duties while another thread keeps the interpreter busy
+        stop = threading.Event()
+        load = threading.Thread(target=busy_listener, args=(stop,), daemon=True)
+        load.start()
+        histogram = LatencyHistogram(name)
+        cpu_start = time.thread_time()
+        start = time.perf_counter()
+        for i in range(args.events):
+            call_start = time.perf_counter()
+            channels[i % len(channels)].ChangeDutyCycle(i % 101)
+            histogram.record(time.perf_counter() - call_start)
+        elapsed = time.perf_counter() - start
+        cpu = time.thread_time() - cpu_start
+        stop.set()
+        load.join()
+        backend.cleanup()
+
+        results.append({
+            'scenario': name,
+            'events': args.events,
+            'seconds': round(elapsed, 4),
+            'events_per_sec': round(args.events / elapsed, 1),
+            'cpu_us_per_change': round(cpu / args.events * 1e6, 2),
+            'hold_cpu_percent': round(hold_cpu * 100, 2),
+            'p50_us': round(histogram.percentile(0.5) * 1e6, 1),
+            'p99_us': round(histogram.percentile(0.99) * 1e6, 1),
+            'max_us': round(histogram.percentile(1.0) * 1e6, 1)
+        })
+
+    return {
+        'benchmark': 'pwm',
+        'environment': environment(gpio=', '.join(backends), sysfs_root=backends['sysfs'].root,
+                                   hold_seconds=args.hold),
+        'results': results,
+        'skipped': skipped
+    }
+
+
+def rtdb_writes(root, count, overlap):
+    """Send telemetry-sized updates one at a time, or all at once through the pool"""
+    histogram = LatencyHistogram('writes')
+    futures = []
+    start = time.perf_counter()
+    for i in range(count):
+        updates = {f'chairs/bench{i % 50}/status': 'moving', f'chairs/bench{i % 50}/current_speed': i % 101}
+        sent = time.perf_counter()
+        if overlap:
+            future = root.update_async(updates)
+            future.add_done_callback(lambda _, sent=sent: histogram.record(time.perf_counter() - sent))
+            futures.append(future)
+        else:
+            root.update(updates)
+            histogram.record(time.perf_counter() - sent)
+    for future in futures:
+        future.result()
+    return time.perf_counter() - start, histogram
+
+
+def rtdb_stream(store, count):
+    """Write commands and time their arrival over the streaming listener"""
+    histogram = LatencyHistogram('stream')
+    received = threading.Semaphore(0)
+    sent = {}
+
+    def on_event(event):
+        if event.path != '/' and event.data is not None:
+            histogram.record(time.perf_counter() - sent[event.path.strip('/')])
+            received.release()
+
+    commands_ref = store.reference('chairs/bench/commands')
+    listener = commands_ref.listen(on_event)
+    time.sleep(0.2)  # Let the initial snapshot arrive
+    futures = []
+    start = time.perf_counter()
+    for i in range(count):
+        key = f'c{i:08d}'
+        sent[key] = time.perf_counter()
+        futures.append(commands_ref.child(key).update_async({'command': 'forward', 'timestamp': i}))
+    for _ in range(count):
+        received.acquire(timeout=10)
+    elapsed = time.perf_counter() - start
+    for future in futures:
+        future.result()
+    listener.close()
+    return elapsed, histogram
+
+
+def bench_rtdb(args):
+    """Compare blocking and overlapping writes, and stream delivery, over a local REST server"""
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, name='rtdb-loop', daemon=True)
+    thread.start()
+    store = asyncio.run_coroutine_threadsafe(
+        open_datastore('memory', latency=args.latency, jitter=args.jitter, seed=1), loop).result()
+    root = store.reference()
+    runs = (('writes-blocking', lambda: rtdb_writes(root, args.events, False)),
+            ('writes-asyncio', lambda: rtdb_writes(root, args.events, True)),
+            ('stream-asyncio', lambda: rtdb_stream(store, args.events)))
+    results = []
+    try:
+        for name, run in runs:
+            elapsed, histogram = run()
+            results.append({
+                'scenario': name,
+                'events': args.events,
+                'seconds': round(elapsed, 4),
+                'events_per_sec': round(args.events / elapsed, 1),
+                'p50_us': round(histogram.percentile(0.5) * 1e6, 1),
+                'p99_us': round(histogram.percentile(0.99) * 1e6, 1)
+            })
+        client = store.stats()
+    finally:
+        store.close()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+    return {
+        'benchmark': 'rtdb',
+        'environment': environment(datastore='memory over http', latency=args.latency,
+                                   jitter=args.jitter, pool_size=POOL_SIZE),
+        'results': results,
+        'client': client
+    }
+
+
+def compare(results, baseline_path):
+    """Print events/sec and p99 changes against an earlier run"""
+    with open(baseline_path) as f:
+        baseline = {entry['scenario']: entry for entry in json.load(f).get('results', [])}
+    for entry in results.get('results', []):
+        old = baseline.get(entry['scenario'])
+        if not old:
+            continue
+        throughput = entry['events_per_sec'] / old['events_per_sec'] - 1
+        p99 = entry['p99_us'] / old['p99_us'] - 1 if old['p99_us'] else 0
+        print(f"{entry['scenario']:>16}: events/sec {throughput:+.1%}, p99 {p99:+.1%}",
+              file=sys.stderr)
+
+
+BENCHMARKS = {
+    'kinematics': bench_kinematics,
+    'suite': bench_suite,
+    'pipeline': bench_pipeline,
+    'lan': bench_lan,
+    'pwm': bench_pwm,
+    'rtdb': bench_rtdb
+}
+
+
+def main():
+    """Run the selected benchmark and print its results as JSON"""
+    parser = argparse.ArgumentParser(description='Smart chair benchmarks')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--events', type=int, default=None, help='events per scenario')
+    parser.add_argument('--rate', type=float, default=50, help='pipeline: commands per second (0 = no pause)')
+    parser.add_argument('--latency', type=float, default=0.02, help='pipeline/rtdb: injected datastore latency (s)')
+    parser.add_argument('--jitter', type=float, default=0.01, help='pipeline/rtdb: injected datastore jitter (s)')
+    parser.add_argument('--hold', type=float, default=2.0, help='pwm: seconds to hold a duty while measuring CPU')
+    parser.add_argument('--output', help='also write the JSON results to this file')
+    parser.add_argument('--compare', help='earlier JSON results to compare against')
+    args = parser.parse_args()
+    if args.events is None:
+        args.events = {'kinematics': 100000, 'suite': 20000, 'pipeline': 200, 'lan': 2000,
+                       'pwm': 20000, 'rtdb': 200}[args.benchmark]
+
+    results = BENCHMARKS[args.benchmark](args)
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,35 @@
-import RPi.GPIO as GPIO
 import time
-import firebase_admin
-from firebase_admin import credentials, db
+import asyncio
 import json
+import logging
+import multiprocessing
 import os
+import signal
+import threading
 import uuid
-import math
+from concurrent.futures import ThreadPoolExecutor
+from chair_commands import (PRIORITY_COMMANDS, CommandCompactor, CommandCursor, CommandDecoder,
+                            CommandScheduler)
+from chair_control import CONTROL_RATE, DEFAULT_CONTROL_RATE, ControlLoop, RampedMotors
+from chair_datastore import DATASTORE, create_datastore
+from chair_gpio import GPIO_BACKEND, create_backend
+from chair_kinematics import DIRECTION_COORDS, KinematicsTable, direction_duties
+from chair_lan import (LAN_PORT, LAN_SECRET_FILE, LanCommandServer, load_pairing_secret, local_address,
+                       pairing_key)
+from chair_log import fields, sampled, setup_logging
+from chair_metrics import METRICS_PORT, MetricsRegistry, MetricsReporter
+from chair_motors import MotorDriver
+from chair_rtdb import RUNTIME, AsyncDatastore, open_datastore
+from chair_shm import PROCESS_MODE, ChairSharedMemory, CommandInbox, ControlProcess, StateWriter
+from chair_state import MovementHistory, MovementState
+from chair_telemetry import StatePublisher, TelemetryEncoder
+from chair_trace import SOURCE_LAN, SOURCE_STATE, TRACE_PATH, TraceRecorder
 
-# Initialize Firebase Admin SDK
-cred = credentials.Certificate('serviceAccountKey.json')
-firebase_admin.initialize_app(cred, {
-    'databaseURL': 'https://smarthub-60812-default-rtdb.firebaseio.com'
-})
+log = logging.getLogger('chair')
+
+# Firebase configuration
+FIREBASE_CREDENTIALS = 'serviceAccountKey.json'
+FIREBASE_URL = 'https://smarthub-60812-default-rtdb.firebaseio.com'
 
 # GPIO pin configuration for Left Motor (BTS7960)
 L_RPWM = 17
@@ -25,52 +43,56 @@ R_LPWM = 6
 R_R_EN = 13
 R_L_EN = 19
 
-# Setup GPIO mode
-GPIO.setmode(GPIO.BCM)
-
-# Setup motor driver pins
+# Motor driver pins
 MOTOR_PINS = [L_RPWM, L_LPWM, L_R_EN, L_L_EN, R_RPWM, R_LPWM, R_R_EN, R_L_EN]
-GPIO.setup(MOTOR_PINS, GPIO.OUT)
-
-# Enable both motors
-GPIO.output(L_R_EN, GPIO.HIGH)
-GPIO.output(L_L_EN, GPIO.HIGH)
-GPIO.output(R_R_EN, GPIO.HIGH)
-GPIO.output(R_L_EN, GPIO.HIGH)
-
-# PWM setup
-pwm_L_R = GPIO.PWM(L_RPWM, 1000)  # Left Motor Forward
-pwm_L_L = GPIO.PWM(L_LPWM, 1000)  # Left Motor Backward
-pwm_R_R = GPIO.PWM(R_RPWM, 1000)  # Right Motor Forward
-pwm_R_L = GPIO.PWM(R_LPWM, 1000)  # Right Motor Backward
-
-# Start PWM with 0 speed
-pwm_L_R.start(0)
-pwm_L_L.start(0)
-pwm_R_R.start(0)
-pwm_R_L.start(0)
+ENABLE_PINS = [L_R_EN, L_L_EN, R_R_EN, R_L_EN]
+PWM_FREQUENCY = 1000  # Hz
+
+# Realtime Database (or its in-memory stand-in), created by init_datastore()
+# and shared by every chair in the process, with its root reference built once
+# for the multi-path updates
+store = None
+root_ref = None
 
 # Speed configuration
 MIN_SPEED = 20
 MAX_SPEED = 100
 DEFAULT_SPEED = 50
-current_speed = DEFAULT_SPEED  # Default to medium speed
-
-# Chair configuration
-CHAIR_CODE = None  # This will be set from Firebase
-CHAIR_ID = None
-
-# Movement state tracking
-current_movement_state = {
-    'x': 0,
-    'y': 0,
-    'left_speed': 0,
-    'right_speed': 0,
-    'direction': 'stop',
-    'angle': 0,
-    'magnitude': 0,
-    'last_update_time': 0
-}
+
+# Joystick/direction to wheel duty lookup table, loaded in the background by
+# main() (or from cache); until then lookups compute the mix per event
+kinematics = KinematicsTable(MIN_SPEED, MAX_SPEED, preload=False)
+
+# Local file with the chair code, id and command cursor
+CHAIR_INFO_FILE = 'chair_info.json'
+
+# Latency histograms and counters, exported by start_metrics()
+metrics = MetricsRegistry()
+command_age = metrics.histogram('command_age', 'Time from the app sending a command to the chair running it')
+actuation_time = metrics.histogram('actuation', 'Time spent in handle_command')
+publish_time = metrics.histogram('publish', 'Duration of telemetry writes to Firebase')
+metrics_reporter = None
+
+# Seconds spent in each startup phase, and until the chair listens for commands
+startup_times = {}
+
+# Coalesces status/movement_state writes into one multi-path update per tick.
+# Writes run on a background worker so command handling only touches the GPIO.
+publisher = StatePublisher(lambda updates: write_updates(updates), on_write=publish_time.record)
+
+# Telemetry writes the asyncio runtime keeps in flight at once
+PUBLISH_IN_FLIGHT = 4
+
+# Chair fields whose change is published with the next write, other
+# movement_state fields follow at a rate set by how fast they change
+URGENT_FIELDS = ('status', 'current_speed', 'movement_state/direction')
+
+# Control actor: the only thread that runs commands and touches motor and
+# movement state. Listeners hand commands over without locking; stop/start
+# preempt pending motion and joystick/direction/speed updates coalesce so only
+# the latest is applied. Each chair submits with its own handler, so chairs
+# never coalesce together. Other threads go through scheduler.call().
+scheduler = CommandScheduler()
 
 # Define threshold for significant movement change
 MOVEMENT_THRESHOLD = 5  # Units in joystick coordinates (0-100)
@@ -79,707 +101,970 @@ SPEED_THRESHOLD = 5     # Percentage points
 # Reduced from earlier value to be more responsive
 UPDATE_TIME_THRESHOLD = 0.05  # 50ms minimum between updates
 
+# The chair run by main()
+chair = None
+
+def init_datastore(backend=None, **options):
+    """Connect to the Realtime Database, or the in-memory stand-in for testing"""
+    global store, root_ref
+    store = create_datastore(backend or DATASTORE, credentials_path=FIREBASE_CREDENTIALS,
+                             database_url=FIREBASE_URL, **options)
+    root_ref = store.reference()
+    return store
+
+async def init_async_datastore(backend=None, **options):
+    """Connect the streaming client of the asyncio runtime, see chair_rtdb"""
+    global store, root_ref
+    store = await open_datastore(backend or DATASTORE, credentials_path=FIREBASE_CREDENTIALS,
+                                 database_url=FIREBASE_URL, **options)
+    root_ref = store.reference()
+    return store
+
+def write_updates(updates):
+    """Send a multi-path update, the streaming client returns a future so writes overlap"""
+    if isinstance(store, AsyncDatastore):
+        return root_ref.update_async(updates)
+    return root_ref.update(updates)
+
 def generate_chair_code():
     """Generate a unique chair code"""
     return str(uuid.uuid4())[:8].upper()
 
-def register_chair():
-    """Register the chair with Firebase"""
-    global CHAIR_CODE, CHAIR_ID
-    
-    # Generate a new chair code
-    CHAIR_CODE = generate_chair_code()
-    
-    # Create a new chair entry in Firebase
-    chairs_ref = db.reference('chairs')
-    new_chair_ref = chairs_ref.push()
-    CHAIR_ID = new_chair_ref.key
-    
-    # Create basic chair data
-    chair_data = {
-        'code': CHAIR_CODE,
-        'name': f'Chair {CHAIR_CODE}',
-        'status': 'online',
-        'created_at': {'.sv': 'timestamp'},
-        'current_speed': DEFAULT_SPEED,
-        'movement_state': {
-            'direction': 'stop',
-            'x': 0,             # X=0 (center)
-            'y': 0,             # Y=0 (center)
-            'magnitude': 0,     # No movement magnitude
-            'left_speed': 0,    # Motors stopped
-            'right_speed': 0,   # Motors stopped
-            'angle': 0          # No direction angle
+
+class Chair:
+    """One chair: its identity, motors, movement state and command listener.
+    The datastore, kinematics table, publisher and scheduler are shared."""
+
+    def __init__(self, info_path=CHAIR_INFO_FILE, name=None):
+        # name tells the chairs of a fleet apart in logs, only the unnamed
+        # chair registers its counters with the metrics registry
+        self.info_path = info_path
+        self.name = name
+        self.log = log if name is None else logging.getLogger(f'chair.{name}')
+        
+        # GPIO backend and motor driver, created by init_motors(). With a
+        # control rate the motors are the ramp, which the control loop moves
+        # toward the commanded duties.
+        self.gpio = None
+        self.motors = None
+        self.ramp = None
+        self.control_loop = None
+        
+        # Chair configuration
+        self.chair_code = None  # This will be set from Firebase
+        self.chair_id = None
+        self.current_speed = DEFAULT_SPEED  # Default to medium speed
+        
+        # References to chairs/{id} and its commands, built once the id is known
+        self.chair_ref = None
+        self.commands_ref = None
+        
+        # Clock of the movement state, a trace replay drives it from the recorded times
+        self.clock = time.time
+        
+        # Movement state tracking, updated in place, with the last states
+        # kept in a ring buffer for diagnostics
+        self.movement_history = MovementHistory()
+        self.current_movement_state = MovementState(self.movement_history)
+        
+        # Prunes processed commands so chairs/{id}/commands stays a bounded window
+        self.compactor = None
+        
+        # Last handled command, persisted so restarts never re-run old commands
+        self.cursor = None
+        
+        # Commands listener, and the direct UDP channel from the app created
+        # by start_lan() when CHAIR_LAN_PORT is set
+        self.listener = None
+        self.lan = None
+        
+        # Records every command handed to the scheduler, see start_trace()
+        self.trace = None
+        
+        # Set on the control thread by close(), later commands are ignored
+        self.closed = False
+        
+        # Control process owning the motors when the chair runs split, see
+        # start_control(), and the last state it wrote
+        self.control = None
+        self.control_state = None
+        
+        self.register_stats('movement', self.movement_history.stats)
+        
+        # Sends only the changed status/movement_state fields, created once
+        # the chair id is known
+        self.telemetry = None
+
+    def register_stats(self, name, stats):
+        """Export a stats() callable, unless this chair is part of a fleet"""
+        if self.name is None:
+            metrics.register_stats(name, stats)
+
+    def init_motors(self, backend=None, rate=CONTROL_RATE):
+        """Configure the motor driver pins and PWM on the selected GPIO backend"""
+        self.gpio = create_backend(backend or GPIO_BACKEND)
+        
+        # Setup motor driver pins
+        self.gpio.setup_outputs(MOTOR_PINS)
+        
+        # Enable both motors
+        for pin in ENABLE_PINS:
+            self.gpio.output(pin, True)
+        
+        # PWM setup
+        pwm_L_R = self.gpio.pwm(L_RPWM, PWM_FREQUENCY)  # Left Motor Forward
+        pwm_L_L = self.gpio.pwm(L_LPWM, PWM_FREQUENCY)  # Left Motor Backward
+        pwm_R_R = self.gpio.pwm(R_RPWM, PWM_FREQUENCY)  # Right Motor Forward
+        pwm_R_L = self.gpio.pwm(R_LPWM, PWM_FREQUENCY)  # Right Motor Backward
+        
+        # Start PWM with 0 speed
+        for pwm in (pwm_L_R, pwm_L_L, pwm_R_R, pwm_R_L):
+            pwm.start(0)
+        
+        # Only writes the PWM channels whose duty cycle changed
+        self.motors = MotorDriver({'L_R': pwm_L_R, 'L_L': pwm_L_L, 'R_R': pwm_R_R, 'R_L': pwm_R_L})
+        if rate > 0:
+            # Commands set wheel targets, the control loop ramps the duties toward them
+            self.ramp = self.motors = RampedMotors(self.motors, rate)
+        return self.motors
+
+    def start_control_loop(self):
+        """Step the motor ramp at the control rate on its own thread"""
+        if self.ramp is None:
+            return
+        self.control_loop = ControlLoop(self.ramp.step, self.ramp.rate, halt=self.ramp.halt)
+        self.control_loop.start()
+        self.register_stats('control_loop', self.control_loop.stats)
+
+    def register_chair(self):
+        """Register the chair with Firebase"""
+        # Generate a new chair code
+        self.chair_code = generate_chair_code()
+        
+        # Create basic chair data
+        chair_data = {
+            'code': self.chair_code,
+            'name': f'Chair {self.chair_code}',
+            'status': 'online',
+            'created_at': {'.sv': 'timestamp'},
+            'current_speed': DEFAULT_SPEED,
+            'movement_state': {
+                'direction': 'stop',
+                'x': 0,             # X=0 (center)
+                'y': 0,             # Y=0 (center)
+                'magnitude': 0,     # No movement magnitude
+                'left_speed': 0,    # Motors stopped
+                'right_speed': 0,   # Motors stopped
+                'angle': 0          # No direction angle
+            }
         }
-    }
-    
-    # Set the data in Firebase
-    new_chair_ref.set(chair_data)
-    save_chair_info(CHAIR_CODE, CHAIR_ID)
-    
-    print(f"Chair registered successfully!")
-    print(f"Chair Code: {CHAIR_CODE}")
-    print(f"Chair ID: {CHAIR_ID}")
-    print("Please use this code in the mobile app to connect to this chair.")
+        
+        # Create the chair entry in Firebase, pushing with a value takes one round trip
+        sent = time.time()
+        new_chair_ref = store.reference('chairs').push(chair_data)
+        self.chair_id = new_chair_ref.key
+        self.bind_references()
+        self.start_clock_sync('created_at', sent, time.time())
+        self.save_chair_info(self.chair_code, self.chair_id)
+        self.init_telemetry(chair_data)
+        
+        self.log.info("Chair registered successfully!", extra=fields(code=self.chair_code, chair_id=self.chair_id))
+        self.log.info("Please use code %s in the mobile app to connect to this chair.", self.chair_code)
 
-def load_chair_info():
-    """Load the chair info from a local file"""
-    try:
-        with open('chair_info.json', 'r') as f:
-            chair_info = json.load(f)
-            return chair_info.get('code'), chair_info.get('id')
-    except (FileNotFoundError, json.JSONDecodeError):
-        return None, None
-
-def save_chair_info(code, chair_id):
-    """Save the chair info to a local file"""
-    with open('chair_info.json', 'w') as f:
-        json.dump({'code': code, 'id': chair_id}, f)
-
-def stop():
-    """Stop all motors"""
-    pwm_L_R.ChangeDutyCycle(0)
-    pwm_L_L.ChangeDutyCycle(0)
-    pwm_R_R.ChangeDutyCycle(0)
-    pwm_R_L.ChangeDutyCycle(0)
-    print("Motors stopped.")
-    
-    # Update movement state
-    global current_movement_state
-    current_movement_state = {
-        'x': 0,
-        'y': 0,
-        'left_speed': 0,
-        'right_speed': 0,
-        'direction': 'stop',
-        'angle': 0,
-        'magnitude': 0,
-        'last_update_time': time.time()
-    }
-    
-    # Update status in Firebase if chair ID is available
-    if CHAIR_ID:
-        db.reference(f'chairs/{CHAIR_ID}/status').set('ready')
-        db.reference(f'chairs/{CHAIR_ID}/movement_state').update({
+    def bind_references(self):
+        """Build the references of this chair once, every later read and listen reuses them"""
+        self.chair_ref = store.reference(f'chairs/{self.chair_id}')
+        self.commands_ref = self.chair_ref.child('commands')
+
+    def start_clock_sync(self, field, sent, received):
+        """Read back a server timestamp written between sent and received, off the startup path"""
+        threading.Thread(target=self.sync_clock, args=(field, sent, received),
+                         name='clock-sync', daemon=True).start()
+
+    def sync_clock(self, field, sent, received):
+        """Measure the offset to Firebase server time, command expiry and age wait for it"""
+        try:
+            server_ms = self.chair_ref.child(field).get()
+        except Exception as e:
+            self.log.warning("Could not read the server time, commands will not expire: %s", e)
+            return
+        if scheduler.sync_clock(server_ms, sent, received):
+            self.log.info("Clock offset to Firebase %+.0fms (+/-%.0fms)", scheduler.clock_offset_ms,
+                          scheduler.clock_uncertainty_ms)
+
+    def load_chair_info(self):
+        """Load the chair info from a local file"""
+        try:
+            with open(self.info_path, 'r') as f:
+                chair_info = json.load(f)
+                return chair_info.get('code'), chair_info.get('id')
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None, None
+
+    def save_chair_info(self, code, chair_id):
+        """Save the chair info to a local file"""
+        with open(self.info_path, 'w') as f:
+            json.dump({'code': code, 'id': chair_id}, f)
+
+    def load_command_cursor(self):
+        """Load the key and timestamp of the last handled command"""
+        try:
+            with open(self.info_path, 'r') as f:
+                cursor = json.load(f).get('cursor') or {}
+                return cursor.get('key'), cursor.get('timestamp', 0)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None, 0
+
+    def save_command_cursor(self, key, timestamp):
+        """Save the last handled command next to the chair info"""
+        try:
+            with open(self.info_path, 'r') as f:
+                chair_info = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            chair_info = {}
+        chair_info['cursor'] = {'key': key, 'timestamp': timestamp}
+        
+        # Write to a temporary file first so a crash never leaves a broken file
+        with open(self.info_path + '.tmp', 'w') as f:
+            json.dump(chair_info, f)
+        os.replace(self.info_path + '.tmp', self.info_path)
+
+    def init_telemetry(self, written):
+        """Create the telemetry encoder, starting from the chair data just written"""
+        self.telemetry = TelemetryEncoder(publisher, f'chairs/{self.chair_id}', urgent=URGENT_FIELDS)
+        acked = {'status': written['status']}
+        if 'current_speed' in written:
+            acked['current_speed'] = written['current_speed']
+        for key, value in written['movement_state'].items():
+            acked[f'movement_state/{key}'] = value
+        self.telemetry.acknowledge(acked)
+        self.register_stats('telemetry', self.telemetry.stats)
+
+    def publish_state(self, status=None, movement=None, speed=None):
+        """Queue the chair status, speed and movement_state fields for publishing"""
+        if self.telemetry is None:
+            return
+        
+        values = {}
+        if status is not None:
+            values['status'] = status
+        if speed is not None:
+            values['current_speed'] = speed
+        for key, value in (movement or {}).items():
+            values[f'movement_state/{key}'] = value
+        # Fields that did not change since the last write are not sent again
+        self.telemetry.update(values)
+
+    def log_movement(self, direction, message, *args, **values):
+        """Log a movement in full when the direction changes and sampled while it repeats"""
+        previous = self.current_movement_state.direction
+        if direction != previous:
+            self.log.info(message, *args, extra=fields(previous=previous, **values))
+        else:
+            sampled(self.log, (self.name, direction), message, *args, **values)
+
+    def stop(self):
+        """Stop all motors"""
+        self.motors.stop()
+        self.log_movement('stop', "Motors stopped.")
+        
+        # Update movement state
+        self.current_movement_state.update('stop', 0, 0, 0, 0, 0, 0, self.clock())
+        
+        # Update status in Firebase if chair ID is available
+        self.publish_state('ready', {
             'direction': 'stop',
             'x': 0,
             'y': 0
         })
 
-def set_speed(speed_value):
-    """Set the motor speed level"""
-    global current_speed
-    
-    try:
-        # If it's a string command for backward compatibility
-        if isinstance(speed_value, str):
-            if speed_value == 'full_speed':
-                speed = MAX_SPEED
-            elif speed_value == 'low_speed':
-                speed = MIN_SPEED
+    def set_speed(self, speed_value):
+        """Set the motor speed level"""
+        try:
+            # If it's a string command for backward compatibility
+            if isinstance(speed_value, str):
+                if speed_value == 'full_speed':
+                    speed = MAX_SPEED
+                elif speed_value == 'low_speed':
+                    speed = MIN_SPEED
+                else:
+                    self.log.warning("Unknown speed command: %s", speed_value)
+                    return
             else:
-                print(f"Unknown speed command: {speed_value}")
-                return
-        else:
-            # Ensure speed is within valid range
-            speed = max(MIN_SPEED, min(int(speed_value), MAX_SPEED))
-        
-        # Only update if the speed change is significant
-        if abs(current_speed - speed) >= SPEED_THRESHOLD:
-            current_speed = speed
+                # Ensure speed is within valid range
+                speed = max(MIN_SPEED, min(int(speed_value), MAX_SPEED))
             
-            # Update speed in Firebase
-            if CHAIR_ID:
-                db.reference(f'chairs/{CHAIR_ID}/current_speed').set(current_speed)
+            # Only update if the speed change is significant
+            if abs(self.current_speed - speed) >= SPEED_THRESHOLD:
+                self.current_speed = speed
+                
+                # Update speed in Firebase
+                self.publish_state(speed=self.current_speed)
+                    
+                sampled(self.log, (self.name, 'speed'), "Speed set to %s%%", self.current_speed)
                 
-            print(f"Speed set to {current_speed}%")
+                # If we're currently moving, apply the new speed
+                if self.current_movement_state.direction != 'stop':
+                    # Re-apply the current movement with the new speed
+                    self.move_joystick(self.current_movement_state.x, self.current_movement_state.y)
             
-            # If we're currently moving, apply the new speed
-            if current_movement_state['direction'] != 'stop':
-                # Re-apply the current movement with the new speed
-                move_joystick(current_movement_state['x'], current_movement_state['y'])
-        
-    except (ValueError, TypeError):
-        print(f"Invalid speed value: {speed_value}")
-
-def move_forward():
-    """Move the chair forward"""
-    if current_speed == 0:
-        set_speed(DEFAULT_SPEED)  # Default to medium speed if none set
-    pwm_L_R.ChangeDutyCycle(0)
-    pwm_L_L.ChangeDutyCycle(current_speed)
-    pwm_R_R.ChangeDutyCycle(current_speed)
-    pwm_R_L.ChangeDutyCycle(0)
-    print(f"Moving FORWARD at speed {current_speed}%")
-    
-    # Update movement state
-    global current_movement_state
-    current_movement_state = {
-        'x': 0,
-        'y': 100,  # 100 = full forward
-        'left_speed': current_speed,
-        'right_speed': current_speed,
-        'direction': 'forward',
-        'angle': 90,  # Degrees (90° = forward)
-        'magnitude': 100,
-        'last_update_time': time.time()
-    }
-    
-    # Update status in Firebase
-    if CHAIR_ID:
-        db.reference(f'chairs/{CHAIR_ID}/status').set('moving')
-        db.reference(f'chairs/{CHAIR_ID}/movement_state').update({
+        except (ValueError, TypeError):
+            self.log.warning("Invalid speed value: %r", speed_value)
+
+    def move_forward(self):
+        """Move the chair forward"""
+        if self.current_speed == 0:
+            self.set_speed(DEFAULT_SPEED)  # Default to medium speed if none set
+        self.motors.drive(self.current_speed, self.current_speed)
+        self.log_movement('forward', "Moving FORWARD at speed %s%%", self.current_speed)
+        
+        # Update movement state
+        self.current_movement_state.update('forward', 0, 100, self.current_speed, self.current_speed,
+                                           90, 100, self.clock())  # Degrees (90° = forward)
+        
+        # Update status in Firebase
+        self.publish_state('moving', {
             'direction': 'forward',
             'x': 0,       # X=0 for straight forward
             'y': 100      # Y=100 for full forward
         })
 
-def move_backward():
-    """Move the chair backward"""
-    if current_speed == 0:
-        set_speed(DEFAULT_SPEED)  # Default to medium speed if none set
-    pwm_L_R.ChangeDutyCycle(current_speed)
-    pwm_L_L.ChangeDutyCycle(0)
-    pwm_R_R.ChangeDutyCycle(0)
-    pwm_R_L.ChangeDutyCycle(current_speed)
-    print(f"Moving BACKWARD at speed {current_speed}%")
-    
-    # Update movement state
-    global current_movement_state
-    current_movement_state = {
-        'x': 0,
-        'y': -100,  # -100 = full backward
-        'left_speed': current_speed,
-        'right_speed': current_speed,
-        'direction': 'backward',
-        'angle': 270,  # Degrees (270° = backward)
-        'magnitude': 100,
-        'last_update_time': time.time()
-    }
-    
-    # Update status in Firebase
-    if CHAIR_ID:
-        db.reference(f'chairs/{CHAIR_ID}/status').set('moving')
-        db.reference(f'chairs/{CHAIR_ID}/movement_state').update({
+    def move_backward(self):
+        """Move the chair backward"""
+        if self.current_speed == 0:
+            self.set_speed(DEFAULT_SPEED)  # Default to medium speed if none set
+        self.motors.drive(-self.current_speed, -self.current_speed)
+        self.log_movement('backward', "Moving BACKWARD at speed %s%%", self.current_speed)
+        
+        # Update movement state
+        self.current_movement_state.update('backward', 0, -100, -self.current_speed, -self.current_speed,
+                                           270, 100, self.clock())  # Degrees (270° = backward)
+        
+        # Update status in Firebase
+        self.publish_state('moving', {
             'direction': 'backward',
             'x': 0,        # X=0 for straight backward
             'y': -100      # Y=-100 for full backward
         })
 
-def turn_left():
-    """Turn the chair left"""
-    if current_speed == 0:
-        set_speed(DEFAULT_SPEED)  # Default to medium speed if none set
-    pwm_L_R.ChangeDutyCycle(0)
-    pwm_L_L.ChangeDutyCycle(current_speed)
-    pwm_R_R.ChangeDutyCycle(0)
-    pwm_R_L.ChangeDutyCycle(current_speed)
-    print(f"Turning LEFT at speed {current_speed}%")
-    
-    # Update movement state
-    global current_movement_state
-    current_movement_state = {
-        'x': -100,  # -100 = full left
-        'y': 0,
-        'left_speed': current_speed,
-        'right_speed': current_speed,
-        'direction': 'left',
-        'angle': 180,  # Degrees (180° = left)
-        'magnitude': 100,
-        'last_update_time': time.time()
-    }
-    
-    # Update status in Firebase
-    if CHAIR_ID:
-        db.reference(f'chairs/{CHAIR_ID}/status').set('moving')
-        db.reference(f'chairs/{CHAIR_ID}/movement_state').update({
+    def turn_left(self):
+        """Turn the chair left"""
+        if self.current_speed == 0:
+            self.set_speed(DEFAULT_SPEED)  # Default to medium speed if none set
+        self.motors.drive(self.current_speed, -self.current_speed)
+        self.log_movement('left', "Turning LEFT at speed %s%%", self.current_speed)
+        
+        # Update movement state
+        self.current_movement_state.update('left', -100, 0, self.current_speed, -self.current_speed,
+                                           180, 100, self.clock())  # Degrees (180° = left)
+        
+        # Update status in Firebase
+        self.publish_state('moving', {
             'direction': 'left',
             'x': -100,     # X=-100 for full left
             'y': 0         # Y=0 for no forward/backward
         })
 
-def turn_right():
-    """Turn the chair right"""
-    if current_speed == 0:
-        set_speed(DEFAULT_SPEED)  # Default to medium speed if none set
-    pwm_L_R.ChangeDutyCycle(current_speed)
-    pwm_L_L.ChangeDutyCycle(0)
-    pwm_R_R.ChangeDutyCycle(current_speed)
-    pwm_R_L.ChangeDutyCycle(0)
-    print(f"Turning RIGHT at speed {current_speed}%")
-    
-    # Update movement state
-    global current_movement_state
-    current_movement_state = {
-        'x': 100,  # 100 = full right
-        'y': 0,
-        'left_speed': current_speed,
-        'right_speed': current_speed,
-        'direction': 'right',
-        'angle': 0,  # Degrees (0° = right)
-        'magnitude': 100,
-        'last_update_time': time.time()
-    }
-    
-    # Update status in Firebase
-    if CHAIR_ID:
-        db.reference(f'chairs/{CHAIR_ID}/status').set('moving')
-        db.reference(f'chairs/{CHAIR_ID}/movement_state').update({
+    def turn_right(self):
+        """Turn the chair right"""
+        if self.current_speed == 0:
+            self.set_speed(DEFAULT_SPEED)  # Default to medium speed if none set
+        self.motors.drive(-self.current_speed, self.current_speed)
+        self.log_movement('right', "Turning RIGHT at speed %s%%", self.current_speed)
+        
+        # Update movement state
+        self.current_movement_state.update('right', 100, 0, -self.current_speed, self.current_speed,
+                                           0, 100, self.clock())  # Degrees (0° = right)
+        
+        # Update status in Firebase
+        self.publish_state('moving', {
             'direction': 'right',
             'x': 100,      # X=100 for full right
             'y': 0         # Y=0 for no forward/backward
         })
 
-def move_joystick(x, y):
-    """
-    Move the chair based on joystick coordinates.
-    x: -100 to 100 (left to right)
-    y: -100 to 100 (backward to forward)
-    """
-    global current_movement_state
-    current_time = time.time()
-    
-    if current_speed == 0:
-        set_speed(DEFAULT_SPEED)  # Default to medium speed if none set
-    
-    # Ensure values are within range
-    x = max(-100, min(100, x))
-    y = max(-100, min(100, y))
-    
-    # Store the original joystick values for Firebase updates
-    original_x = x
-    original_y = y
-    
-    # Check if movement is within the deadzone
-    if abs(x) < 5 and abs(y) < 5:
-        # If we're already stopped, don't do anything
-        if current_movement_state['direction'] == 'stop':
+    def move_joystick(self, x, y):
+        """
+        Move the chair based on joystick coordinates.
+        x: -100 to 100 (left to right)
+        y: -100 to 100 (backward to forward)
+        """
+        current_time = self.clock()
+        
+        if self.current_speed == 0:
+            self.set_speed(DEFAULT_SPEED)  # Default to medium speed if none set
+        
+        # Ensure values are within range
+        x = max(-100, min(100, x))
+        y = max(-100, min(100, y))
+        
+        # Store the original joystick values for Firebase updates
+        original_x = x
+        original_y = y
+        
+        # Wheel duties, direction, angle and magnitude come from the precomputed table
+        left_speed, right_speed, direction, angle, magnitude = kinematics.lookup(x, y, self.current_speed)
+        
+        # Check if movement is within the deadzone
+        if direction == 'stop':
+            # If we're already stopped, don't do anything
+            if self.current_movement_state.direction == 'stop':
+                return
+            self.stop()
             return
-        stop()
-        return
-    
-    # Calculate movement angle and magnitude
-    angle = math.degrees(math.atan2(y, x))
-    if angle < 0:
-        angle += 360  # Convert to 0-360 range
-    magnitude = min(100, math.sqrt(x*x + y*y))  # 0-100
-    
-    # Calculate time since last update
-    time_since_last_update = current_time - current_movement_state['last_update_time']
-    
-    # Check if the change in movement is significant OR if we've exceeded the time threshold for an update
-    angle_diff = abs((angle - current_movement_state['angle'] + 180) % 360 - 180)
-    magnitude_diff = abs(magnitude - current_movement_state['magnitude'])
-    
-    if ((magnitude_diff < MOVEMENT_THRESHOLD and 
-        angle_diff < ANGLE_THRESHOLD) and
-        time_since_last_update < UPDATE_TIME_THRESHOLD and
-        current_movement_state['direction'] != 'stop'):
-        return
-    
-    # No longer swapping x and y - use directly for correct direction mapping
-    # Previously:
-    # temp_x = x
-    # x = y
-    # y = -temp_x
-    
-    # Update movement state with the actual joystick values
-    current_movement_state['x'] = x
-    current_movement_state['y'] = y
-    current_movement_state['angle'] = angle
-    current_movement_state['magnitude'] = magnitude
-    current_movement_state['last_update_time'] = current_time
-    
-    # Scale magnitude to speed range
-    speed_factor = magnitude / 100.0
-    motor_speed = current_speed * speed_factor
-    
-    if motor_speed < MIN_SPEED and magnitude > 0:
-        motor_speed = MIN_SPEED  # Ensure we meet minimum speed if joystick is moved
-    
-    # Calculate motor speeds
-    left_speed = motor_speed
-    right_speed = motor_speed
-    
-    # Determine direction and adjust motor speeds based on joystick position
-    if x < 0:  # Left side of joystick (turn left)
-        turn_factor = abs(x) / 100.0
-        right_speed = motor_speed
-        left_speed = motor_speed * (1 - turn_factor)
-        
-        if y > 0:  # Forward-left
-            current_movement_state['direction'] = 'forward-left'
-        elif y < 0:  # Backward-left
-            current_movement_state['direction'] = 'backward-left'
-        else:  # Pure left
-            current_movement_state['direction'] = 'left'
-            
-    elif x > 0:  # Right side of joystick (turn right)
-        turn_factor = x / 100.0
-        left_speed = motor_speed
-        right_speed = motor_speed * (1 - turn_factor)
-        
-        if y > 0:  # Forward-right
-            current_movement_state['direction'] = 'forward-right'
-        elif y < 0:  # Backward-right
-            current_movement_state['direction'] = 'backward-right'
-        else:  # Pure right
-            current_movement_state['direction'] = 'right'
-            
-    else:  # Pure forward/backward
-        if y > 0:
-            current_movement_state['direction'] = 'forward'
-        elif y < 0:
-            current_movement_state['direction'] = 'backward'
-    
-    # Update the motor speeds in the state
-    current_movement_state['left_speed'] = left_speed
-    current_movement_state['right_speed'] = right_speed
-    
-    # Apply motor speeds based on direction
-    if y >= 0:  # Forward or neutral with turning
-        # Forward direction
-        pwm_L_R.ChangeDutyCycle(0)
-        pwm_L_L.ChangeDutyCycle(left_speed if y > 0 or x != 0 else 0)
-        pwm_R_R.ChangeDutyCycle(right_speed if y > 0 or x != 0 else 0)
-        pwm_R_L.ChangeDutyCycle(0)
-    else:  # Backward
-        # Backward direction
-        pwm_L_R.ChangeDutyCycle(left_speed)
-        pwm_L_L.ChangeDutyCycle(0)
-        pwm_R_R.ChangeDutyCycle(0)
-        pwm_R_L.ChangeDutyCycle(right_speed)
-    
-    print(f"Joystick: x={x}, y={y}, direction={current_movement_state['direction']}, left_speed={left_speed:.1f}, right_speed={right_speed:.1f}")
-    
-    # Update status in Firebase
-    if CHAIR_ID:
-        db.reference(f'chairs/{CHAIR_ID}/status').set('moving')
         
+        # Calculate time since last update
+        state = self.current_movement_state
+        time_since_last_update = current_time - state.last_update_time
+        
+        # Check if the change in movement is significant OR if we've exceeded the time threshold for an update
+        angle_diff = abs((angle - state.angle + 180) % 360 - 180)
+        magnitude_diff = abs(magnitude - state.magnitude)
+        
+        if ((magnitude_diff < MOVEMENT_THRESHOLD and 
+            angle_diff < ANGLE_THRESHOLD) and
+            time_since_last_update < UPDATE_TIME_THRESHOLD and
+            state.direction != 'stop'):
+            return
+        
+        self.log_movement(direction, "Joystick %s", direction, x=x, y=y,
+                     left_speed=round(abs(left_speed), 1), right_speed=round(abs(right_speed), 1))
+        
+        # Update movement state with the actual joystick values
+        state.update(direction, x, y, left_speed, right_speed, angle, magnitude, current_time)
+        
+        # Apply motor speeds, negative duties drive the wheel backward
+        self.motors.drive(left_speed, right_speed)
+        
+        # Update status in Firebase
         # Important: Use the original joystick values for the movement_state
         # to ensure consistent values between the app and the chair
-        db.reference(f'chairs/{CHAIR_ID}/movement_state').update({
-            'direction': current_movement_state['direction'],
+        self.publish_state('moving', {
+            'direction': direction,
             'x': original_x,  # Use original X value received from joystick
             'y': original_y   # Use original Y value received from joystick
         })
 
-def handle_command(command, value=None):
-    """Handle incoming commands"""
-    if command == 'forward':
-        move_forward()
-    elif command == 'backward':
-        move_backward()
-    elif command == 'left':
-        turn_left()
-    elif command == 'right':
-        turn_right()
-    elif command == 'direction':
-        # Handle directional commands for diagonal movements
-        if isinstance(value, str):
-            handle_direction(value)
-        else:
-            print("Invalid direction format. Expected string value.")
-    elif command == 'joystick':
-        if isinstance(value, dict) and 'x' in value and 'y' in value:
-            move_joystick(value['x'], value['y'])
+    def handle_command(self, command, value=None):
+        """Handle incoming commands"""
+        if command == 'forward':
+            self.move_forward()
+        elif command == 'backward':
+            self.move_backward()
+        elif command == 'left':
+            self.turn_left()
+        elif command == 'right':
+            self.turn_right()
+        elif command == 'direction':
+            # Handle directional commands for diagonal movements
+            if isinstance(value, str):
+                self.handle_direction(value)
+            else:
+                self.log.warning("Invalid direction format. Expected string value.")
+        elif command == 'joystick':
+            if isinstance(value, dict) and 'x' in value and 'y' in value:
+                self.move_joystick(value['x'], value['y'])
+            else:
+                self.log.warning("Invalid joystick value format. Expected {x: value, y: value}")
+        elif command == 'speed':
+            if value is not None:
+                self.set_speed(value)
+        elif command == 'full_speed':  # For backward compatibility
+            self.set_speed('full_speed')
+        elif command == 'low_speed':   # For backward compatibility
+            self.set_speed('low_speed')
+        elif command == 'start':
+            self.start()
+        elif command == 'stop':
+            self.stop()
         else:
-            print("Invalid joystick value format. Expected {x: value, y: value}")
-    elif command == 'speed':
-        if value is not None:
-            set_speed(value)
-    elif command == 'full_speed':  # For backward compatibility
-        set_speed('full_speed')
-    elif command == 'low_speed':   # For backward compatibility
-        set_speed('low_speed')
-    elif command == 'start':
-        start()
-    elif command == 'stop':
-        stop()
-    else:
-        print(f"Unknown command: {command}")
-
-def handle_direction(direction):
-    """Handle directional commands including diagonals"""
-    if current_speed == 0:
-        set_speed(DEFAULT_SPEED)  # Default to medium speed if none set
-    
-    print(f"Handling direction: {direction}")
-    
-    # Coordinates for each direction (x, y values in range -100 to 100)
-    direction_coords = {
-        'forward': (0, 100),
-        'backward': (0, -100),
-        'left': (-100, 0),
-        'right': (100, 0),
-        'forward-left': (-70, 70),     # Diagonal forward-left
-        'forward-right': (70, 70),     # Diagonal forward-right
-        'backward-left': (-70, -70),   # Diagonal backward-left
-        'backward-right': (70, -70),   # Diagonal backward-right
-        'stop': (0, 0)
-    }
-    
-    # Get the coordinates for the requested direction
-    if direction in direction_coords:
-        x, y = direction_coords[direction]
+            self.log.warning("Unknown command: %s", command)
+
+    def run_command(self, command, value=None, timestamp=None):
+        """Run a command from the scheduler and record how late and how long it was"""
+        if self.closed:
+            return
         
-        # Update movement state
-        global current_movement_state
-        current_time = time.time()
-        
-        current_movement_state['x'] = x
-        current_movement_state['y'] = y
-        current_movement_state['direction'] = direction
-        current_movement_state['last_update_time'] = current_time
-        
-        # Calculate motor speeds based on direction
-        if direction == 'forward':
-            # Full forward
-            pwm_L_R.ChangeDutyCycle(0)
-            pwm_L_L.ChangeDutyCycle(current_speed)
-            pwm_R_R.ChangeDutyCycle(current_speed)
-            pwm_R_L.ChangeDutyCycle(0)
-            current_movement_state['left_speed'] = current_speed
-            current_movement_state['right_speed'] = current_speed
-            
-        elif direction == 'backward':
-            # Full backward
-            pwm_L_R.ChangeDutyCycle(current_speed)
-            pwm_L_L.ChangeDutyCycle(0)
-            pwm_R_R.ChangeDutyCycle(0)
-            pwm_R_L.ChangeDutyCycle(current_speed)
-            current_movement_state['left_speed'] = current_speed
-            current_movement_state['right_speed'] = current_speed
-            
-        elif direction == 'right':
-            # FIXED: This is turning RIGHT, swap the speeds
-            pwm_L_R.ChangeDutyCycle(0)
-            pwm_L_L.ChangeDutyCycle(current_speed * 0.5)  # Left motor slower
-            pwm_R_R.ChangeDutyCycle(current_speed)        # Right motor faster
-            pwm_R_L.ChangeDutyCycle(0)
-            current_movement_state['left_speed'] = current_speed * 0.5
-            current_movement_state['right_speed'] = current_speed
-            
-        elif direction == 'left':
-            # FIXED: This is turning LEFT, swap the speeds
-            pwm_L_R.ChangeDutyCycle(0)
-            pwm_L_L.ChangeDutyCycle(current_speed)        # Left motor faster
-            pwm_R_R.ChangeDutyCycle(current_speed * 0.5)  # Right motor slower
-            pwm_R_L.ChangeDutyCycle(0)
-            current_movement_state['left_speed'] = current_speed
-            current_movement_state['right_speed'] = current_speed * 0.5
-            
-        elif direction == 'forward-right':
-            # FIXED: Forward-RIGHT diagonal, swapped motor speeds
-            left_speed = current_speed * 0.3  # Left motor slower
-            right_speed = current_speed       # Right motor faster
-            pwm_L_R.ChangeDutyCycle(0)
-            pwm_L_L.ChangeDutyCycle(left_speed)
-            pwm_R_R.ChangeDutyCycle(right_speed)
-            pwm_R_L.ChangeDutyCycle(0)
-            current_movement_state['left_speed'] = left_speed
-            current_movement_state['right_speed'] = right_speed
-            
-        elif direction == 'forward-left':
-            # FIXED: Forward-LEFT diagonal, swapped motor speeds
-            left_speed = current_speed       # Left motor faster
-            right_speed = current_speed * 0.3  # Right motor slower
-            pwm_L_R.ChangeDutyCycle(0)
-            pwm_L_L.ChangeDutyCycle(left_speed)
-            pwm_R_R.ChangeDutyCycle(right_speed)
-            pwm_R_L.ChangeDutyCycle(0)
-            current_movement_state['left_speed'] = left_speed
-            current_movement_state['right_speed'] = right_speed
-            
-        elif direction == 'backward-right':
-            # FIXED: Backward-RIGHT diagonal, swapped motor speeds
-            left_speed = current_speed * 0.3  # Left motor slower
-            right_speed = current_speed       # Right motor faster
-            pwm_L_R.ChangeDutyCycle(left_speed)
-            pwm_L_L.ChangeDutyCycle(0)
-            pwm_R_R.ChangeDutyCycle(0)
-            pwm_R_L.ChangeDutyCycle(right_speed)
-            current_movement_state['left_speed'] = left_speed
-            current_movement_state['right_speed'] = right_speed
-            
-        elif direction == 'backward-left':
-            # FIXED: Backward-LEFT diagonal, swapped motor speeds
-            left_speed = current_speed       # Left motor faster
-            right_speed = current_speed * 0.3  # Right motor slower
-            pwm_L_R.ChangeDutyCycle(left_speed)
-            pwm_L_L.ChangeDutyCycle(0)
-            pwm_R_R.ChangeDutyCycle(0)
-            pwm_R_L.ChangeDutyCycle(right_speed)
-            current_movement_state['left_speed'] = left_speed
-            current_movement_state['right_speed'] = right_speed
-            
-        elif direction == 'stop':
-            # Stop all motors
-            stop()
+        now_ms = scheduler.server_time_ms()
+        if isinstance(timestamp, (int, float)) and now_ms is not None:
+            # Firebase server time against the local clock, corrected by the measured offset
+            command_age.record((now_ms - timestamp) / 1000)
+        
+        if self.control is not None:
+            # Split chair: the control process picks it up from shared memory
+            self.control.submit(command, value, timestamp)
             return
         
-        # Calculate magnitude and angle from x, y coordinates
-        magnitude = min(100, math.sqrt(x*x + y*y))
-        angle = math.degrees(math.atan2(y, x))
-        if angle < 0:
-            angle += 360
+        start = time.perf_counter()
+        self.handle_command(command, value)
+        actuation_time.record(time.perf_counter() - start)
+
+    def handle_direction(self, direction):
+        """Handle directional commands including diagonals"""
+        if self.current_speed == 0:
+            self.set_speed(DEFAULT_SPEED)  # Default to medium speed if none set
         
-        current_movement_state['magnitude'] = magnitude
-        current_movement_state['angle'] = angle
+        self.log.debug("Handling direction: %s", direction)
+        
+        # Get the coordinates for the requested direction
+        if direction not in DIRECTION_COORDS:
+            self.log.warning("Unknown direction: %s", direction)
+            self.stop()
+            return
+        
+        if direction == 'stop':
+            # Stop all self.motors
+            self.stop()
+            return
+        
+        # Directions keep their tuned wheel duties, the joystick mix only
+        # supplies the angle and magnitude of the direction
+        x, y = DIRECTION_COORDS[direction]
+        left_speed, right_speed = direction_duties(direction, self.current_speed)
+        _, _, _, angle, magnitude = kinematics.lookup(x, y, self.current_speed)
+        self.motors.drive(left_speed, right_speed)
+        self.log_movement(direction, "Moving %s at speed L:%.1f, R:%.1f", direction, abs(left_speed), abs(right_speed))
+        
+        # Update movement state
+        self.current_movement_state.update(direction, x, y, left_speed, right_speed,
+                                           angle, magnitude, self.clock())
         
         # Update status in Firebase
-        if CHAIR_ID:
-            db.reference(f'chairs/{CHAIR_ID}/status').set('moving')
-            db.reference(f'chairs/{CHAIR_ID}/movement_state').update({
-                'direction': direction,
-                'x': x,
-                'y': y,
-                'left_speed': current_movement_state['left_speed'],
-                'right_speed': current_movement_state['right_speed'],
-                'magnitude': magnitude,
-                'angle': angle
-            })
-        
-        print(f"Moving {direction} at speed L:{current_movement_state['left_speed']:.1f}, R:{current_movement_state['right_speed']:.1f}")
-    else:
-        print(f"Unknown direction: {direction}")
-        stop()
-
-def start():
-    """Start the chair - initialize motors but don't move yet"""
-    # Reset motors to ready state
-    stop()
-    print("Chair initialized and ready to move.")
-    
-    # Update status in Firebase if chair ID is available
-    if CHAIR_ID:
-        db.reference(f'chairs/{CHAIR_ID}/status').set('ready')
+        self.publish_state('moving', {
+            'direction': direction,
+            'x': x,
+            'y': y,
+            'left_speed': self.current_movement_state.left_speed,
+            'right_speed': self.current_movement_state.right_speed,
+            'magnitude': magnitude,
+            'angle': angle
+        })
 
-def setup_chair():
-    """Setup the chair with its code"""
-    global CHAIR_CODE, CHAIR_ID
-    
-    # Try to load existing chair info
-    CHAIR_CODE, CHAIR_ID = load_chair_info()
-    
-    if CHAIR_CODE is None or CHAIR_ID is None:
-        # If no info exists, register a new chair
-        register_chair()
-    else:
+    def start(self):
+        """Start the chair - initialize self.motors but don't move yet"""
+        # Reset self.motors to ready state
+        self.stop()
+        self.log.info("Chair initialized and ready to move.")
+        
+        # Update status in Firebase if chair ID is available
+        self.publish_state('ready')
+
+    def init_compactor(self, command_ids=()):
+        """Create the command compactor, seeded with command ids already in the database"""
+        # Deletes go straight to the database, the latest-wins publisher may drop them
+        self.compactor = CommandCompactor(lambda updates: root_ref.update(updates),
+                                          f'chairs/{self.chair_id}/commands')
+        self.compactor.seed(command_ids)
+        self.register_stats('compactor', self.compactor.stats)
+        return self.compactor
+
+    def setup_chair(self):
+        """Setup the chair with its code"""
+        # Try to load existing chair info
+        self.chair_code, self.chair_id = self.load_chair_info()
+        
+        if self.chair_code is None or self.chair_id is None:
+            # If no info exists, register a new chair
+            self.register_chair()
+            return
+        
+        # Shallow reads only return keys and plain values (like self.current_speed),
+        # never the command history, and both run at the same time
+        chair_path = f'chairs/{self.chair_id}'
+        self.bind_references()
+        with ThreadPoolExecutor(2) as pool:
+            chair_read = pool.submit(self.chair_ref.get, shallow=True)
+            commands_read = pool.submit(self.commands_ref.get, shallow=True)
+            chair_data = chair_read.result()
+            commands = commands_read.result()
+        
         # Verify the chair exists in Firebase
-        chair_ref = db.reference(f'chairs/{CHAIR_ID}')
-        chair_data = chair_ref.get()
         if chair_data is None:
-            print("Chair not found in database. Registering new chair...")
-            register_chair()
-        else:
-            print(f"Chair initialized with code: {CHAIR_CODE}")
-            print(f"Chair ID: {CHAIR_ID}")
-            
-            # Update the chair's status to online and reset movement state
-            chair_ref.update({
-                'status': 'online',
-                'last_seen': {'.sv': 'timestamp'},
-                'movement_state': {
-                    'direction': 'stop',
-                    'x': 0,     # X=0 (center)
-                    'y': 0      # Y=0 (center)
-                }
-            })
-            
-            # Create detailed movement state reference for efficient updates
-            movement_ref = db.reference(f'chairs/{CHAIR_ID}/movement_state')
-            movement_ref.update({
+            self.log.warning("Chair not found in database. Registering new chair...")
+            self.register_chair()
+            return
+        
+        self.log.info("Chair initialized with code: %s", self.chair_code, extra=fields(chair_id=self.chair_id))
+        
+        # Load saved speed if available, the self.motors are still stopped from self.init_motors()
+        try:
+            self.current_speed = max(MIN_SPEED, min(int(chair_data.get('current_speed', DEFAULT_SPEED)), MAX_SPEED))
+        except (ValueError, TypeError):
+            self.current_speed = DEFAULT_SPEED
+        
+        # Status, speed, the reset movement state and the pruned command
+        # history all go out in a single multi-path update
+        updates = {
+            f'{chair_path}/status': 'ready',
+            f'{chair_path}/last_seen': {'.sv': 'timestamp'},
+            f'{chair_path}/current_speed': self.current_speed,
+            f'{chair_path}/movement_state': {
                 'direction': 'stop',
-                'x': 0,
-                'y': 0,
-                'magnitude': 0,
-                'left_speed': 0,
-                'right_speed': 0
-            })
+                'x': 0,             # X=0 (center)
+                'y': 0,             # Y=0 (center)
+                'magnitude': 0,     # No movement
+                'left_speed': 0,    # Motors stopped
+                'right_speed': 0,   # Motors stopped
+                'angle': 0          # No direction angle
+            }
+        }
+        self.init_compactor(commands.keys() if isinstance(commands, dict) else ())
+        updates.update(self.compactor.prune_updates())
+        sent = time.time()
+        try:
+            root_ref.update(updates)
+        except Exception:
+            self.compactor.restore(updates)
+            raise
+        self.start_clock_sync('last_seen', sent, time.time())
+        self.init_telemetry({'status': 'ready', 'current_speed': self.current_speed,
+                             'movement_state': updates[f'{chair_path}/movement_state']})
+        if self.control is not None:
+            # The control process started before the saved speed was known
+            scheduler.submit('speed', self.current_speed, handler=self.run_command)
+
+    def listen_for_commands(self):
+        """Listen for commands from Firebase"""
+        if self.chair_id is None:
+            self.log.error("Chair not properly initialized!")
+            return
             
-            # Load saved speed if available
-            if 'current_speed' in chair_data:
-                set_speed(chair_data['current_speed'])
+        commands_ref = self.commands_ref
+        if self.compactor is None:
+            # The listener snapshot seeds it with the stored commands
+            self.init_compactor()
+        
+        # Resume after the last command handled by a previous run. The initial
+        # snapshot of the listener is bounded by the compactor and anything at
+        # or before the cursor in it is skipped instead of being run again.
+        cursor_key, cursor_timestamp = self.load_command_cursor()
+        self.cursor = CommandCursor(self.save_command_cursor, cursor_key, cursor_timestamp)
+        
+        # Rebuilds commands from the streamed event payloads and only reads a
+        # command back from Firebase when an event does not carry all of it
+        decoder = CommandDecoder(lambda command_id: commands_ref.child(command_id).get(),
+                                 cursor=self.cursor)
+        self.register_stats('decoder', decoder.stats)
+        
+        def handle_command_update(event):
+            """Handle updates to the chair's commands"""
+            # Only snapshots seed it, patches carrying the compactor's own deletes would re-add them
+            if event.path == '/' and event.event_type == 'put' and isinstance(event.data, dict):
+                self.compactor.seed(command_id for command_id, data in event.data.items() if data is not None)
             
-            # Initialize motors to stopped state
-            stop()
+            for command_id, command_data in decoder.decode(event):
+                # While the LAN link is up it drives the chair, stop/start still count
+                if self.lan is None or not self.lan.claims(command_data['command'], PRIORITY_COMMANDS):
+                    if self.trace is not None:
+                        self.trace.record(command_data['command'], command_data.get('value'),
+                                          command_data.get('timestamp'))
+                    scheduler.submit(command_data['command'], command_data.get('value'),
+                                     command_data.get('timestamp'), handler=self.run_command)
+                self.cursor.advance(command_id, command_data.get('timestamp'))
+                self.compactor.processed(command_id)
+        
+        # Listen for changes to commands, from the cursor's timestamp on where
+        # the datastore can stream a query (served by the .indexOn timestamp
+        # rule); commands sharing that timestamp are told apart by the key
+        scheduler.start()
+        if cursor_timestamp and getattr(store, 'listens_to_queries', False):
+            query = commands_ref.order_by_child('timestamp').start_at(cursor_timestamp)
+            self.listener = query.listen(handle_command_update)
+        else:
+            self.listener = commands_ref.listen(handle_command_update)
 
-def listen_for_commands():
-    """Listen for commands from Firebase"""
-    if CHAIR_ID is None:
-        print("Chair not properly initialized!")
-        return
+    def submit_lan_command(self, command, value=None):
+        """Queue a command received over the LAN channel"""
+        # Stamped on arrival in Firebase server time, so age and expiry are measured
+        # the same way; unstamped while the clock offset is unknown
+        timestamp = scheduler.server_time_ms()
+        if self.trace is not None:
+            self.trace.record(command, value, timestamp, source=SOURCE_LAN)
+        scheduler.submit(command, value, timestamp, handler=self.run_command)
+
+    def lan_link_changed(self, up):
+        """Hand control between the LAN channel and Firebase"""
+        if up:
+            self.log.info("LAN link up, ignoring Firebase motion commands")
+            return
+        self.log.warning("LAN link lost, falling back to Firebase")
+        # The app's joystick stream was cut off, don't keep driving on its last command
+        if self.current_movement_state.direction != 'stop':
+            if self.trace is not None:
+                self.trace.record('stop', source=SOURCE_LAN)
+            scheduler.submit('stop', handler=self.run_command)
+
+    def start_lan(self, port=LAN_PORT):
+        """Accept commands directly from the app over UDP"""
+        if not port or self.chair_id is None:
+            return
+        # The chair id and code are readable by every app user, so the key
+        # comes from a secret that only leaves the chair out of band
+        secret_path = os.path.join(os.path.dirname(self.info_path), LAN_SECRET_FILE)
+        secret, created = load_pairing_secret(secret_path)
+        if created:
+            self.log.info("Created the LAN pairing secret in %s, give it to the app to pair", secret_path)
+        self.lan = LanCommandServer(pairing_key(self.chair_id, secret), self.submit_lan_command,
+                                    port=port, on_link_change=self.lan_link_changed)
+        self.lan.start()
+        self.register_stats('lan', self.lan.stats)
         
-    commands_ref = db.reference(f'chairs/{CHAIR_ID}/commands')
-    
-    # Set initial speed
-    set_speed(DEFAULT_SPEED)
-    
-    # Create a state reference node for efficient state updates
-    state_ref = db.reference(f'chairs/{CHAIR_ID}/movement_state')
-    state_ref.set({
-        'direction': 'stop',
-        'x': 0,             # X=0 (center)
-        'y': 0,             # Y=0 (center)
-        'magnitude': 0,     # No movement
-        'left_speed': 0,    # Motors stopped 
-        'right_speed': 0,   # Motors stopped
-        'angle': 0          # No direction angle
-    })
-    
-    def handle_command_update(event):
-        """Handle updates to the chair's commands"""
-        if event.path == '/' and event.data is None:
+        # Let the app find the chair on the local network
+        publisher.publish({f'chairs/{self.chair_id}/lan': {'address': local_address(), 'port': self.lan.address[1]}})
+        self.log.info("LAN commands on udp port %s", self.lan.address[1])
+
+    def start_trace(self, path=TRACE_PATH):
+        """Record received commands to a trace file when CHAIR_TRACE is set"""
+        if not path:
             return
-            
-        # If event.path is '/', we received the full commands object
-        if event.path == '/':
-            if not event.data:
-                return
-                
-            # Find the latest command
-            latest_command = None
-            latest_timestamp = 0
-            latest_value = None
-            
-            for cmd_id, cmd_data in event.data.items():
-                if cmd_data.get('timestamp', 0) > latest_timestamp:
-                    latest_timestamp = cmd_data.get('timestamp', 0)
-                    latest_command = cmd_data.get('command')
-                    latest_value = cmd_data.get('value')
-            
-            if latest_command:
-                handle_command(latest_command, latest_value)
+        self.trace = TraceRecorder(path)
+        # A replay starts from the speed the chair had when recording began
+        self.trace.record('speed', self.current_speed, source=SOURCE_STATE)
+        self.register_stats('trace', self.trace.stats)
+        self.log.info("Recording commands to %s", path)
+
+    def start_control(self, backend=None):
+        """Run the motors in a separate control process, fed through shared memory"""
+        self.control = ControlProcess(run_control, self.apply_control_state, self.info_path,
+                                      backend or GPIO_BACKEND)
+        self.control.start()
+        self.register_stats('control', self.control_stats)
+        self.log.info("Motors run in control process %s", self.control.process.pid)
+
+    def apply_control_state(self, state):
+        """Mirror the state written by the control process and publish its fields"""
+        previous, self.control_state = self.control_state, state
+        if previous is None or previous['movement'] != state['movement']:
+            self.current_movement_state.update(*state['movement'])
+        self.current_speed = state['fields'].get('current_speed', self.current_speed)
+        if self.telemetry is not None:
+            self.telemetry.update(state['fields'])
+
+    def control_stats(self):
+        """Return the shared memory counters and those of the control process"""
+        stats = self.control.stats()
+        if self.control_state is not None:
+            stats.update(self.control_state['control'])
+        return stats
+
+    def _shutdown(self):
+        """Stop the motors for good, runs on the control thread"""
+        if self.control is not None:
+            self.control.stop()
+        else:
+            self.stop()
+        self.closed = True
+
+    def close(self):
+        """Stop listening, stop the motors and save the command cursor"""
+        try:
+            if self.listener is not None:
+                self.listener.close()
+                self.listener = None
+            if self.lan is not None:
+                self.lan.close()
+                self.lan = None
+            if self.motors is not None or self.control is not None:
+                # On the control thread like any command, cancelling motion still queued
+                try:
+                    scheduler.call(self._shutdown, preempt=self.run_command)
+                except TimeoutError as e:
+                    self.log.error("Control thread did not stop the motors, stopping them directly: %s", e)
+                    self._halt()
+        finally:
+            # Whatever failed above, the wheels stop and the pins are released
+            if self.control is not None:
+                self.control.close()
+            if self.control_loop is not None:
+                self.control_loop.close()
+            if self.ramp is not None:
+                # Nothing steps the ramp any more, stop the wheels right away
+                self.ramp.halt()
+            if self.compactor is not None:
+                self.compactor.close()
+            if self.cursor is not None:
+                self.cursor.save()
+            if self.gpio is not None:
+                self.gpio.cleanup()
+            if self.trace is not None:
+                self.trace.close()
+
+    def _halt(self):
+        """Stop the motors from the calling thread, when the control thread is stuck"""
+        if self.control is not None:
+            self.control.stop()
+        elif self.ramp is not None:
+            self.ramp.halt()
         else:
-            # We received a specific command update
-            command_path = event.path.split('/')
-            if len(command_path) >= 2:  # Format: /command_id
-                command_id = command_path[1]
-                command_data = commands_ref.child(command_id).get()
-                if command_data and 'command' in command_data:
-                    handle_command(command_data['command'], command_data.get('value'))
+            self.motors.stop()
+        self.closed = True
+
+def run_control(memory_name, info_path, backend=None):
+    """Control process of a split chair: owns the GPIO and runs the latest commands at the control rate"""
+    # Ctrl-C reaches the whole process group, the network process stops us in order
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logs = setup_logging()
+    kinematics.load()
+    memory = ChairSharedMemory(memory_name)
+    wheelchair = Chair(info_path, name='control')
+    wheelchair.init_motors(backend)
+    # publish_state() lands in the state slot, the network process publishes it
+    state = wheelchair.telemetry = StateWriter(memory.state)
+    inbox = CommandInbox(memory.commands)
+    parent = multiprocessing.parent_process()
+    counters = {'commands_run': 0}
+    
+    def snapshot():
+        """Movement state with the signed duties the wheels are driven at, duties and counters"""
+        current = wheelchair.current_movement_state
+        duties = wheelchair.motors.duties()
+        movement = [current.direction, current.x, current.y, duties['L_L'] - duties['L_R'],
+                    duties['R_R'] - duties['R_L'], current.angle, current.magnitude, current.last_update_time]
+        stats = loop.stats()
+        stats.update(counters, commands_skipped=inbox.commands_skipped)
+        return movement, duties, stats
+    
+    def tick(seconds):
+        """Run new commands, step the ramp and share the state"""
+        for command, value, _ in inbox.poll():
+            wheelchair.handle_command(command, value)
+            counters['commands_run'] += 1
+        if wheelchair.ramp is not None:
+            wheelchair.ramp.step(seconds)
+        state.flush(snapshot)
+        if inbox.closed:
+            loop.stop()
+        elif not parent.is_alive():
+            wheelchair.log.warning("Network process is gone, stopping the motors")
+            loop.stop()
     
-    # Listen for changes to commands
-    commands_ref.listen(handle_command_update)
+    # Commands and the ramp share this process's main thread and its cadence
+    loop = ControlLoop(tick, wheelchair.ramp.rate if wheelchair.ramp is not None else DEFAULT_CONTROL_RATE)
+    try:
+        loop.run()
+    finally:
+        # Whatever ended the loop, the chair does not keep driving
+        if wheelchair.current_movement_state.direction != 'stop':
+            wheelchair.stop()
+        if wheelchair.ramp is not None:
+            wheelchair.ramp.halt()
+        state.flush(snapshot, force=True)
+        wheelchair.gpio.cleanup()
+        memory.close()
+        logs.close()
+
+def publish_metrics(summary):
+    """Summarize the metrics into chairs/{id}/metrics"""
+    if chair is not None and chair.chair_id:
+        summary['updated_at'] = {'.sv': 'timestamp'}
+        publisher.publish({f'chairs/{chair.chair_id}/metrics': summary})
+
+def start_metrics():
+    """Export metrics as Prometheus text and periodically to Firebase"""
+    global metrics_reporter
+    metrics.register_stats('publisher', publisher.stats)
+    metrics.register_stats('scheduler', scheduler.stats)
+    if chair.motors is not None:
+        metrics.register_stats('motors', chair.motors.stats)
+    metrics.register_stats('startup', lambda: startup_times)
+    # Connection reuse and TLS handshakes of the datastore session
+    metrics.register_stats('datastore', store.stats)
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+        log.info("Metrics available on http://127.0.0.1:%s/metrics", METRICS_PORT)
+    metrics_reporter = MetricsReporter(metrics, publish_metrics)
+    metrics_reporter.start()
+
+def startup_phases(datastore):
+    """Startup steps of main() in order, with the step that connects the datastore"""
+    motors = chair.start_control if PROCESS_MODE == 'split' else chair.init_motors
+    return (('motors', motors), ('datastore', datastore),
+            ('setup', chair.setup_chair), ('control', chair.start_control_loop),
+            ('trace', chair.start_trace),
+            ('listen', chair.listen_for_commands),
+            ('lan', chair.start_lan))
+
+def shutdown(logs):
+    """Stop the chair and release everything main() started"""
+    if metrics_reporter is not None:
+        metrics_reporter.close()
+    # The chair stops on the control thread, which is shut down afterwards
+    try:
+        chair.close()
+    finally:
+        scheduler.close()
+        publisher.close()
+        if store is not None:
+            store.close()
+        logs.close()
+
+async def main_async(logs):
+    """Main function of the asyncio runtime: the event loop streams commands and sends the writes"""
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+    try:
+        started = time.perf_counter()
+        threading.Thread(target=kinematics.load, name='kinematics', daemon=True).start()
+        
+        log.info("Starting chair control system (asyncio runtime)...")
+        publisher.max_in_flight = PUBLISH_IN_FLIGHT
+        publisher.start()
+        for phase, step in startup_phases(init_async_datastore):
+            phase_start = time.perf_counter()
+            if asyncio.iscoroutinefunction(step):
+                await step()
+            else:
+                # Blocking steps run off the loop, their datastore calls come back to it
+                await asyncio.to_thread(step)
+            startup_times[f'{phase}_seconds'] = round(time.perf_counter() - phase_start, 4)
+        startup_times['ready_seconds'] = round(time.perf_counter() - started, 4)
+        log.info("Listening for commands, ready in %.3fs", startup_times['ready_seconds'],
+                 extra=fields(**startup_times))
+        start_metrics()
+        
+        await stopping.wait()
+        log.info("Exiting...")
+    finally:
+        # Closing the datastore waits on the loop, so it cannot run on it
+        await asyncio.to_thread(shutdown, logs)
 
 def main():
     """Main function"""
+    global chair
+    # Log lines are written by a background thread, never by the command path
+    logs = setup_logging()
+    metrics.register_stats('log', logs.stats)
+    chair = Chair()
+    if RUNTIME == 'asyncio':
+        asyncio.run(main_async(logs))
+        return
     try:
-        setup_chair()
-        print("Starting chair control system...")
-        print("Listening for commands...")
-        listen_for_commands()
+        started = time.perf_counter()
+        
+        # The joystick table loads while the startup round trips are in flight
+        threading.Thread(target=kinematics.load, name='kinematics', daemon=True).start()
+        
+        log.info("Starting chair control system...")
+        publisher.start()
+        for phase, step in startup_phases(init_datastore):
+            phase_start = time.perf_counter()
+            step()
+            startup_times[f'{phase}_seconds'] = round(time.perf_counter() - phase_start, 4)
+        startup_times['ready_seconds'] = round(time.perf_counter() - started, 4)
+        log.info("Listening for commands, ready in %.3fs", startup_times['ready_seconds'],
+                 extra=fields(**startup_times))
+        start_metrics()
         
         # Keep the program running
         while True:
             time.sleep(1)
             
     except KeyboardInterrupt:
-        print("\nExiting...")
+        log.info("Exiting...")
     finally:
-        stop()
-        GPIO.cleanup()
+        shutdown(logs)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
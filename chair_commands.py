@@ -0,0 +1,560 @@
+"""
+Command ingestion for the smart chair.
+Turns Realtime Database listener events on chairs/{id}/commands into
+complete command records without extra round trips, and schedules them
+so stop/start preempt motion and stale joystick positions are skipped.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+log = logging.getLogger('chair.commands')
+
+# Number of recently seen commands kept for applying partial updates
+MAX_CACHED_COMMANDS = 32
+
+# Commands that jump the queue and cancel pending motion
+PRIORITY_COMMANDS = ('stop', 'start')
+
+# Commands where only the most recent pending value matters
+COALESCED_COMMANDS = ('joystick', 'direction', 'speed')
+
+# Commands that move the chair and are cancelled by a stop/start
+MOTION_COMMANDS = ('forward', 'backward', 'left', 'right', 'direction', 'joystick')
+
+# Marks functions queued with CommandScheduler.call(), they run in the priority lane
+CONTROL_CALL = object()
+
+# Commands older than this (based on their Firebase timestamp) are dropped
+MAX_COMMAND_AGE = 2.0  # Seconds
+
+# Number of processed commands kept under chairs/{id}/commands
+COMMAND_HISTORY_WINDOW = 20
+
+# Processed commands are pruned once this many have piled up past the window
+COMPACTION_BATCH = 20
+
+# Minimum time between two saves of the command cursor
+CURSOR_SAVE_INTERVAL = 1.0  # Seconds
+
+
+class CommandCursor:
+    """Remember the newest handled command so nothing is run twice"""
+
+    def __init__(self, save, key=None, timestamp=0, save_interval=CURSOR_SAVE_INTERVAL):
+        # save(key, timestamp) persists the cursor across restarts
+        self._save = save
+        self._save_interval = save_interval
+        self._last_save = 0
+        self._dirty = False
+        self.key = key
+        self.timestamp = timestamp or 0
+
+    def is_new(self, command_id):
+        """Check whether a command comes after the cursor (push ids sort by time)"""
+        return self.key is None or command_id > self.key
+
+    def advance(self, command_id, timestamp):
+        """Move the cursor past a handled command, saving it now and then"""
+        if not self.is_new(command_id):
+            return
+        self.key = command_id
+        if isinstance(timestamp, (int, float)):
+            self.timestamp = timestamp
+        self._dirty = True
+        if time.monotonic() - self._last_save >= self._save_interval:
+            self.save()
+
+    def save(self):
+        """Persist the cursor if it moved since the last save"""
+        if not self._dirty:
+            return
+        self._dirty = False
+        self._last_save = time.monotonic()
+        try:
+            self._save(self.key, self.timestamp)
+        except OSError as e:
+            log.warning("Could not save command cursor: %s", e)
+
+
+class CommandDecoder:
+    """Rebuild command records from the payloads of listener events"""
+
+    def __init__(self, fetch, max_cached=MAX_CACHED_COMMANDS, cursor=None):
+        # fetch(command_id) reads one command from the database; only used
+        # when an event does not carry enough data to rebuild the command
+        self._fetch = fetch
+        self._max_cached = max_cached
+        self._cursor = cursor
+        self._commands = OrderedDict()
+
+        # Counters for monitoring
+        self.events_decoded = 0
+        self.fetch_fallbacks = 0
+
+    def decode(self, event):
+        """Return the (command_id, command_data) pairs an event made ready to run"""
+        self.events_decoded += 1
+        event_type = getattr(event, 'event_type', 'put')
+        parts = [part for part in event.path.split('/') if part]
+
+        if not parts:
+            if event_type == 'patch':
+                # Patch at the root: keys are child paths relative to commands
+                changed = []
+                for child_path, value in (event.data or {}).items():
+                    command_id = self._apply(child_path.strip('/').split('/'), value, 'put')
+                    if command_id and command_id not in changed:
+                        changed.append(command_id)
+                return self._complete(changed)
+
+            # Full snapshot of the commands node, only the newest unseen one matters
+            self._commands.clear()
+            if not isinstance(event.data, dict):
+                return []
+            latest_id = None
+            latest_timestamp = 0
+            for command_id, command_data in event.data.items():
+                if not isinstance(command_data, dict) or not self._is_new(command_id):
+                    continue
+                self._remember(command_id, command_data)
+                timestamp = command_data.get('timestamp', 0)
+                if isinstance(timestamp, (int, float)) and timestamp > latest_timestamp:
+                    latest_timestamp = timestamp
+                    latest_id = command_id
+            return self._complete([latest_id] if latest_id else [])
+
+        command_id = self._apply(parts, event.data, event_type)
+        return self._complete([command_id] if command_id else [])
+
+    def _is_new(self, command_id):
+        """Check a command id against the cursor, if there is one"""
+        return self._cursor is None or self._cursor.is_new(command_id)
+
+    def _apply(self, parts, data, event_type):
+        """Apply one put/patch to the cached copy of a command, return its id"""
+        command_id = parts[0]
+        if not self._is_new(command_id):
+            # Already handled before, possibly by a previous run
+            return None
+        if len(parts) == 1 and data is None:
+            # Command deleted
+            self._commands.pop(command_id, None)
+            return None
+
+        if len(parts) == 1 and event_type == 'put':
+            command = dict(data) if isinstance(data, dict) else {}
+        else:
+            command = self._commands.get(command_id)
+            if command is None:
+                # Partial update for a command we have never seen in full
+                command = self._fetch_command(command_id)
+                if command is None:
+                    return None
+                self._remember(command_id, command)
+                return command_id
+            command = dict(command)
+
+            if len(parts) == 1:
+                for key, value in (data or {}).items():
+                    self._set_path(command, key.strip('/').split('/'), value)
+            else:
+                self._set_path(command, parts[1:], data)
+
+        self._remember(command_id, command)
+        return command_id
+
+    def _complete(self, command_ids):
+        """Resolve ids to complete commands, fetching any that are missing fields"""
+        ready = []
+        for command_id in command_ids:
+            command = self._commands.get(command_id)
+            if command is None or 'command' not in command:
+                command = self._fetch_command(command_id)
+                if command is None:
+                    continue
+                self._remember(command_id, command)
+            if 'command' in command:
+                ready.append((command_id, command))
+        return ready
+
+    def _fetch_command(self, command_id):
+        """Read a command from the database when the event payload was not enough"""
+        self.fetch_fallbacks += 1
+        command = self._fetch(command_id)
+        return command if isinstance(command, dict) else None
+
+    def _remember(self, command_id, command):
+        """Cache a command, evicting the oldest once the cache is full"""
+        self._commands[command_id] = command
+        self._commands.move_to_end(command_id)
+        while len(self._commands) > self._max_cached:
+            self._commands.popitem(last=False)
+
+    @staticmethod
+    def _set_path(target, parts, value):
+        """Set a nested value in a command dict, deleting it when value is None"""
+        for part in parts[:-1]:
+            child = target.get(part)
+            if not isinstance(child, dict):
+                child = target[part] = {}
+            target = child
+        if value is None:
+            target.pop(parts[-1], None)
+        else:
+            target[parts[-1]] = value
+
+    def stats(self):
+        """Return the decoder counters"""
+        return {
+            'events_decoded': self.events_decoded,
+            'fetch_fallbacks': self.fetch_fallbacks
+        }
+
+
+class CommandScheduler:
+    """
+    Control actor: the one thread that runs commands and touches motor state.
+    Listener threads only append to a lock-free ingest deque; the actor
+    drains it into its own queues, where stop/start preempt pending motion
+    and joystick/direction/speed coalesce, then runs them one at a time.
+    Work from other threads (like stopping at shutdown) goes through call().
+    """
+
+    def __init__(self, handler=None, max_age=MAX_COMMAND_AGE, clock=time.time):
+        # handler(command, value, timestamp) is called on the actor thread.
+        # Commands can also bring their own handler, so several chairs can share
+        # one actor; coalescing and preemption then stay within each handler.
+        self._handler = handler
+        self._max_age_ms = max_age * 1000
+        self._clock = clock
+        self._ingest = deque()          # Appended by any thread, popped by the actor only
+        self._wake = threading.Event()
+        self._idle = threading.Condition()
+        self._priority = deque()        # Owned by the actor thread
+        self._normal = OrderedDict()    # Owned by the actor thread
+        self._sequence = 0
+        self._running = False
+        self._busy = False
+        self._thread = None
+
+        # Milliseconds to add to the local clock to get Firebase server time,
+        # None until sync_clock() measured it. The Pi has no RTC, so until then
+        # commands are never expired by age.
+        self.clock_offset_ms = None
+        self.clock_uncertainty_ms = None    # Half the round trip of the measurement
+
+        # Counters for monitoring
+        self.submitted = 0
+        self.dispatched = 0
+        self.coalesced = 0   # Pending commands replaced by a newer one
+        self.preempted = 0   # Pending motion commands cancelled by stop/start
+        self.expired = 0     # Commands dropped because they were too old
+        self.calls = 0       # Functions run for other threads through call()
+        self.max_backlog = 0  # Most entries taken from the ingest queue at once
+
+    def start(self):
+        """Start the actor thread"""
+        with self._idle:
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name='control', daemon=True)
+            self._thread.start()
+
+    def submit(self, command, value=None, timestamp=None, handler=None):
+        """Queue a command for the actor, to handler or the scheduler's own handler"""
+        # deque.append is atomic, so listeners never wait on the actor. The wake
+        # event is only set when it is not already, since setting it takes a lock;
+        # the actor clears it before draining, so an entry is never left behind.
+        self._ingest.append((handler or self._handler, command, value, timestamp))
+        if not self._wake.is_set():
+            self._wake.set()
+
+    def call(self, fn, preempt=None, timeout=2.0):
+        """
+        Run fn() on the actor thread ahead of queued commands and return its result.
+        With preempt, motion still queued for that handler is cancelled like by a stop.
+        """
+        if not self._running or threading.current_thread() is self._thread:
+            return fn()
+        done = threading.Event()
+        outcome = []
+
+        def run(command, value, timestamp):
+            try:
+                outcome.append((True, fn()))
+            except Exception as e:
+                outcome.append((False, e))
+            finally:
+                done.set()
+
+        self._ingest.append((run, CONTROL_CALL, preempt, None))
+        self._wake.set()
+        if not done.wait(timeout):
+            raise TimeoutError(f"Control thread did not run {fn!r} within {timeout}s")
+        ok, result = outcome[0]
+        if not ok:
+            raise result
+        return result
+
+    def wait_idle(self, timeout=2.0):
+        """Wait until every queued command has been dispatched"""
+        deadline = time.monotonic() + timeout
+        with self._idle:
+            while self._running and (self._ingest or self._priority or self._normal or self._busy):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def close(self, timeout=2.0):
+        """Stop the actor thread, discarding commands that are still queued"""
+        with self._idle:
+            self._running = False
+            self._idle.notify_all()
+        self._wake.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+        self._thread = None
+        self._ingest.clear()
+        self._priority.clear()
+        self._normal.clear()
+
+    def sync_clock(self, server_ms, sent, received):
+        """
+        Measure the clock offset from a server timestamp written by a request
+        sent and answered at the given local times (seconds since epoch)
+        """
+        if not isinstance(server_ms, (int, float)) or isinstance(server_ms, bool):
+            return False
+        uncertainty_ms = (received - sent) * 500
+        if self.clock_uncertainty_ms is not None and uncertainty_ms > self.clock_uncertainty_ms:
+            return False  # A shorter round trip measured it more precisely
+        self.clock_offset_ms = server_ms - (sent + received) * 500
+        self.clock_uncertainty_ms = uncertainty_ms
+        return True
+
+    def server_time_ms(self):
+        """Firebase server time in ms since epoch, None while the clock offset is unknown"""
+        if self.clock_offset_ms is None:
+            return None
+        return self._clock() * 1000 + self.clock_offset_ms
+
+    def is_expired(self, timestamp):
+        """Check whether a command timestamp (ms since epoch) is too old to run"""
+        if not isinstance(timestamp, (int, float)) or self._max_age_ms <= 0:
+            return False
+        now_ms = self.server_time_ms()
+        if now_ms is None:
+            return False
+        return now_ms - timestamp > self._max_age_ms
+
+    def stats(self):
+        """Return the scheduler counters, pending is read without stopping the actor"""
+        return {
+            'submitted': self.submitted,
+            'dispatched': self.dispatched,
+            'coalesced': self.coalesced,
+            'preempted': self.preempted,
+            'expired': self.expired,
+            'calls': self.calls,
+            'max_backlog': self.max_backlog,
+            'clock_offset_ms': round(self.clock_offset_ms or 0, 1),
+            'clock_synced': int(self.clock_offset_ms is not None),
+            'pending': len(self._ingest) + len(self._priority) + len(self._normal)
+        }
+
+    def _drain(self):
+        """Move ingested entries into the actor's queues, applying preemption and coalescing"""
+        taken = 0
+        ingest = self._ingest
+        while ingest:
+            entry = ingest.popleft()
+            taken += 1
+            handler, command = entry[0], entry[1]
+            if command is CONTROL_CALL:
+                if entry[2] is not None:
+                    self._preempt(entry[2])
+                self._priority.append(entry)
+                continue
+            self.submitted += 1
+            if command in PRIORITY_COMMANDS:
+                # Anything still waiting to move the chair is out of date now
+                self._preempt(handler)
+                self._priority.append(entry)
+            elif command in COALESCED_COMMANDS:
+                # Latest wins, and it moves to the back of the queue
+                if self._normal.pop((handler, command), None) is not None:
+                    self.coalesced += 1
+                self._normal[(handler, command)] = entry
+            else:
+                self._sequence += 1
+                self._normal[self._sequence] = entry
+        if taken > self.max_backlog:
+            self.max_backlog = taken
+
+    def _preempt(self, handler):
+        """Cancel the motion commands queued for a handler"""
+        for key in [key for key, pending in self._normal.items()
+                    if pending[1] in MOTION_COMMANDS and pending[0] == handler]:
+            del self._normal[key]
+            self.preempted += 1
+
+    def _next(self):
+        """Take the next command to run, priority lane first"""
+        if self._priority:
+            return self._priority.popleft()
+        return self._normal.popitem(last=False)[1]
+
+    def _run(self):
+        """Actor loop: take in new commands, then run the next one"""
+        self._busy = True
+        while True:
+            self._drain()
+            if not (self._priority or self._normal):
+                with self._idle:
+                    self._busy = False
+                    self._idle.notify_all()
+                # Cleared before draining again, so a submit in between is never missed
+                self._wake.wait()
+                self._wake.clear()
+                # Busy before draining, so wait_idle never sees a command in neither queue
+                self._busy = True
+                if not self._running:
+                    return
+                continue
+            if not self._running:
+                return
+            handler, command, value, timestamp = self._next()
+
+            if command is CONTROL_CALL:
+                handler(command, value, timestamp)
+                self.calls += 1
+                continue
+
+            # A late stop is still safe to apply, anything else is dropped
+            if command not in PRIORITY_COMMANDS and self.is_expired(timestamp):
+                self.expired += 1
+                continue
+
+            try:
+                handler(command, value, timestamp)
+                self.dispatched += 1
+            except Exception as e:
+                log.exception("Error handling command %s: %s", command, e)
+
+
+class CommandCompactor:
+    """Acknowledge processed commands and prune the history in batches"""
+
+    def __init__(self, write, commands_path, window=COMMAND_HISTORY_WINDOW,
+                 batch=COMPACTION_BATCH):
+        # write() sends a {path: value} multi-path update relative to the root
+        # and raises when it fails; it runs on the compactor's worker thread,
+        # never the listener's
+        self._write = write
+        self._path = commands_path.strip('/')
+        self._window = window
+        self._batch = batch
+        self._lock = threading.Lock()
+        self._known = set()
+        self._due = threading.Event()
+        self._closed = False
+        self._worker = None
+
+        # Counters for monitoring
+        self.commands_pruned = 0
+        self.compactions = 0
+        self.writes_failed = 0
+
+    def seed(self, command_ids):
+        """Register command ids already stored in the database"""
+        with self._lock:
+            self._known.update(command_ids)
+
+    def processed(self, command_id):
+        """Mark a command as handled, pruning old ones once a batch has built up"""
+        with self._lock:
+            self._known.add(command_id)
+            if len(self._known) < self._window + self._batch or self._closed:
+                return
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name='compactor', daemon=True)
+                self._worker.start()
+        # Batches that fill up while a write is under way are pruned by the next pass
+        self._due.set()
+
+    def close(self, timeout=2.0):
+        """Stop the worker, a compaction that is under way is finished first"""
+        with self._lock:
+            self._closed = True
+            worker = self._worker
+        self._due.set()
+        if worker is not None:
+            worker.join(timeout)
+
+    def _run(self):
+        """Worker loop: prune whenever processed() found a full batch"""
+        while True:
+            self._due.wait()
+            self._due.clear()
+            if self._closed:
+                return
+            self.compact()
+
+    def compact(self):
+        """Delete everything but the newest commands in one multi-path update, return how many"""
+        updates = self.prune_updates()
+        if not updates:
+            return 0
+        try:
+            self._write(updates)
+        except Exception as e:
+            self.restore(updates)
+            log.warning("Could not prune the command history: %s", e)
+            return 0
+        return len(updates) - 1
+
+    def prune_updates(self):
+        """
+        Build the multi-path update that prunes old commands, for sending with
+        other writes. Pass it to restore() if that write fails.
+        """
+        with self._lock:
+            # Push ids sort chronologically, so the oldest commands come first
+            ordered = sorted(self._known)
+            prune = ordered[:-self._window] if self._window > 0 else ordered
+            if not prune:
+                return {}
+            self._known.difference_update(prune)
+            self.commands_pruned += len(prune)
+            self.compactions += 1
+
+        updates = {f'{self._path}/{command_id}': None for command_id in prune}
+        updates[f'{self._path}_ack'] = ordered[-1]
+        return updates
+
+    def restore(self, updates):
+        """The prune update was not written, keep its commands for the next compaction"""
+        prefix = self._path + '/'
+        command_ids = [path[len(prefix):] for path, value in updates.items()
+                       if value is None and path.startswith(prefix)]
+        with self._lock:
+            self._known.update(command_ids)
+            self.commands_pruned -= len(command_ids)
+            self.compactions -= 1
+            self.writes_failed += 1
+
+    def stats(self):
+        """Return the compactor counters"""
+        with self._lock:
+            stored = len(self._known)
+        return {
+            'commands_pruned': self.commands_pruned,
+            'compactions': self.compactions,
+            'writes_failed': self.writes_failed,
+            'stored': stored
+        }
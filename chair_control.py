@@ -0,0 +1,226 @@
+"""
+Fixed-rate motor control for the smart chair.
+Commands only set wheel targets. A ControlLoop ticks at CHAIR_CONTROL_RATE on
+the monotonic clock and RampedMotors moves each wheel's signed duty toward its
+target, accelerating and braking at limited rates, so actuation follows the
+loop's cadence instead of the timing of network events. The loop counts
+overruns and keeps a histogram of how late each tick started; it can pin
+itself to a CPU and ask for SCHED_FIFO.
+"""
+import logging
+import os
+import threading
+import time
+
+from chair_metrics import LatencyHistogram
+
+log = logging.getLogger('chair.control')
+
+# Control loop ticks per second, 0 applies duties as soon as a command runs
+CONTROL_RATE = float(os.environ.get('CHAIR_CONTROL_RATE', '100'))
+
+# Rate used where a loop is needed anyway, like the control process of a split chair
+DEFAULT_CONTROL_RATE = 100.0
+
+# Wheel duty change limits in percentage points per second: speeding up, and
+# slowing down (also on the way through zero when a wheel reverses)
+ACCELERATION = float(os.environ.get('CHAIR_ACCELERATION', '200'))
+DECELERATION = float(os.environ.get('CHAIR_DECELERATION', '400'))
+
+# CPU to pin the control loop to ('' for any) and its SCHED_FIFO priority (0 for none)
+CONTROL_CPU = os.environ.get('CHAIR_CONTROL_CPU', '')
+CONTROL_PRIORITY = int(os.environ.get('CHAIR_CONTROL_PRIORITY', '0'))
+
+
+def slew(actual, target, acceleration, deceleration, seconds):
+    """Move a signed duty toward its target by no more than the rate limits allow"""
+    if actual == target:
+        return actual
+    if actual and (target * actual <= 0 or abs(target) < abs(actual)):
+        # Braking, and a reversing wheel brakes to zero before it speeds up again
+        goal = target if target * actual > 0 else 0
+        step = deceleration * seconds
+    else:
+        goal = target
+        step = acceleration * seconds
+    if abs(goal - actual) <= step:
+        return goal
+    return actual + step if goal > actual else actual - step
+
+
+class RampedMotors:
+    """Wheel targets that the control loop moves a MotorDriver toward at limited rates"""
+
+    def __init__(self, driver, rate=CONTROL_RATE, acceleration=ACCELERATION, deceleration=DECELERATION):
+        self.driver = driver
+        self.rate = rate
+        self.period = 1.0 / rate
+        self._acceleration = acceleration
+        self._deceleration = deceleration
+        self._lock = threading.Lock()
+        self._target = (0, 0)   # Signed left and right duties
+        self._actual = (0, 0)
+
+        # Counters for monitoring
+        self.steps = 0
+        self.limited_steps = 0  # Steps where a wheel was held back by the limits
+
+    def drive(self, left, right):
+        """Set signed wheel targets (negative = backward)"""
+        with self._lock:
+            self._target = (left, right)
+
+    def stop(self):
+        """Bring both wheels to 0 at the braking rate"""
+        self.drive(0, 0)
+
+    def halt(self):
+        """Stop both wheels at once, for shutdown"""
+        with self._lock:
+            self._target = self._actual = (0, 0)
+            self.driver.stop()
+
+    def step(self, seconds):
+        """Move the duties toward the targets by the time since the last step"""
+        with self._lock:
+            if self._actual == self._target:
+                return
+            (left, right), (target_left, target_right) = self._actual, self._target
+            left = slew(left, target_left, self._acceleration, self._deceleration, seconds)
+            right = slew(right, target_right, self._acceleration, self._deceleration, seconds)
+            self._actual = (left, right)
+            self.steps += 1
+            if self._actual != self._target:
+                self.limited_steps += 1
+            self.driver.drive(left, right)
+
+    def advance(self, seconds):
+        """Run the steps of the given time at once, for replaying without a loop"""
+        while seconds > 0 and self._actual != self._target:
+            self.step(min(seconds, self.period))
+            seconds -= self.period
+
+    def targets(self):
+        """Return the signed left and right targets"""
+        with self._lock:
+            return self._target
+
+    def duties(self):
+        """Return the duty written to each channel"""
+        return self.driver.duties()
+
+    def stats(self):
+        """Return the driver and ramp counters"""
+        stats = self.driver.stats()
+        stats['steps'] = self.steps
+        stats['limited_steps'] = self.limited_steps
+        return stats
+
+
+class ControlLoop:
+    """Calls step(seconds since the last tick) at a fixed rate on the monotonic clock"""
+
+    def __init__(self, step, rate=CONTROL_RATE, cpu=CONTROL_CPU, priority=CONTROL_PRIORITY,
+                 clock=time.monotonic, halt=None):
+        # halt() stops the motors when a step raises, the loop ends after it
+        self._step = step
+        self._halt = halt
+        self.rate = rate
+        self.period = 1.0 / rate
+        self._cpu = cpu
+        self._priority = priority
+        self._clock = clock
+        self._stop = threading.Event()
+        self._thread = None
+        self.jitter = LatencyHistogram('control_jitter', 'Lateness of control loop ticks against their schedule')
+
+        # Counters for monitoring
+        self.ticks = 0
+        self.overruns = 0       # Ticks that ended after the next one was due
+        self.ticks_skipped = 0  # Ticks dropped to get back on schedule
+        self.max_tick = 0.0     # Longest step, in seconds
+        self.step_errors = 0
+
+    def start(self):
+        """Run the loop on its own thread"""
+        self._thread = threading.Thread(target=self.run, name='control-loop', daemon=True)
+        self._thread.start()
+
+    def run(self):
+        """Tick until stop() or close(), on the calling thread"""
+        self._configure()
+        clock = self._clock
+        period = self.period
+        next_tick = last = clock()
+        while not self._stop.is_set():
+            now = clock()
+            self.jitter.record(now - next_tick)
+            try:
+                self._step(now - last)
+            except Exception:
+                # Nothing steps the ramp any more, so the wheels must not keep their last duty
+                log.exception("Control step failed, halting the motors")
+                self.step_errors += 1
+                self._halt_motors()
+                break
+            last = now
+            self.ticks += 1
+
+            finished = clock()
+            self.max_tick = max(self.max_tick, finished - now)
+            next_tick += period
+            if finished >= next_tick:
+                # Missed the next deadline: skip the ticks already due rather than bursting
+                self.overruns += 1
+                skipped = int((finished - next_tick) / period) + 1
+                self.ticks_skipped += skipped
+                next_tick += skipped * period
+            time.sleep(next_tick - finished)
+
+    def _halt_motors(self):
+        """Call the halt callback, a failure there is logged and the loop still ends"""
+        if self._halt is None:
+            return
+        try:
+            self._halt()
+        except Exception:
+            log.exception("Could not halt the motors")
+
+    def stop(self):
+        """Leave the loop after the current tick"""
+        self._stop.set()
+
+    def close(self):
+        """Stop the loop and wait for its thread"""
+        self.stop()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        """Return the loop counters and tick lateness in microseconds"""
+        return {
+            'rate': self.rate,
+            'ticks': self.ticks,
+            'overruns': self.overruns,
+            'ticks_skipped': self.ticks_skipped,
+            'step_errors': self.step_errors,
+            'max_tick_us': round(self.max_tick * 1e6, 1),
+            'jitter_p50_us': round(self.jitter.percentile(0.5) * 1e6, 1),
+            'jitter_p99_us': round(self.jitter.percentile(0.99) * 1e6, 1),
+            'jitter_max_us': self.jitter.max or 0
+        }
+
+    def _configure(self):
+        """Pin the calling thread to a CPU and raise it to SCHED_FIFO when configured"""
+        if self._cpu not in ('', None):
+            try:
+                os.sched_setaffinity(0, {int(self._cpu)})
+            except (AttributeError, OSError, ValueError) as e:
+                log.warning("Could not pin the control loop to CPU %s: %s", self._cpu, e)
+        if self._priority > 0:
+            try:
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self._priority))
+            except (AttributeError, OSError) as e:
+                # Needs root or CAP_SYS_NICE, the loop still runs at normal priority
+                log.warning("Could not switch the control loop to SCHED_FIFO: %s", e)
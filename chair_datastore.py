@@ -0,0 +1,455 @@
+"""
+Datastore backends for the smart chair.
+Everything the chair reads and writes goes through a reference API shaped
+like firebase_admin.db (reference, child, get, set, update, push, delete,
+listen, order_by_child). The 'firebase' backend is the real Realtime
+Database; the 'memory' backend keeps the tree in-process and streams
+listener events with injected latency, so the command pipeline can be
+benchmarked without network access.
+"""
+import copy
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+log = logging.getLogger('chair.datastore')
+
+# Backend used when none is given: 'firebase' on the chair, 'memory' for testing
+DATASTORE = os.environ.get('CHAIR_DATASTORE', 'firebase')
+
+# Injected latency and jitter for the memory backend, in seconds
+MEMORY_LATENCY = float(os.environ.get('CHAIR_DATASTORE_LATENCY', '0'))
+MEMORY_JITTER = float(os.environ.get('CHAIR_DATASTORE_JITTER', '0'))
+
+
+class FirebaseDatastore:
+    """Realtime Database through the Firebase Admin SDK"""
+
+    name = 'firebase'
+
+    def __init__(self, credentials_path, database_url):
+        import firebase_admin  # Only needed when talking to the real database
+        from firebase_admin import credentials, db
+        self._db = db
+        cred = credentials.Certificate(credentials_path)
+        self._app = firebase_admin.initialize_app(cred, {
+            'databaseURL': database_url
+        })
+
+    def reference(self, path='/'):
+        """Return a firebase_admin Reference"""
+        return self._db.reference(path)
+
+    def stats(self):
+        """
+        Connection counters of the SDK's pooled HTTP session. Each new HTTPS
+        connection is a TLS handshake, reused ones serve the other requests.
+        """
+        try:
+            session = self._db.reference()._client.session
+            pools = session.get_adapter('https://').poolmanager.pools
+            pools = [pools[key] for key in pools.keys()]
+        except (AttributeError, KeyError):
+            return {}  # SDK internals changed, the counters are only for monitoring
+        connections = sum(pool.num_connections for pool in pools)
+        requests = sum(pool.num_requests for pool in pools)
+        return {
+            'connections_opened': connections,
+            'tls_handshakes': connections,
+            'requests': requests,
+            'requests_reused': max(0, requests - connections)
+        }
+
+    def close(self):
+        """Delete the Firebase app and its listener threads"""
+        import firebase_admin
+        firebase_admin.delete_app(self._app)
+
+
+class Event:
+    """Listener event with the same fields as firebase_admin.db.Event"""
+
+    def __init__(self, event_type, path, data):
+        self.event_type = event_type
+        self.path = path
+        self.data = data
+
+    def __repr__(self):
+        return f"Event({self.event_type!r}, {self.path!r}, {self.data!r})"
+
+
+def _split(path):
+    """Split a database path into its segments"""
+    return tuple(part for part in str(path).split('/') if part)
+
+
+def _join(parts):
+    """Join path segments back into an absolute path"""
+    return '/' + '/'.join(parts)
+
+
+class MemoryListener:
+    """Registration for a memory datastore listener"""
+
+    def __init__(self, store, parts, callback):
+        self._store = store
+        self.parts = parts
+        self.callback = callback
+        self.last_delivery = 0
+        self.closed = False
+
+    def close(self):
+        """Stop receiving events"""
+        self.closed = True
+        self._store._remove_listener(self)
+
+
+class MemoryQuery:
+    """Ordered/filtered read of the children of a memory reference"""
+
+    def __init__(self, ref, order_by):
+        self._ref = ref
+        self._order_by = order_by  # Child key, or None to order by key
+        self._start = None
+        self._end = None
+        self._limit_first = None
+        self._limit_last = None
+
+    def start_at(self, value):
+        self._start = value
+        return self
+
+    def end_at(self, value):
+        self._end = value
+        return self
+
+    def limit_to_first(self, limit):
+        self._limit_first = limit
+        return self
+
+    def limit_to_last(self, limit):
+        self._limit_last = limit
+        return self
+
+    def _sort_value(self, key, value):
+        if self._order_by is None:
+            return key
+        if isinstance(value, dict):
+            return value.get(self._order_by)
+        return None
+
+    def get(self):
+        """Return the matching children in order"""
+        children = self._ref.get()
+        if not isinstance(children, dict):
+            return OrderedDict()
+
+        items = []
+        for key, value in children.items():
+            order = self._sort_value(key, value)
+            if self._start is not None and (order is None or order < self._start):
+                continue
+            if self._end is not None and (order is None or order > self._end):
+                continue
+            items.append(((order is not None, order, key), key, value))
+        items.sort(key=lambda item: item[0])
+
+        if self._limit_first is not None:
+            items = items[:self._limit_first]
+        if self._limit_last is not None:
+            items = items[-self._limit_last:] if self._limit_last else []
+        return OrderedDict((key, value) for _, key, value in items)
+
+
+class MemoryReference:
+    """Reference into a memory datastore"""
+
+    def __init__(self, store, parts):
+        self._store = store
+        self._parts = parts
+
+    @property
+    def key(self):
+        return self._parts[-1] if self._parts else None
+
+    @property
+    def path(self):
+        return _join(self._parts)
+
+    def child(self, path):
+        return MemoryReference(self._store, self._parts + _split(path))
+
+    def get(self, shallow=False):
+        value = self._store._read(self._parts)
+        if shallow and isinstance(value, dict):
+            return {key: True if isinstance(child, dict) else child
+                    for key, child in value.items()}
+        return value
+
+    def set(self, value):
+        self._store._write(self._parts, value)
+
+    def update(self, value):
+        if not value or not isinstance(value, dict):
+            raise ValueError('Value argument must be a non-empty dictionary.')
+        self._store._write(self._parts, None, updates=value)
+
+    def push(self, value=''):
+        ref = self.child(self._store._push_key())
+        if value != '':
+            ref.set(value)
+        return ref
+
+    def delete(self):
+        self._store._write(self._parts, None)
+
+    def listen(self, callback):
+        return self._store._add_listener(self._parts, callback)
+
+    def order_by_child(self, path):
+        return MemoryQuery(self, path)
+
+    def order_by_key(self):
+        return MemoryQuery(self, None)
+
+
+class MemoryDatastore:
+    """In-process stand-in for the Realtime Database"""
+
+    name = 'memory'
+
+    def __init__(self, latency=MEMORY_LATENCY, jitter=MEMORY_JITTER, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+        self._root = {}
+        self._listeners = []
+        self._push_counter = itertools.count()
+        self._last_push_ms = 0
+
+        # Events waiting for delivery: (deliver at, sequence, listener, event)
+        self._queue = []
+        self._sequence = itertools.count()
+        self._queue_cond = threading.Condition()
+        self._dispatcher = None
+        self._delivering = False
+        self._running = True
+
+        # Counters for monitoring
+        self.requests = 0
+        self.events_delivered = 0
+
+    def reference(self, path='/'):
+        """Return a reference to a path"""
+        return MemoryReference(self, _split(path))
+
+    def close(self):
+        """Stop delivering events"""
+        with self._queue_cond:
+            self._running = False
+            self._queue_cond.notify_all()
+        if self._dispatcher is not None:
+            self._dispatcher.join(1.0)
+
+    def stats(self):
+        """Return the request and event counters"""
+        return {
+            'requests': self.requests,
+            'events_delivered': self.events_delivered
+        }
+
+    def wait_idle(self, timeout=2.0):
+        """Wait until every queued listener event has been delivered"""
+        deadline = time.monotonic() + timeout
+        with self._queue_cond:
+            while self._queue or self._delivering:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._queue_cond.wait(remaining)
+        return True
+
+    def _delay(self):
+        """Draw one latency sample"""
+        if self.latency <= 0 and self.jitter <= 0:
+            return 0
+        return max(0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+
+    def _round_trip(self):
+        """Block like a request to the real database would"""
+        self.requests += 1
+        delay = self._delay()
+        if delay:
+            time.sleep(delay)
+
+    def _push_key(self):
+        """Generate a chronologically sortable key like Firebase push ids"""
+        with self._lock:
+            now_ms = max(int(time.time() * 1000), self._last_push_ms)
+            self._last_push_ms = now_ms
+            return f'-{now_ms:012x}{next(self._push_counter):06x}'
+
+    def _read(self, parts):
+        self._round_trip()
+        with self._lock:
+            node = self._root
+            for part in parts:
+                if not isinstance(node, dict) or part not in node:
+                    return None
+                node = node[part]
+            return copy.deepcopy(node)
+
+    def _write(self, parts, value, updates=None):
+        """Apply a set (updates is None) or a multi-path update at parts"""
+        self._round_trip()
+        with self._lock:
+            if updates is None:
+                value = self._resolve(value)
+                self._store(parts, value)
+            else:
+                updates = {key: self._resolve(child) for key, child in updates.items()}
+                for key, child in updates.items():
+                    self._store(parts + _split(key), child)
+            self._notify(parts, value, updates)
+
+    def _resolve(self, value):
+        """Replace server values and drop empty children, like the database does"""
+        if isinstance(value, dict):
+            if value.get('.sv') == 'timestamp':
+                return int(time.time() * 1000)
+            resolved = {}
+            for key, child in value.items():
+                child = self._resolve(child)
+                if child is not None:
+                    resolved[str(key)] = child
+            return resolved or None
+        return copy.deepcopy(value)
+
+    def _store(self, parts, value):
+        if not parts:
+            self._root = value if isinstance(value, dict) else {}
+            return
+        node = self._root
+        trail = []
+        for part in parts[:-1]:
+            child = node.get(part)
+            if not isinstance(child, dict):
+                if value is None:
+                    return
+                child = node[part] = {}
+            trail.append((node, part))
+            node = child
+        if value is None:
+            node.pop(parts[-1], None)
+            # Remove parents left empty
+            while not node and trail:
+                parent, part = trail.pop()
+                del parent[part]
+                node = parent
+        else:
+            node[parts[-1]] = value
+
+    def _notify(self, parts, value, updates):
+        """Queue events for every listener affected by a write"""
+        for listener in list(self._listeners):
+            target = listener.parts
+            depth = len(target)
+            if updates is None:
+                if parts[:depth] == target:
+                    self._schedule(listener, Event('put', _join(parts[depth:]), copy.deepcopy(value)))
+                elif target[:len(parts)] == parts:
+                    self._schedule(listener, Event('put', '/', self._snapshot(target)))
+            elif parts[:depth] == target:
+                self._schedule(listener, Event('patch', _join(parts[depth:]), copy.deepcopy(updates)))
+            elif target[:len(parts)] == parts:
+                # Only the update keys at or below the listener matter
+                patch = {}
+                replaced = False
+                for key, child in updates.items():
+                    key_parts = parts + _split(key)
+                    if target[:len(key_parts)] == key_parts:
+                        replaced = True
+                    elif key_parts[:depth] == target:
+                        patch['/'.join(key_parts[depth:])] = copy.deepcopy(child)
+                if replaced:
+                    self._schedule(listener, Event('put', '/', self._snapshot(target)))
+                elif patch:
+                    self._schedule(listener, Event('patch', '/', patch))
+
+    def _snapshot(self, parts):
+        node = self._root
+        for part in parts:
+            if not isinstance(node, dict) or part not in node:
+                return None
+            node = node[part]
+        return copy.deepcopy(node)
+
+    def _add_listener(self, parts, callback):
+        listener = MemoryListener(self, parts, callback)
+        with self._lock:
+            self._listeners.append(listener)
+            # Like the real database, a new listener first gets the current value
+            self._schedule(listener, Event('put', '/', self._snapshot(parts)))
+        with self._queue_cond:
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch, name='datastore-events',
+                                                    daemon=True)
+                self._dispatcher.start()
+        return listener
+
+    def _remove_listener(self, listener):
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def _schedule(self, listener, event):
+        """Queue an event, keeping the order of events per listener"""
+        deliver_at = max(time.monotonic() + self._delay(), listener.last_delivery)
+        listener.last_delivery = deliver_at
+        with self._queue_cond:
+            heapq.heappush(self._queue, (deliver_at, next(self._sequence), listener, event))
+            self._queue_cond.notify()
+
+    def _dispatch(self):
+        """Deliver queued events once their injected latency has passed"""
+        while True:
+            with self._queue_cond:
+                while self._running:
+                    if self._queue:
+                        wait = self._queue[0][0] - time.monotonic()
+                        if wait <= 0:
+                            break
+                        self._queue_cond.wait(wait)
+                    else:
+                        self._queue_cond.wait()
+                if not self._running:
+                    return
+                _, _, listener, event = heapq.heappop(self._queue)
+                self._delivering = True
+
+            if not listener.closed:
+                try:
+                    listener.callback(event)
+                    self.events_delivered += 1
+                except Exception as e:
+                    log.exception("Listener callback failed: %s", e)
+
+            with self._queue_cond:
+                self._delivering = False
+                self._queue_cond.notify_all()
+
+
+def create_datastore(name=None, credentials_path='serviceAccountKey.json', database_url=None, **options):
+    """Create the datastore selected by name or CHAIR_DATASTORE"""
+    name = name or DATASTORE
+    if name == 'firebase':
+        return FirebaseDatastore(credentials_path, database_url)
+    if name == 'memory':
+        return MemoryDatastore(**options)
+    raise ValueError(f"Unknown datastore: {name} (expected firebase or memory)")
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Multi-chair runtime for depot test rigs and scale tests.
+Hosts many Chair instances in one process. They share one datastore
+connection (one authenticated Firebase app), the kinematics table, one
+telemetry publisher, one command scheduler thread and one control loop that
+steps every chair's motor ramp; each chair keeps its own state, simulated
+motors, command cursor and listener.
+
+Usage:
+    python3 chair_fleet.py --chairs 100 [--datastore memory] [--drive 5] [--duration 60]
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import chair
+from chair_control import CONTROL_RATE, ControlLoop
+from chair_kinematics import DIRECTION_COORDS
+from chair_log import setup_logging
+from chair_telemetry import MAX_PENDING_PATHS
+
+log = logging.getLogger('chair.fleet')
+
+# Directory with one chair info file per fleet chair
+FLEET_DIR = os.environ.get('CHAIR_FLEET_DIR', 'fleet')
+
+# Chairs set up at the same time during startup
+STARTUP_CONCURRENCY = 16
+
+# Telemetry paths a single chair can have pending at once
+PATHS_PER_CHAIR = 12
+
+# Pushes in flight at once while driving the fleet
+DRIVE_CONCURRENCY = 32
+
+# Seconds between two fleet status lines
+REPORT_INTERVAL = 5.0
+
+DRIVE_COMMANDS = ('joystick', 'joystick', 'joystick', 'direction', 'speed', 'stop')
+
+
+class Fleet:
+    """Chairs sharing the datastore, publisher and scheduler of this process"""
+
+    def __init__(self, count, info_dir=FLEET_DIR, gpio_backend='sim'):
+        self.info_dir = info_dir
+        self.gpio_backend = gpio_backend
+        self.chairs = [chair.Chair(os.path.join(info_dir, f'chair_{index}.json'), name=str(index))
+                       for index in range(count)]
+        self.ready_seconds = None
+        self.control_loop = None
+
+    def start(self):
+        """Set up every chair and start its listener"""
+        os.makedirs(self.info_dir, exist_ok=True)
+        chair.publisher.max_pending = max(MAX_PENDING_PATHS, len(self.chairs) * PATHS_PER_CHAIR)
+
+        started = time.perf_counter()
+        # Startup is mostly waiting on round trips, so chairs start side by side
+        with ThreadPoolExecutor(STARTUP_CONCURRENCY) as pool:
+            list(pool.map(self._start_chair, self.chairs))
+        self.ready_seconds = round(time.perf_counter() - started, 4)
+        log.info("Fleet of %s chairs ready in %.3fs", len(self.chairs), self.ready_seconds)
+        if CONTROL_RATE > 0:
+            self.control_loop = ControlLoop(self._step_ramps, CONTROL_RATE, halt=self._halt_ramps)
+            self.control_loop.start()
+
+    def _start_chair(self, member):
+        member.init_motors(self.gpio_backend)
+        member.setup_chair()
+        member.listen_for_commands()
+
+    def _step_ramps(self, seconds):
+        for member in self.chairs:
+            if member.ramp is not None:
+                member.ramp.step(seconds)
+
+    def _halt_ramps(self):
+        for member in self.chairs:
+            if member.ramp is not None:
+                member.ramp.halt()
+
+    def close(self):
+        """Stop every chair, before the shared scheduler is closed"""
+        if self.control_loop is not None:
+            self.control_loop.close()
+        for member in self.chairs:
+            member.close()
+
+    def stats(self):
+        """Fleet-wide counters"""
+        moving = sum(1 for member in self.chairs
+                     if member.current_movement_state.direction != 'stop')
+        calls_made = sum(member.motors.stats()['calls_made'] for member in self.chairs if member.motors)
+        return {
+            'chairs': len(self.chairs),
+            'moving': moving,
+            'ready_seconds': self.ready_seconds,
+            'pwm_calls_made': calls_made,
+            'control_loop': self.control_loop.stats() if self.control_loop is not None else None
+        }
+
+
+def random_command(rng):
+    """A plausible command from the app"""
+    command = rng.choice(DRIVE_COMMANDS)
+    if command == 'joystick':
+        return command, {'x': rng.randint(-100, 100), 'y': rng.randint(-100, 100)}
+    if command == 'direction':
+        return command, rng.choice(list(DIRECTION_COORDS))
+    if command == 'speed':
+        return command, rng.randint(chair.MIN_SPEED, chair.MAX_SPEED)
+    return command, None
+
+
+def drive(fleet, rate, stop_event, seed=1):
+    """Push random commands to every chair, rate commands per chair per second"""
+    rng = random.Random(seed)
+    refs = [member.commands_ref for member in fleet.chairs]
+    interval = 1.0 / (rate * len(refs))
+    next_send = time.monotonic()
+    # Each push waits a round trip, so pushes are sent side by side like many apps would
+    with ThreadPoolExecutor(DRIVE_CONCURRENCY) as pool:
+        while not stop_event.is_set():
+            command, value = random_command(rng)
+            data = {'command': command, 'timestamp': {'.sv': 'timestamp'}}
+            if value is not None:
+                data['value'] = value
+            pool.submit(rng.choice(refs).push, data)
+
+            next_send += interval
+            delay = next_send - time.monotonic()
+            if delay > 0:
+                stop_event.wait(delay)
+
+
+def report(fleet):
+    """One JSON status line for the whole fleet"""
+    status = fleet.stats()
+    status['scheduler'] = chair.scheduler.stats()
+    status['publisher'] = chair.publisher.stats()
+    status['command_age'] = chair.command_age.summary()
+    print(json.dumps(status), flush=True)
+
+
+def main():
+    """Run a fleet of simulated chairs"""
+    parser = argparse.ArgumentParser(description='Run many simulated chairs in one process')
+    parser.add_argument('--chairs', type=int, default=10)
+    parser.add_argument('--datastore', default=None, help='firebase or memory (default: CHAIR_DATASTORE)')
+    parser.add_argument('--latency', type=float, default=0.05, help='memory datastore latency (s)')
+    parser.add_argument('--jitter', type=float, default=0.02, help='memory datastore jitter (s)')
+    parser.add_argument('--info-dir', default=None, help='directory for the chair info files')
+    parser.add_argument('--drive', type=float, default=0, help='random commands per chair per second')
+    parser.add_argument('--duration', type=float, default=0, help='seconds to run (0 = until Ctrl+C)')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    logs = setup_logging(level=args.log_level)
+    options = {}
+    if (args.datastore or chair.DATASTORE) == 'memory':
+        options = {'latency': args.latency, 'jitter': args.jitter}
+    info_dir = args.info_dir
+    if info_dir is None:
+        # Memory chairs are gone after the run, so are their info files
+        info_dir = tempfile.mkdtemp(prefix='chair-fleet-') if options else FLEET_DIR
+
+    chair.kinematics.load()
+    chair.init_datastore(args.datastore, **options)
+    chair.publisher.start()
+    fleet = Fleet(args.chairs, info_dir)
+    stop_event = threading.Event()
+    try:
+        fleet.start()
+        report(fleet)
+        if args.drive > 0:
+            threading.Thread(target=drive, args=(fleet, args.drive, stop_event),
+                             name='fleet-driver', daemon=True).start()
+
+        deadline = time.monotonic() + args.duration if args.duration else None
+        while deadline is None or time.monotonic() < deadline:
+            time.sleep(REPORT_INTERVAL if deadline is None
+                       else max(0, min(REPORT_INTERVAL, deadline - time.monotonic())))
+            report(fleet)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_event.set()
+        fleet.close()
+        chair.scheduler.close()
+        chair.publisher.close()
+        chair.store.close()
+        logs.close()
+
+
+if __name__ == "__main__":
+    main()
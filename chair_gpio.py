@@ -0,0 +1,284 @@
+"""
+GPIO backends for the smart chair.
+The motor code only needs digital outputs and PWM channels, so it can run
+on the Raspberry Pi through RPi.GPIO, with hardware PWM channels through the
+kernel's sysfs PWM interface, or in-process on any machine through a
+simulated backend that records every duty cycle change.
+"""
+import os
+import threading
+import time
+from collections import deque
+
+# Backend used when none is given: 'rpi' on the chair, 'sim' for testing
+GPIO_BACKEND = os.environ.get('CHAIR_GPIO_BACKEND', 'rpi')
+
+# Duty cycle changes kept per pin by the simulated backend
+SIM_TIMELINE_LENGTH = 100000
+
+# Where the kernel exposes PWM chips (pwmchipN/pwmM/{period,duty_cycle,enable})
+SYSFS_PWM_ROOT = os.environ.get('CHAIR_PWM_ROOT', '/sys/class/pwm')
+
+# Hardware PWM channel of each motor pin for the sysfs backend, as
+# "pin=chip:channel,..." e.g. "17=0:0,27=0:1,5=0:2,6=0:3" for the first four
+# outputs of a PCA9685 board (dtoverlay=i2c-pwm-pca9685a). The Pi itself
+# only has two hardware PWM channels (GPIO 12/18 and 13/19), one short of
+# the four BTS7960 inputs.
+PWM_CHANNELS = os.environ.get('CHAIR_PWM_CHANNELS', '')
+
+# Backend for the digital outputs (enable pins) when PWM goes through sysfs
+SYSFS_OUTPUT_BACKEND = os.environ.get('CHAIR_SYSFS_OUTPUTS', 'rpi')
+
+# How long to wait for the kernel to create an exported PWM channel
+PWM_EXPORT_TIMEOUT = 1.0  # 1 second
+
+
+class RPiGPIOBackend:
+    """Outputs and software PWM through RPi.GPIO"""
+
+    name = 'rpi'
+
+    def __init__(self):
+        import RPi.GPIO as GPIO  # Only available on the Raspberry Pi
+        self._gpio = GPIO
+        GPIO.setmode(GPIO.BCM)
+
+    def setup_outputs(self, pins):
+        """Configure pins as outputs"""
+        self._gpio.setup(pins, self._gpio.OUT)
+
+    def output(self, pin, high):
+        """Drive a digital output high or low"""
+        self._gpio.output(pin, self._gpio.HIGH if high else self._gpio.LOW)
+
+    def pwm(self, pin, frequency):
+        """Create a PWM channel with start/ChangeDutyCycle/stop"""
+        return self._gpio.PWM(pin, frequency)
+
+    def cleanup(self):
+        """Release all pins"""
+        self._gpio.cleanup()
+
+
+class SimulatedPWM:
+    """PWM channel that records its duty cycle timeline instead of driving a pin"""
+
+    def __init__(self, backend, pin, frequency):
+        self._backend = backend
+        self.pin = pin
+        self.frequency = frequency
+        self.duty = 0
+        self.running = False
+
+    def start(self, duty):
+        self.running = True
+        self.ChangeDutyCycle(duty)
+
+    def ChangeDutyCycle(self, duty):
+        self.duty = duty
+        self._backend._record(self.pin, duty)
+
+    def stop(self):
+        self.running = False
+        self.ChangeDutyCycle(0)
+
+
+class SimulatedGPIOBackend:
+    """In-process GPIO that keeps pin levels and duty cycle timelines in memory"""
+
+    name = 'sim'
+
+    def __init__(self, timeline_length=SIM_TIMELINE_LENGTH):
+        self._lock = threading.Lock()
+        self._timeline_length = timeline_length
+        self.levels = {}
+        self.channels = {}
+        self.timelines = {}  # pin -> deque of (monotonic time, duty)
+        self.duty_changes = 0
+
+    def setup_outputs(self, pins):
+        """Configure pins as outputs"""
+        for pin in pins:
+            self.levels.setdefault(pin, False)
+
+    def output(self, pin, high):
+        """Drive a digital output high or low"""
+        self.levels[pin] = bool(high)
+
+    def pwm(self, pin, frequency):
+        """Create a simulated PWM channel"""
+        channel = SimulatedPWM(self, pin, frequency)
+        self.channels[pin] = channel
+        return channel
+
+    def cleanup(self):
+        """Stop all PWM channels"""
+        for channel in self.channels.values():
+            if channel.running:
+                channel.stop()
+
+    def timeline(self, pin):
+        """Return the recorded (time, duty) changes of a pin"""
+        with self._lock:
+            return list(self.timelines.get(pin, ()))
+
+    def _record(self, pin, duty):
+        with self._lock:
+            timeline = self.timelines.get(pin)
+            if timeline is None:
+                timeline = self.timelines[pin] = deque(maxlen=self._timeline_length)
+            timeline.append((time.monotonic(), duty))
+            self.duty_changes += 1
+
+
+def parse_pwm_channels(spec):
+    """Parse "pin=chip:channel,..." into {pin: (chip, channel)}"""
+    channels = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        try:
+            pin, target = item.split('=')
+            chip, channel = target.split(':')
+            channels[int(pin)] = (int(chip), int(channel))
+        except ValueError:
+            raise ValueError(f"Bad PWM channel {item!r}, expected pin=chip:channel") from None
+    return channels
+
+
+def read_attribute(path, name):
+    """Read a sysfs attribute as a string"""
+    with open(os.path.join(path, name)) as f:
+        return f.read().split()[0]
+
+
+def write_attribute(path, name, value):
+    """Write a sysfs attribute"""
+    with open(os.path.join(path, name), 'w') as f:
+        f.write(f'{value}\n')
+
+
+class SysfsPWM:
+    """Hardware PWM channel driven through pwmchipN/pwmM in sysfs"""
+
+    def __init__(self, path, frequency):
+        self.path = path
+        self.frequency = frequency
+        self.period_ns = int(round(1e9 / frequency))
+        self.duty = 0
+        self.running = False
+        self._duty_fd = None
+
+    def start(self, duty):
+        # duty_cycle may never exceed the period, so it is cleared before the period changes
+        write_attribute(self.path, 'duty_cycle', 0)
+        write_attribute(self.path, 'period', self.period_ns)
+        # Kept open, so a duty change is a single pwrite
+        self._duty_fd = os.open(os.path.join(self.path, 'duty_cycle'), os.O_WRONLY)
+        self.ChangeDutyCycle(duty)
+        write_attribute(self.path, 'enable', 1)
+        self.running = True
+
+    def ChangeDutyCycle(self, duty):
+        duty = max(0, min(100, duty))
+        # The kernel takes one value per write at offset 0, a trailing newline is allowed
+        os.pwrite(self._duty_fd, b'%d\n' % (self.period_ns * duty // 100), 0)
+        self.duty = duty
+
+    def stop(self):
+        self.ChangeDutyCycle(0)
+        write_attribute(self.path, 'enable', 0)
+        self.running = False
+
+    def close(self):
+        if self._duty_fd is not None:
+            os.close(self._duty_fd)
+            self._duty_fd = None
+
+
+class SysfsPWMBackend:
+    """Hardware PWM through the kernel's sysfs PWM interface, outputs through another backend"""
+
+    name = 'sysfs'
+
+    def __init__(self, root=SYSFS_PWM_ROOT, channels=None, outputs=None):
+        # channels maps pins to (chip, channel), outputs is the backend that
+        # drives the digital outputs; both default to their CHAIR_* settings
+        self.root = root
+        self._channels = parse_pwm_channels(PWM_CHANNELS) if channels is None else channels
+        self._outputs = outputs if outputs is not None else create_backend(SYSFS_OUTPUT_BACKEND)
+        self.channels = {}
+
+    def setup_outputs(self, pins):
+        """Configure pins as outputs"""
+        self._outputs.setup_outputs(pins)
+
+    def output(self, pin, high):
+        """Drive a digital output high or low"""
+        self._outputs.output(pin, high)
+
+    def pwm(self, pin, frequency):
+        """Export the hardware channel mapped to a pin"""
+        if pin not in self._channels:
+            raise ValueError(f"No hardware PWM channel for pin {pin}, set CHAIR_PWM_CHANNELS")
+        chip, channel = self._channels[pin]
+        pwm = SysfsPWM(self._export(chip, channel), frequency)
+        self.channels[pin] = pwm
+        return pwm
+
+    def cleanup(self):
+        """Stop and unexport every channel, then release the outputs"""
+        for pin, pwm in self.channels.items():
+            if pwm.running:
+                pwm.stop()
+            pwm.close()
+            chip, channel = self._channels[pin]
+            try:
+                write_attribute(os.path.join(self.root, f'pwmchip{chip}'), 'unexport', channel)
+            except OSError:
+                pass  # Already gone
+        self.channels.clear()
+        self._outputs.cleanup()
+
+    def _export(self, chip, channel):
+        """Export a channel unless it already is, and return its directory"""
+        chip_path = os.path.join(self.root, f'pwmchip{chip}')
+        path = os.path.join(chip_path, f'pwm{channel}')
+        if os.path.isdir(path):
+            return path
+        write_attribute(chip_path, 'export', channel)
+        # udev creates the directory and fixes its permissions shortly after
+        deadline = time.monotonic() + PWM_EXPORT_TIMEOUT
+        while not os.access(os.path.join(path, 'duty_cycle'), os.W_OK):
+            if time.monotonic() > deadline:
+                raise OSError(f"PWM channel {path} did not appear after export")
+            time.sleep(0.01)
+        return path
+
+
+def create_fake_sysfs_pwm(root, chips=(16,)):
+    """Lay out a directory tree like /sys/class/pwm with exported channels, for testing"""
+    for chip, count in enumerate(chips):
+        chip_path = os.path.join(root, f'pwmchip{chip}')
+        os.makedirs(chip_path, exist_ok=True)
+        for name, value in (('npwm', count), ('export', ''), ('unexport', '')):
+            write_attribute(chip_path, name, value)
+        for channel in range(count):
+            path = os.path.join(chip_path, f'pwm{channel}')
+            os.makedirs(path, exist_ok=True)
+            for name, value in (('period', 0), ('duty_cycle', 0), ('enable', 0), ('polarity', 'normal')):
+                write_attribute(path, name, value)
+    return root
+
+
+BACKENDS = {
+    'rpi': RPiGPIOBackend,
+    'sysfs': SysfsPWMBackend,
+    'sim': SimulatedGPIOBackend
+}
+
+
+def create_backend(name=None):
+    """Create the GPIO backend selected by name or CHAIR_GPIO_BACKEND"""
+    name = name or GPIO_BACKEND
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown GPIO backend: {name} (expected one of {', '.join(BACKENDS)})")
+    return BACKENDS[name]()
@@ -0,0 +1,261 @@
+"""
+Differential-drive kinematics for the smart chair.
+Maps joystick coordinates and the speed setting to left/right motor duty
+cycles through a lookup table that is precomputed once at startup, so a
+joystick event costs a few array reads. Direction commands keep their own
+tuned duties.
+"""
+import logging
+import math
+import os
+from array import array
+
+log = logging.getLogger('chair.kinematics')
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional, without it the mix is computed per event
+    np = None
+
+# Joystick values below this on both axes count as centered
+DEADZONE = 5
+
+# Joystick grid resolution of the lookup table (must divide 100), 1 gives
+# every integer position its own cell so lookups match mix_joystick
+JOYSTICK_STEP = 1
+
+# Where the precomputed table is cached between runs
+KINEMATICS_CACHE = 'kinematics_table.npz'
+
+# Bump when the mixing changes so stale caches are rebuilt
+TABLE_VERSION = 2
+
+# Direction names, the table stores their index
+DIRECTIONS = (
+    'stop', 'forward', 'backward', 'left', 'right',
+    'forward-left', 'forward-right', 'backward-left', 'backward-right'
+)
+
+# Joystick coordinates for each direction command (x, y in -100 to 100)
+DIRECTION_COORDS = {
+    'forward': (0, 100),
+    'backward': (0, -100),
+    'left': (-100, 0),
+    'right': (100, 0),
+    'forward-left': (-70, 70),     # Diagonal forward-left
+    'forward-right': (70, 70),     # Diagonal forward-right
+    'backward-left': (-70, -70),   # Diagonal backward-left
+    'backward-right': (70, -70),   # Diagonal backward-right
+    'stop': (0, 0)
+}
+
+# Signed left/right duty of each direction command as a fraction of the
+# speed setting, as tuned on the chair: turns slow the inner wheel to half,
+# diagonals to 30%
+DIRECTION_DUTIES = {
+    'forward': (1.0, 1.0),
+    'backward': (-1.0, -1.0),
+    'left': (1.0, 0.5),
+    'right': (0.5, 1.0),
+    'forward-left': (1.0, 0.3),
+    'forward-right': (0.3, 1.0),
+    'backward-left': (-1.0, -0.3),
+    'backward-right': (-0.3, -1.0),
+    'stop': (0.0, 0.0)
+}
+
+
+def direction_duties(direction, speed):
+    """Signed left and right duties of a direction command"""
+    left, right = DIRECTION_DUTIES[direction]
+    return left * speed, right * speed
+
+
+def joystick_direction(x, y):
+    """Name the direction of a joystick position outside the deadzone"""
+    if x < 0:
+        return 'forward-left' if y > 0 else 'backward-left' if y < 0 else 'left'
+    if x > 0:
+        return 'forward-right' if y > 0 else 'backward-right' if y < 0 else 'right'
+    return 'forward' if y > 0 else 'backward' if y < 0 else 'stop'
+
+
+def mix_joystick(x, y, speed, min_speed, deadzone=DEADZONE):
+    """
+    Compute the wheel duties for a joystick position.
+    Returns (left, right, direction, angle, magnitude); duties are signed,
+    negative meaning the wheel turns backward.
+    """
+    x = max(-100, min(100, x))
+    y = max(-100, min(100, y))
+    if abs(x) < deadzone and abs(y) < deadzone:
+        return 0, 0, 'stop', 0, 0
+
+    angle = math.degrees(math.atan2(y, x))
+    if angle < 0:
+        angle += 360  # Convert to 0-360 range
+    magnitude = min(100, math.sqrt(x*x + y*y))  # 0-100
+
+    # Scale magnitude to speed range
+    motor_speed = speed * magnitude / 100.0
+    if motor_speed < min_speed and magnitude > 0:
+        motor_speed = min_speed  # Ensure we meet minimum speed if joystick is moved
+
+    # Slow down the wheel on the side we are turning towards
+    left_speed = motor_speed
+    right_speed = motor_speed
+    if x < 0:
+        left_speed = motor_speed * (1 - abs(x) / 100.0)
+    elif x > 0:
+        right_speed = motor_speed * (1 - x / 100.0)
+
+    if y < 0:
+        left_speed, right_speed = -left_speed, -right_speed
+    return left_speed, right_speed, joystick_direction(x, y), angle, magnitude
+
+
+class KinematicsTable:
+    """Quantized (x, y, speed) -> (left duty, right duty, direction) lookup table"""
+
+    def __init__(self, min_speed, max_speed, step=JOYSTICK_STEP, deadzone=DEADZONE,
+                 cache_path=KINEMATICS_CACHE, preload=True):
+        if 100 % step:
+            raise ValueError(f"Joystick step must divide 100, got {step}")
+        self.min_speed = min_speed
+        self.max_speed = max_speed
+        self.step = step
+        self.deadzone = deadzone
+        self._half = 100 // step
+        self._size = 2 * self._half + 1
+        self._speeds = max_speed - min_speed + 1
+
+        # Duties in hundredths as int16, left/right interleaved, indexed by
+        # ((xi * size + yi) * speeds + si) * 2
+        self._duties = None
+        # Per grid cell: (direction, angle, magnitude, offset of its duties)
+        self._cells = None
+
+        # Joystick values on the grid and exact speeds map straight to table
+        # offsets, anything else (between grid points, out of range) is rounded
+        axis = range(-100, 101, step)
+        self._x_offset = {v: self._grid_index(v) * self._size for v in axis}
+        self._y_offset = {v: self._grid_index(v) for v in axis}
+        self._speed_offset = {v: (v - min_speed) * 2 for v in range(min_speed, max_speed + 1)}
+
+        self._cache_path = cache_path
+        if preload:
+            self.load()
+
+    def load(self):
+        """Load the table from the cache or build it, lookups compute the mix until then"""
+        if np is None or self._cells is not None:
+            return
+        if not (self._cache_path and self._load(self._cache_path)):
+            self._build()
+            if self._cache_path:
+                self._save(self._cache_path)
+
+    def _params(self):
+        """Parameters a cached table has to match"""
+        return [TABLE_VERSION, self.min_speed, self.max_speed, self.step, self.deadzone]
+
+    def _build(self):
+        """Vectorize mix_joystick over the whole (x, y, speed) grid"""
+        axis = np.arange(-100, 101, self.step, dtype=np.float64)
+        X, Y = np.meshgrid(axis, axis, indexing='ij')
+
+        angle = np.degrees(np.arctan2(Y, X))
+        angle = np.where(angle < 0, angle + 360, angle)
+        magnitude = np.minimum(100, np.sqrt(X*X + Y*Y))
+        centered = (np.abs(X) < self.deadzone) & (np.abs(Y) < self.deadzone)
+        angle[centered] = 0
+        magnitude[centered] = 0
+
+        # One speed at a time keeps the float intermediates to a single plane
+        duties = np.empty(X.shape + (self._speeds, 2), dtype=np.int16)
+        turn = 1 - np.abs(X) / 100.0
+        sign = np.where(centered, 0.0, np.where(Y < 0, -1.0, 1.0))
+        for si, speed in enumerate(range(self.min_speed, self.max_speed + 1)):
+            motor = speed * magnitude / 100.0
+            motor = np.where((motor < self.min_speed) & (magnitude > 0), self.min_speed, motor)
+            left = np.where(X < 0, motor * turn, motor) * sign
+            right = np.where(X > 0, motor * turn, motor) * sign
+            duties[:, :, si, 0] = np.rint(left * 100)
+            duties[:, :, si, 1] = np.rint(right * 100)
+
+        direction = np.zeros(X.shape, dtype=np.uint8)
+        for index, name in enumerate(DIRECTIONS[1:], start=1):
+            x, y = DIRECTION_COORDS[name]
+            match = (np.sign(X) == np.sign(x)) & (np.sign(Y) == np.sign(y)) & ~centered
+            direction[match] = index
+
+        self._store(duties, direction, angle, magnitude)
+
+    def _grid_index(self, value):
+        """
+        Grid index of an axis value, rounded away from zero so a position off
+        center never lands in the deadzone or on the other side of an axis
+        """
+        value = max(-100, min(100, value))
+        cells = math.ceil(abs(value) / self.step)
+        return self._half + (cells if value > 0 else -cells)
+
+    def _store(self, duties, direction, angle, magnitude):
+        """Unpack the tables into flat arrays and tuples, which index fastest from Python"""
+        self._duties = array('h', duties.astype(np.int16).ravel().tobytes())
+        stride = self._speeds * 2
+        self._cells = [
+            (DIRECTIONS[code], float(cell_angle), float(cell_magnitude), cell * stride)
+            for cell, (code, cell_angle, cell_magnitude) in enumerate(
+                zip(direction.ravel().tolist(), angle.ravel().tolist(), magnitude.ravel().tolist()))
+        ]
+
+    def _load(self, path):
+        """Load a cached table built with the same parameters"""
+        try:
+            with np.load(path) as cached:
+                if list(cached['params']) != self._params():
+                    return False
+                self._store(cached['duties'], cached['direction'],
+                            cached['angle'], cached['magnitude'])
+                return True
+        except (OSError, KeyError, ValueError):
+            return False
+
+    def _save(self, path):
+        """Cache the table on disk so later starts skip the build"""
+        try:
+            tmp_path = path + '.tmp.npz'
+            np.savez(tmp_path,
+                     params=np.array(self._params()),
+                     duties=np.frombuffer(self._duties, dtype=np.int16),
+                     direction=np.array([DIRECTIONS.index(cell[0]) for cell in self._cells], dtype=np.uint8),
+                     angle=np.array([cell[1] for cell in self._cells]),
+                     magnitude=np.array([cell[2] for cell in self._cells]))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            log.warning("Could not cache kinematics table: %s", e)
+
+    def lookup(self, x, y, speed):
+        """Return (left, right, direction, angle, magnitude) for a joystick position"""
+        try:
+            direction, angle, magnitude, offset = self._cells[self._x_offset[x] + self._y_offset[y]]
+            i = offset + self._speed_offset[speed]
+        except (KeyError, TypeError):
+            return self._lookup_rounded(x, y, speed)
+        duties = self._duties
+        return duties[i] / 100, duties[i + 1] / 100, direction, angle, magnitude
+
+    def _lookup_rounded(self, x, y, speed):
+        """Lookup for values that are not exact grid keys"""
+        if self._cells is None:
+            return mix_joystick(x, y, speed, self.min_speed, self.deadzone)
+        x = max(-100, min(100, x))
+        y = max(-100, min(100, y))
+        if abs(x) < self.deadzone and abs(y) < self.deadzone:
+            return 0, 0, 'stop', 0, 0
+
+        si = max(0, min(self._speeds - 1, int(round(speed)) - self.min_speed))
+        _, angle, magnitude, offset = self._cells[self._grid_index(x) * self._size + self._grid_index(y)]
+        i = offset + si * 2
+        return self._duties[i] / 100, self._duties[i + 1] / 100, joystick_direction(x, y), angle, magnitude
@@ -0,0 +1,382 @@
+"""
+Direct LAN control channel for the smart chair.
+The app can send the same commands it writes to Firebase as UDP datagrams
+straight to the chair, skipping the cloud round trip when both are on the
+same network. Every datagram is authenticated with a truncated HMAC-SHA256:
+the handshake uses a key derived from a random pairing secret, commands use
+a per-session key, and sequence numbers reject replayed or reordered packets
+(a hello nonce opens one session only).
+The secret is kept on the chair in an owner-only file and handed to the app
+out of band, it is never written to Firebase.
+While the link is alive the chair ignores motion commands from Firebase;
+when it goes quiet the chair stops and Firebase takes over again.
+
+Datagram: 16-byte MAC followed by a UTF-8 JSON body
+    {"type": "hello", "nonce": hex}                                -> welcome
+    {"type": "command", "session": id, "seq": n, "command": ..., "value": ...} -> ack
+    {"type": "ping", "session": id, "seq": n}                      -> ack
+"""
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+from chair_log import fields
+
+log = logging.getLogger('chair.lan')
+
+# UDP port of the LAN listener (0 to disable)
+LAN_PORT = int(os.environ.get('CHAIR_LAN_PORT', '0'))
+LAN_HOST = os.environ.get('CHAIR_LAN_HOST', '0.0.0.0')
+
+# The link counts as down when no valid datagram arrived for this long,
+# clients send pings at least every LAN_PING_INTERVAL while idle
+LAN_LINK_TIMEOUT = 1.0   # 1 second
+LAN_PING_INTERVAL = 0.25
+
+# Sessions kept at once, the least recently used one is dropped beyond this
+# unless it is still in use
+MAX_SESSIONS = 4
+
+# Client nonces of recent hellos, a hello repeating one of them is a replay
+SEEN_NONCES = 256
+
+# File next to the chair info holding the pairing secret
+LAN_SECRET_FILE = 'lan_secret'
+
+MAC_SIZE = 16
+MAX_DATAGRAM = 2048
+
+
+def load_pairing_secret(path):
+    """
+    Read the pairing secret, creating a random one readable by the owner only.
+    Returns (secret, created).
+    """
+    try:
+        with open(path, 'r') as f:
+            secret = f.read().strip()
+        if secret:
+            return secret, False
+    except FileNotFoundError:
+        pass
+
+    secret = secrets.token_hex(32)
+    fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        os.fchmod(f.fileno(), 0o600)  # A leftover temporary file keeps its old mode
+        f.write(secret + '\n')
+    os.replace(path + '.tmp', path)
+    return secret, True
+
+
+def pairing_key(chair_id, secret):
+    """Handshake key shared by the chair and any app given its pairing secret"""
+    return hmac.new(bytes.fromhex(secret), chair_id.encode(), hashlib.sha256).digest()
+
+
+def session_key(key, client_nonce, server_nonce):
+    """Key for one session, derived from the pairing key and both nonces"""
+    return hmac.new(key, bytes.fromhex(client_nonce) + bytes.fromhex(server_nonce),
+                    hashlib.sha256).digest()
+
+
+def seal(key, message):
+    """Encode a message as MAC + JSON body"""
+    body = json.dumps(message, separators=(',', ':')).encode()
+    return hmac.new(key, body, hashlib.sha256).digest()[:MAC_SIZE] + body
+
+
+def unseal(key, datagram):
+    """Return the message of a datagram if its MAC matches the key, else None"""
+    mac, body = datagram[:MAC_SIZE], datagram[MAC_SIZE:]
+    if not hmac.compare_digest(mac, hmac.new(key, body, hashlib.sha256).digest()[:MAC_SIZE]):
+        return None
+    try:
+        message = json.loads(body)
+    except ValueError:
+        return None
+    return message if isinstance(message, dict) else None
+
+
+def peek(datagram):
+    """Read a datagram body without checking it, to find the key that checks it"""
+    try:
+        message = json.loads(datagram[MAC_SIZE:])
+    except ValueError:
+        return None
+    return message if isinstance(message, dict) else None
+
+
+def local_address():
+    """Best guess of the chair's address on the local network"""
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            probe.connect(('10.255.255.255', 1))  # Never sent, only picks a route
+            return probe.getsockname()[0]
+    except OSError:
+        return '127.0.0.1'
+
+
+class LanSession:
+    """Authenticated client of the LAN channel"""
+
+    def __init__(self, session_id, key, address):
+        self.session_id = session_id
+        self.key = key
+        self.address = address
+        self.last_seq = 0
+        self.last_valid = None   # Clock reading of its latest valid datagram
+
+
+class LanCommandServer:
+    """UDP listener that feeds authenticated commands into the chair"""
+
+    def __init__(self, key, submit, port=LAN_PORT, host=LAN_HOST,
+                 link_timeout=LAN_LINK_TIMEOUT, on_link_change=None, clock=time.monotonic):
+        # submit(command, value) queues a command, on_link_change(up) is told
+        # when the link comes up or goes quiet
+        self._key = key
+        self._submit = submit
+        self._bind = (host, port)
+        self._link_timeout = link_timeout
+        self._on_link_change = on_link_change
+        self._clock = clock
+        self._sessions = OrderedDict()
+        self._nonces = OrderedDict()
+        self._socket = None
+        self._thread = None
+        self._running = False
+        self._last_valid = None
+        self._link_up = False
+
+        # Counters for monitoring
+        self.commands_received = 0
+        self.rejected_auth = 0       # Bad MAC, unknown session or malformed datagram
+        self.rejected_sequence = 0   # Replayed or reordered datagrams, replayed hellos
+        self.rejected_busy = 0       # Hellos refused while every session was in use
+        self.firebase_ignored = 0    # Firebase commands skipped while the link was up
+        self.link_drops = 0
+
+    @property
+    def address(self):
+        """(host, port) the listener is bound to"""
+        return self._socket.getsockname() if self._socket else None
+
+    def start(self):
+        """Bind the socket and start the receive thread"""
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind(self._bind)
+        # Wake up regularly to notice when the link goes quiet
+        self._socket.settimeout(self._link_timeout / 4)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='lan', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Stop listening"""
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(self._link_timeout)
+            self._thread = None
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def active(self):
+        """Whether a client sent a valid datagram within the link timeout"""
+        last = self._last_valid
+        return last is not None and self._clock() - last < self._link_timeout
+
+    def claims(self, command, priority_commands=()):
+        """Whether a Firebase command should be skipped because the LAN link drives the chair"""
+        if command in priority_commands or not self.active():
+            return False
+        self.firebase_ignored += 1
+        return True
+
+    def stats(self):
+        """Return the LAN channel counters"""
+        return {
+            'link_up': int(self.active()),
+            'sessions': len(self._sessions),
+            'commands_received': self.commands_received,
+            'rejected_auth': self.rejected_auth,
+            'rejected_sequence': self.rejected_sequence,
+            'rejected_busy': self.rejected_busy,
+            'firebase_ignored': self.firebase_ignored,
+            'link_drops': self.link_drops
+        }
+
+    def _run(self):
+        while self._running:
+            try:
+                datagram, address = self._socket.recvfrom(MAX_DATAGRAM)
+            except socket.timeout:
+                self._check_link()
+                continue
+            except OSError:
+                if self._running:
+                    log.exception("LAN receive failed")
+                return
+
+            try:
+                reply = self._handle(datagram, address)
+            except Exception as e:
+                log.exception("LAN datagram failed: %s", e)
+                continue
+            if reply is not None:
+                try:
+                    self._socket.sendto(reply, address)
+                except OSError as e:
+                    log.warning("LAN reply to %s failed: %s", address, e)
+            self._check_link()
+
+    def _handle(self, datagram, address):
+        """Check one datagram, act on it and return the reply to send"""
+        message = peek(datagram)
+        if message is None:
+            self.rejected_auth += 1
+            return None
+
+        if message.get('type') == 'hello':
+            return self._hello(datagram, address)
+
+        session = self._sessions.get(message.get('session'))
+        if session is None or unseal(session.key, datagram) is None:
+            self.rejected_auth += 1
+            return None
+
+        seq = message.get('seq')
+        if not isinstance(seq, int) or seq <= session.last_seq:
+            self.rejected_sequence += 1
+            return None
+        session.last_seq = seq
+        session.address = address
+        self._sessions.move_to_end(session.session_id)
+        self._mark_valid()
+        session.last_valid = self._last_valid
+
+        if message.get('type') == 'command' and isinstance(message.get('command'), str):
+            self.commands_received += 1
+            self._submit(message['command'], message.get('value'))
+        return seal(session.key, {'type': 'ack', 'session': session.session_id, 'seq': seq})
+
+    def _hello(self, datagram, address):
+        """Open a session for a client that knows the pairing key"""
+        message = unseal(self._key, datagram)
+        try:
+            client_nonce = message['nonce'] if message else None
+            bytes.fromhex(client_nonce)
+        except (TypeError, ValueError):
+            client_nonce = None
+        if client_nonce is None:
+            self.rejected_auth += 1
+            return None
+
+        # A captured hello is valid forever, so each nonce opens one session only
+        if client_nonce in self._nonces:
+            self.rejected_sequence += 1
+            return None
+        self._nonces[client_nonce] = True
+        while len(self._nonces) > SEEN_NONCES:
+            self._nonces.popitem(last=False)
+
+        if len(self._sessions) >= MAX_SESSIONS:
+            # Sessions are kept in order of use, if the oldest one is still
+            # active a new client must not cut off the one driving the chair
+            oldest_id, oldest = next(iter(self._sessions.items()))
+            if oldest.last_valid is not None and self._clock() - oldest.last_valid < self._link_timeout:
+                self.rejected_busy += 1
+                return None
+            del self._sessions[oldest_id]
+
+        server_nonce = secrets.token_hex(16)
+        session_id = secrets.token_hex(8)
+        self._sessions[session_id] = LanSession(
+            session_id, session_key(self._key, client_nonce, server_nonce), address)
+        log.info("LAN session opened", extra=fields(session=session_id, client=address[0]))
+        return seal(self._key, {'type': 'welcome', 'session': session_id,
+                                'nonce': client_nonce, 'server_nonce': server_nonce})
+
+    def _mark_valid(self):
+        self._last_valid = self._clock()
+        if not self._link_up:
+            self._link_up = True
+            if self._on_link_change is not None:
+                self._on_link_change(True)
+
+    def _check_link(self):
+        if self._link_up and not self.active():
+            self._link_up = False
+            self.link_drops += 1
+            if self._on_link_change is not None:
+                self._on_link_change(False)
+
+
+class LanClient:
+    """Loopback client for testing and benchmarking the LAN channel"""
+
+    def __init__(self, key, address, timeout=1.0):
+        self._key = key
+        self._address = address
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.settimeout(timeout)
+        self._session_key = None
+        self.session_id = None
+        self.seq = 0
+
+    def connect(self):
+        """Run the handshake and open a session"""
+        nonce = secrets.token_hex(16)
+        self._socket.sendto(seal(self._key, {'type': 'hello', 'nonce': nonce}), self._address)
+        while True:
+            datagram, _ = self._socket.recvfrom(MAX_DATAGRAM)
+            reply = unseal(self._key, datagram)
+            if reply and reply.get('type') == 'welcome' and reply.get('nonce') == nonce:
+                break
+        self.session_id = reply['session']
+        self._session_key = session_key(self._key, nonce, reply['server_nonce'])
+        self.seq = 0
+        return self.session_id
+
+    def send(self, command, value=None):
+        """Send a command without waiting for the ack, returns its sequence number"""
+        message = {'type': 'command', 'command': command}
+        if value is not None:
+            message['value'] = value
+        return self._send(message)
+
+    def ping(self):
+        """Keep the link alive while no commands are being sent"""
+        return self._send({'type': 'ping'})
+
+    def request(self, command, value=None):
+        """Send a command and return the seconds until its ack arrived"""
+        start = time.perf_counter()
+        seq = self.send(command, value)
+        self.wait_ack(seq)
+        return time.perf_counter() - start
+
+    def wait_ack(self, seq):
+        """Wait for the ack of a sequence number, skipping older acks"""
+        while True:
+            datagram, _ = self._socket.recvfrom(MAX_DATAGRAM)
+            reply = unseal(self._session_key, datagram)
+            if reply and reply.get('type') == 'ack' and reply.get('seq') == seq:
+                return
+
+    def close(self):
+        self._socket.close()
+
+    def _send(self, message):
+        self.seq += 1
+        message.update(session=self.session_id, seq=self.seq)
+        self._socket.sendto(seal(self._session_key, message), self._address)
+        return self.seq
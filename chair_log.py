@@ -0,0 +1,168 @@
+"""
+Logging for the smart chair.
+Records are handed to a bounded queue and written by a background thread,
+so the listener and command threads never wait on stdout or journald.
+Per-event lines (joystick moves, repeated directions, speed drags) carry a
+sample key and are limited to one line per key per interval, while state
+transitions are always logged in full.
+"""
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+# Level and output format ('text' or 'json') of the chair log
+LOG_LEVEL = os.environ.get('CHAIR_LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.environ.get('CHAIR_LOG_FORMAT', 'text')
+
+# Records waiting for the writer thread, newer records are dropped when full
+LOG_QUEUE_SIZE = 1000
+
+# Minimum time between two sampled lines with the same key
+SAMPLE_INTERVAL = 1.0  # 1 second
+
+
+class RateLimiter:
+    """Allow at most one line per sample key per interval"""
+
+    def __init__(self, interval=SAMPLE_INTERVAL, clock=time.monotonic):
+        self.interval = interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._last = {}  # sample key -> (time of last line, lines suppressed since)
+        self.suppressed = 0
+
+    def allow(self, key):
+        """Return how many lines were skipped since the last one, or None to skip this one"""
+        now = self._clock()
+        with self._lock:
+            last, suppressed = self._last.get(key, (None, 0))
+            if last is not None and now - last < self.interval:
+                self._last[key] = (last, suppressed + 1)
+                self.suppressed += 1
+                return None
+            self._last[key] = (now, 0)
+        return suppressed
+
+
+# Shared by every sampled() call in the process
+rate_limit = RateLimiter()
+
+
+def fields(**values):
+    """Extra for a log call: structured key=value fields"""
+    return {'fields': values}
+
+
+def sampled(logger, key, message, *args, level=logging.INFO, **values):
+    """Log a per-event line at most once per key per interval, skipping the record entirely otherwise"""
+    if not logger.isEnabledFor(level):
+        return
+    suppressed = rate_limit.allow(key)
+    if suppressed is None:
+        return
+    if suppressed:
+        values['suppressed'] = suppressed
+    logger.log(level, message, *args, extra={'fields': values})
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that drops records instead of blocking when the queue is full"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Formatting happens on the writer thread, not in the caller
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class StructuredFormatter(logging.Formatter):
+    """Format records as text with key=value fields, or as one JSON object per line"""
+
+    def __init__(self, json_output=False):
+        super().__init__()
+        self._json = json_output
+
+    def format(self, record):
+        message = record.getMessage()
+        values = getattr(record, 'fields', None) or {}
+
+        if self._json:
+            entry = {
+                'time': round(record.created, 3),
+                'level': record.levelname,
+                'logger': record.name,
+                'message': message
+            }
+            entry.update(values)
+            if record.exc_info:
+                entry['exception'] = self.formatException(record.exc_info)
+            return json.dumps(entry, default=str)
+
+        line = f"{self.formatTime(record)} {record.levelname:<7} {record.name}: {message}"
+        if values:
+            line += ' ' + ' '.join(f'{key}={value}' for key, value in values.items())
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+class QueueLogging:
+    """Root logger setup: a bounded queue and a background writer thread"""
+
+    def __init__(self, level=LOG_LEVEL, stream=None, json_output=None,
+                 interval=SAMPLE_INTERVAL, queue_size=LOG_QUEUE_SIZE):
+        if json_output is None:
+            json_output = LOG_FORMAT == 'json'
+        self._level = level
+        self._queue = queue.Queue(queue_size)
+
+        output = logging.StreamHandler(stream or sys.stdout)
+        output.setFormatter(StructuredFormatter(json_output))
+        self._listener = logging.handlers.QueueListener(self._queue, output)
+        self._handler = NonBlockingQueueHandler(self._queue)
+        rate_limit.interval = interval
+
+    def start(self):
+        """Route the root logger through the queue"""
+        # Skip the caller stack walk and process lookups the formatter never uses
+        logging._srcfile = None
+        logging.logProcesses = False
+        logging.logMultiprocessing = False
+
+        root = logging.getLogger()
+        root.setLevel(self._level)
+        root.addHandler(self._handler)
+        self._listener.start()
+
+    def close(self):
+        """Write out queued records and detach from the root logger"""
+        logging.getLogger().removeHandler(self._handler)
+        self._listener.stop()
+
+    def stats(self):
+        """Return the logging counters"""
+        return {
+            'queued': self._queue.qsize(),
+            'dropped': self._handler.dropped,
+            'suppressed': rate_limit.suppressed
+        }
+
+
+def setup_logging(**options):
+    """Start queued logging for the process and return it"""
+    logs = QueueLogging(**options)
+    logs.start()
+    return logs
@@ -0,0 +1,241 @@
+"""
+Metrics for the smart chair.
+Latency histograms with HDR-style log-linear buckets (fixed memory, about
+1% precision), plus counters collected from the other components. The
+registry can be exported as Prometheus text, either to a file for the
+node_exporter textfile collector or from a small local HTTP endpoint, and
+summarized periodically into the Realtime Database.
+"""
+import logging
+import os
+import threading
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+log = logging.getLogger('chair.metrics')
+
+# Prometheus text file to rewrite every interval ('' to disable)
+METRICS_FILE = os.environ.get('CHAIR_METRICS_FILE', '')
+
+# Port of the local /metrics endpoint (0 to disable)
+METRICS_PORT = int(os.environ.get('CHAIR_METRICS_PORT', '0'))
+
+# Seconds between metrics exports and database summaries
+METRICS_INTERVAL = 10.0
+
+# Quantiles reported for every histogram
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+class LatencyHistogram:
+    """Log-linear histogram of durations, recorded in microseconds"""
+
+    def __init__(self, name, help_text='', sub_bucket_bits=7, max_seconds=60):
+        self.name = name
+        self.help_text = help_text
+        self._bits = sub_bucket_bits
+        self._half = 1 << (sub_bucket_bits - 1)
+        self._max_value = int(max_seconds * 1e6)
+        self._lock = threading.Lock()
+        self._counts = array('Q', [0]) * (self._index(self._max_value) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        """Bucket index: exact below 2^bits, then `half` sub-buckets per power of two"""
+        if value < (1 << self._bits):
+            return value
+        shift = value.bit_length() - self._bits
+        return shift * self._half + (value >> shift)
+
+    def _value(self, index):
+        """Midpoint of the values that fall into a bucket"""
+        if index < (1 << self._bits):
+            return index
+        shift = index // self._half - 1
+        sub = index - shift * self._half
+        return (sub << shift) + (1 << shift) // 2
+
+    def record(self, seconds):
+        """Record one duration in seconds"""
+        value = min(max(int(seconds * 1e6), 0), self._max_value)
+        with self._lock:
+            self._counts[self._index(value)] += 1
+            self.count += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def percentile(self, quantile):
+        """Value in seconds below which the given fraction of samples fall"""
+        with self._lock:
+            if not self.count:
+                return 0.0
+            target = max(1, int(round(quantile * self.count)))
+            seen = 0
+            for index, count in enumerate(self._counts):
+                if count:
+                    seen += count
+                    if seen >= target:
+                        return min(self._value(index), self.max) / 1e6
+            return self.max / 1e6
+
+    def reset(self):
+        """Clear all samples"""
+        with self._lock:
+            for index in range(len(self._counts)):
+                self._counts[index] = 0
+            self.count = 0
+            self.total = 0
+            self.min = None
+            self.max = None
+
+    def summary(self):
+        """Return count, mean, max and quantiles in milliseconds"""
+        summary = {
+            'count': self.count,
+            'mean_ms': round(self.total / self.count / 1000, 3) if self.count else 0,
+            'max_ms': round((self.max or 0) / 1000, 3)
+        }
+        for quantile in QUANTILES:
+            label = f'p{quantile * 100:g}'.replace('.', '_')
+            summary[f'{label}_ms'] = round(self.percentile(quantile) * 1000, 3)
+        return summary
+
+
+class MetricsRegistry:
+    """Named histograms and counter sources exported together"""
+
+    def __init__(self, prefix='chair'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._sources = {}
+
+    def histogram(self, name, help_text=''):
+        """Get or create a latency histogram"""
+        with self._lock:
+            if name not in self._histograms:
+                self._histograms[name] = LatencyHistogram(name, help_text)
+            return self._histograms[name]
+
+    def register_stats(self, name, stats):
+        """Export the numeric values of a stats() callable as gauges"""
+        with self._lock:
+            self._sources[name] = stats
+
+    def values(self):
+        """Collect current values from every registered stats source"""
+        with self._lock:
+            sources = list(self._sources.items())
+        values = {}
+        for name, stats in sources:
+            try:
+                for key, value in stats().items():
+                    if isinstance(value, (int, float)) and not isinstance(value, bool):
+                        values[f'{name}_{key}'] = value
+            except Exception as e:
+                log.warning("Could not collect %s metrics: %s", name, e)
+        return values
+
+    def summary(self):
+        """Compact summary of every histogram and counter"""
+        with self._lock:
+            histograms = list(self._histograms.values())
+        summary = {histogram.name: histogram.summary() for histogram in histograms}
+        summary['counters'] = self.values()
+        return summary
+
+    def prometheus_text(self):
+        """Render all metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            histograms = list(self._histograms.values())
+        for histogram in histograms:
+            metric = f'{self.prefix}_{histogram.name}_seconds'
+            lines.append(f'# HELP {metric} {histogram.help_text or histogram.name}')
+            lines.append(f'# TYPE {metric} summary')
+            for quantile in QUANTILES:
+                lines.append(f'{metric}{{quantile="{quantile}"}} {histogram.percentile(quantile):.6f}')
+            lines.append(f'{metric}_sum {histogram.total / 1e6:.6f}')
+            lines.append(f'{metric}_count {histogram.count}')
+        for key, value in sorted(self.values().items()):
+            metric = f'{self.prefix}_{key}'
+            lines.append(f'# TYPE {metric} gauge')
+            lines.append(f'{metric} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        """Atomically rewrite a Prometheus text file"""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, path)
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serve /metrics over HTTP from a background thread"""
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip('/') not in ('', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Keep scrapes out of the chair log
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+        return server
+
+
+class MetricsReporter:
+    """Periodically export the registry to a file and a summary callback"""
+
+    def __init__(self, registry, publish=None, path=METRICS_FILE, interval=METRICS_INTERVAL):
+        # publish(summary) receives the registry summary every interval
+        self._registry = registry
+        self._publish = publish
+        self._path = path
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the reporting thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='metrics', daemon=True)
+            self._thread.start()
+
+    def close(self):
+        """Stop reporting after one last export"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self._interval)
+            self._thread = None
+
+    def report(self):
+        """Export the registry once"""
+        if self._path:
+            try:
+                self._registry.write_textfile(self._path)
+            except OSError as e:
+                log.warning("Could not write metrics file: %s", e)
+        if self._publish is not None:
+            self._publish(self._registry.summary())
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self.report()
+        self.report()
@@ -0,0 +1,66 @@
+"""
+Motor driver layer for the smart chair.
+Wraps the four BTS7960 PWM inputs and only writes duty cycles that
+actually changed, since every ChangeDutyCycle call is expensive.
+"""
+import threading
+
+# PWM channel names: <motor>_<input>, L/R motor and RPWM/LPWM input
+CHANNELS = ('L_R', 'L_L', 'R_R', 'R_L')
+
+
+class MotorDriver:
+    """Four-channel PWM driver that caches the last duty per channel"""
+
+    def __init__(self, channels):
+        # channels maps each name in CHANNELS to an object with ChangeDutyCycle()
+        self._channels = channels
+        self._lock = threading.Lock()
+        self._duties = {name: 0 for name in CHANNELS}  # PWM is started at 0
+
+        # Counters for monitoring
+        self.calls_made = 0
+        self.calls_skipped = 0
+
+    def set_duties(self, **duties):
+        """Set several channel duties in one batch, skipping unchanged ones"""
+        with self._lock:
+            changed = []
+            for name, duty in duties.items():
+                if self._duties[name] == duty:
+                    self.calls_skipped += 1
+                else:
+                    changed.append((name, duty))
+
+            # Lower channels before raising others, so on a direction change
+            # both inputs of a motor are never driven at the same time
+            changed.sort(key=lambda item: item[1] > self._duties[item[0]])
+            for name, duty in changed:
+                self._channels[name].ChangeDutyCycle(duty)
+                self._duties[name] = duty
+                self.calls_made += 1
+
+    def drive(self, left, right):
+        """Apply signed wheel duties (negative = backward)"""
+        self.set_duties(
+            L_R=-left if left < 0 else 0,
+            L_L=left if left > 0 else 0,
+            R_R=right if right > 0 else 0,
+            R_L=-right if right < 0 else 0
+        )
+
+    def stop(self):
+        """Set every channel to 0"""
+        self.set_duties(L_R=0, L_L=0, R_R=0, R_L=0)
+
+    def duties(self):
+        """Return the last duty written to each channel"""
+        with self._lock:
+            return dict(self._duties)
+
+    def stats(self):
+        """Return the driver counters"""
+        return {
+            'calls_made': self.calls_made,
+            'calls_skipped': self.calls_skipped
+        }
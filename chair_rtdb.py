@@ -0,0 +1,799 @@
+"""
+Realtime Database client for the asyncio runtime of the smart chair.
+With CHAIR_RUNTIME=asyncio main() runs an event loop instead of parking while
+firebase_admin's threads do the work: commands arrive over the database's
+server-sent events stream, and reads and writes share a pool of keep-alive
+HTTP/1.1 connections, so many writes can be in flight at once.
+
+AsyncDatastore puts the reference API of chair_datastore on top of the client
+for the chair code that calls it from other threads. RealtimeServer serves a
+MemoryDatastore over the same REST and streaming API, so the runtime can be
+tested and benchmarked without network access.
+"""
+import asyncio
+import calendar
+import json
+import logging
+import os
+import random
+import ssl
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, quote, unquote, urlencode, urlsplit
+
+from chair_datastore import Event
+
+log = logging.getLogger('chair.rtdb')
+
+# Runtime of main(): 'blocking' (firebase_admin threads) or 'asyncio' (this client)
+RUNTIME = os.environ.get('CHAIR_RUNTIME', 'blocking')
+
+# Keep-alive connections per database
+POOL_SIZE = int(os.environ.get('CHAIR_HTTP_POOL', '8'))
+
+# Idle connections older than this are closed instead of reused, before the server drops them
+IDLE_TIMEOUT = 30.0  # 30 seconds
+
+# Longest wait for a response
+REQUEST_TIMEOUT = 10.0  # 10 seconds
+
+# Attempts after the first for a request that failed in a way worth repeating,
+# with exponential backoff between them
+REQUEST_RETRIES = int(os.environ.get('CHAIR_HTTP_RETRIES', '3'))
+RETRY_DELAY = 0.1       # 100ms
+MAX_RETRY_DELAY = 2.0   # 2 seconds
+
+# Responses that mean the request was not applied and may be sent again
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+# Delay before reconnecting a dropped stream, doubled up to the maximum while it keeps failing
+STREAM_RETRY_DELAY = 1.0        # 1 second
+STREAM_MAX_RETRY_DELAY = 30.0   # 30 seconds
+
+# Redirects followed when the database moves a stream to another host
+MAX_REDIRECTS = 5
+
+# Access tokens are refreshed this long before they expire
+TOKEN_REFRESH_MARGIN = 300  # 5 minutes
+
+# Largest response header or chunk size line
+MAX_LINE = 1 << 16
+
+# Requests a RealtimeServer handles at once
+SERVER_WORKERS = 64
+
+
+class HttpError(Exception):
+    """Error response from the database"""
+
+    def __init__(self, status, message):
+        super().__init__(f"HTTP {status}: {message}")
+        self.status = status
+
+
+class HttpConnection:
+    """One keep-alive HTTP/1.1 connection"""
+
+    def __init__(self, reader, writer, host):
+        self.reader = reader
+        self.writer = writer
+        self.host = host
+        self.reusable = True
+        self.last_used = time.monotonic()
+
+    @classmethod
+    async def open(cls, host, port, ssl_context=None):
+        reader, writer = await asyncio.open_connection(
+            host, port, ssl=ssl_context, server_hostname=host if ssl_context else None)
+        return cls(reader, writer, host)
+
+    async def send(self, method, target, body=None, headers=()):
+        """Write a request, body is JSON bytes"""
+        lines = [f'{method} {target} HTTP/1.1', f'Host: {self.host}']
+        lines.extend(f'{name}: {value}' for name, value in headers)
+        if body is not None:
+            lines.append('Content-Type: application/json')
+            lines.append(f'Content-Length: {len(body)}')
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + (body or b''))
+        await self.writer.drain()
+
+    async def read_head(self):
+        """Read the status line and headers, header names in lower case"""
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("Connection closed before a response")
+        parts = status_line.decode('latin-1').split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+            raise ConnectionError(f"Bad status line {status_line!r}")
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n'):
+                break
+            if not line:
+                raise ConnectionError("Connection closed in the response headers")
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if headers.get('connection', '').lower() == 'close' or parts[0] == 'HTTP/1.0':
+            self.reusable = False
+        return int(parts[1]), headers
+
+    async def chunks(self, headers):
+        """Yield the response body as it arrives"""
+        reader = self.reader
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size_line = await reader.readline()
+                if not size_line or len(size_line) > MAX_LINE:
+                    raise ConnectionError("Bad chunk size line")
+                size = int(size_line.split(b';', 1)[0].strip(), 16)
+                if size == 0:
+                    # Trailers end with an empty line
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    return
+                chunk = await reader.readexactly(size + 2)
+                yield chunk[:-2]
+        elif 'content-length' in headers:
+            remaining = int(headers['content-length'])
+            while remaining > 0:
+                chunk = await reader.read(min(remaining, 1 << 16))
+                if not chunk:
+                    raise ConnectionError("Connection closed in the response body")
+                remaining -= len(chunk)
+                yield chunk
+        else:
+            # Delimited by the server closing the connection
+            self.reusable = False
+            while True:
+                chunk = await reader.read(1 << 16)
+                if not chunk:
+                    return
+                yield chunk
+
+    async def read_body(self, headers):
+        return b''.join([chunk async for chunk in self.chunks(headers)])
+
+    def close(self):
+        self.reusable = False
+        self.writer.close()
+
+
+class ConnectionPool:
+    """Keep-alive connections to one host, at most size of them in use at once"""
+
+    def __init__(self, host, port, ssl_context=None, size=POOL_SIZE):
+        self.host = host
+        self.port = port
+        self._ssl = ssl_context
+        self._slots = asyncio.Semaphore(size)
+        self._idle = []     # Most recently used last, so warm connections are reused first
+
+        # Counters for monitoring
+        self.connections_opened = 0     # Each one a TCP and, for https, a TLS handshake
+        self.connections_closed = 0
+        self.connect_seconds = 0.0      # Time spent opening connections
+        self.requests = 0
+        self.requests_reused = 0    # Sent on a connection that had served a request before
+
+    async def request(self, method, target, body=None, headers=()):
+        """Send a request and return (status, headers, body)"""
+        async with self._slots:
+            while True:
+                connection = self._take_idle()
+                reused = connection is not None
+                if connection is None:
+                    connect_start = time.perf_counter()
+                    connection = await HttpConnection.open(self.host, self.port, self._ssl)
+                    self.connect_seconds += time.perf_counter() - connect_start
+                    self.connections_opened += 1
+                try:
+                    await connection.send(method, target, body, headers)
+                    status, response_headers = await connection.read_head()
+                    data = await connection.read_body(response_headers)
+                except (ConnectionError, asyncio.IncompleteReadError) as e:
+                    self._close(connection)
+                    # The server closed an idle connection as we reused it; only
+                    # requests that are safe to repeat are sent again
+                    if reused and method != 'POST':
+                        log.debug("Reused connection dropped (%s), retrying", e)
+                        continue
+                    raise
+                except BaseException:
+                    self._close(connection)
+                    raise
+
+                self.requests += 1
+                if reused:
+                    self.requests_reused += 1
+                if connection.reusable:
+                    connection.last_used = time.monotonic()
+                    self._idle.append(connection)
+                else:
+                    self._close(connection)
+                return status, response_headers, data
+
+    def _take_idle(self):
+        """Newest idle connection that is not too old, closing the stale ones"""
+        while self._idle:
+            connection = self._idle.pop()
+            if time.monotonic() - connection.last_used < IDLE_TIMEOUT:
+                return connection
+            self._close(connection)
+        return None
+
+    def _close(self, connection):
+        connection.close()
+        self.connections_closed += 1
+
+    def close(self):
+        """Close the idle connections"""
+        while self._idle:
+            self._close(self._idle.pop())
+
+    def stats(self):
+        """Return the pool counters"""
+        return {
+            'connections_opened': self.connections_opened,
+            'connections_closed': self.connections_closed,
+            'connections_idle': len(self._idle),
+            'connect_ms': round(self.connect_seconds / max(1, self.connections_opened) * 1000, 2),
+            'requests': self.requests,
+            'requests_reused': self.requests_reused,
+            'reuse_ratio': round(self.requests_reused / self.requests, 3) if self.requests else 0
+        }
+
+
+class ServiceAccountToken:
+    """OAuth2 access token of the chair's service account, refreshed before it expires"""
+
+    def __init__(self, credentials_path):
+        from firebase_admin import credentials  # Only needed when talking to the real database
+        self._credential = credentials.Certificate(credentials_path)
+        self._token = None
+        self._expires = 0
+
+    async def get(self):
+        """Return a valid token, fetching a new one off the event loop when needed"""
+        if self._token is None or time.time() > self._expires - TOKEN_REFRESH_MARGIN:
+            info = await asyncio.get_running_loop().run_in_executor(None, self._credential.get_access_token)
+            self._token = info.access_token
+            # google-auth reports a naive UTC expiry
+            self._expires = calendar.timegm(info.expiry.timetuple()) if info.expiry else time.time() + 3600
+        return self._token
+
+    def invalidate(self):
+        """Forget the token after the database rejected it"""
+        self._token = None
+
+
+class RealtimeDatabase:
+    """REST and streaming client of one Realtime Database, used on its event loop"""
+
+    def __init__(self, url, token=None, pool_size=POOL_SIZE):
+        # token has an async get() and invalidate(), None for an open database
+        parts = urlsplit(url)
+        self.secure = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.secure else 80)
+        self._ssl = ssl.create_default_context() if self.secure else None
+        self._token = token
+        self.pool = ConnectionPool(self.host, self.port, self._ssl, pool_size)
+        self.streams = []
+
+        # Counters for monitoring
+        self.requests_retried = 0
+        self.requests_failed = 0
+
+    async def target(self, path, query=None):
+        """Request target for a path: /path.json?query"""
+        params = dict(query or {})
+        if self._token is not None:
+            params['access_token'] = await self._token.get()
+        target = quote('/' + path.strip('/')) + '.json'
+        return target + ('?' + urlencode(params) if params else '')
+
+    async def request(self, method, path, value=None, query=None):
+        """Send one request and return the decoded JSON response, retrying with backoff"""
+        body = None if value is None else json.dumps(value, separators=(',', ':')).encode()
+        delay = RETRY_DELAY
+        token_refreshed = False
+        attempt = 0
+        while True:
+            last = attempt >= REQUEST_RETRIES
+            try:
+                target = await self.target(path, query)
+                status, _, data = await asyncio.wait_for(
+                    self.pool.request(method, target, body), REQUEST_TIMEOUT)
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                # A push may have been applied before the connection failed,
+                # sending it again could add the child twice
+                if last or method == 'POST':
+                    self.requests_failed += 1
+                    raise
+                error = e
+            else:
+                if status == 401 and self._token is not None and not token_refreshed:
+                    self._token.invalidate()
+                    token_refreshed = True
+                    continue
+                if status < 400:
+                    return json.loads(data) if data else None
+                error = HttpError(status, _error_message(data))
+                if last or status not in RETRY_STATUSES:
+                    self.requests_failed += 1
+                    raise error
+            attempt += 1
+            self.requests_retried += 1
+            log.debug("%s %s failed (%s), retrying in %.2fs", method, path, error, delay)
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+            delay = min(delay * 2, MAX_RETRY_DELAY)
+
+    async def get(self, path, shallow=False, query=None):
+        query = dict(query or {})
+        if shallow:
+            query['shallow'] = 'true'
+        return await self.request('GET', path, query=query)
+
+    async def set(self, path, value):
+        await self.request('PUT', path, value, {'print': 'silent'})
+
+    async def update(self, path, values):
+        await self.request('PATCH', path, values, {'print': 'silent'})
+
+    async def push(self, path, value):
+        """Add a child with a generated key and return the key"""
+        return (await self.request('POST', path, value))['name']
+
+    async def delete(self, path):
+        await self.request('DELETE', path, query={'print': 'silent'})
+
+    def listen(self, path, callback, query=None):
+        """Stream the events of a path to callback(Event) until the stream is closed"""
+        stream = EventStream(self, path, callback, query)
+        self.streams.append(stream)
+        stream.start()
+        return stream
+
+    async def close(self):
+        """Stop every stream and close the pool"""
+        for stream in self.streams:
+            await stream.aclose()
+        self.streams.clear()
+        self.pool.close()
+
+    def stats(self):
+        """Return the pool and stream counters"""
+        stats = self.pool.stats()
+        stream_connections = sum(stream.connections for stream in self.streams)
+        stats['tls_handshakes'] = self.pool.connections_opened + stream_connections if self.secure else 0
+        stats['requests_retried'] = self.requests_retried
+        stats['requests_failed'] = self.requests_failed
+        stats['stream_connections'] = stream_connections
+        stats['stream_events'] = sum(stream.events for stream in self.streams)
+        stats['stream_reconnects'] = sum(stream.reconnects for stream in self.streams)
+        return stats
+
+
+def _error_message(data):
+    try:
+        return json.loads(data).get('error', '')
+    except (ValueError, AttributeError):
+        return data[:200].decode('utf-8', 'replace')
+
+
+class EventStream:
+    """Server-sent events of one database path, reconnecting until closed"""
+
+    def __init__(self, database, path, callback, query=None):
+        self._database = database
+        self._path = path
+        self._callback = callback
+        self._query = query
+        self._task = None
+        self.closed = False
+
+        # Counters for monitoring
+        self.connections = 0
+        self.events = 0
+        self.reconnects = 0
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        delay = STREAM_RETRY_DELAY
+        while not self.closed:
+            try:
+                await self._stream()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("Stream of %s dropped: %s", self._path, e)
+            else:
+                delay = STREAM_RETRY_DELAY
+            if self.closed:
+                return
+            self.reconnects += 1
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+            delay = min(delay * 2, STREAM_MAX_RETRY_DELAY)
+
+    async def _stream(self):
+        database = self._database
+        target = await database.target(self._path, self._query)
+        host, port = database.host, database.port
+        for _ in range(MAX_REDIRECTS):
+            connection = await HttpConnection.open(host, port, database._ssl)
+            self.connections += 1
+            try:
+                await connection.send('GET', target, headers=(('Accept', 'text/event-stream'),))
+                status, headers = await connection.read_head()
+                if status in (301, 302, 307, 308) and 'location' in headers:
+                    # The database serves the stream from another host
+                    location = urlsplit(headers['location'])
+                    host = location.hostname
+                    port = location.port or (443 if database.secure else 80)
+                    target = location.path + ('?' + location.query if location.query else '')
+                    continue
+                if status != 200:
+                    raise HttpError(status, _error_message(await connection.read_body(headers)))
+                await self._read_events(connection, headers)
+                raise ConnectionError("Stream closed by the server")
+            finally:
+                connection.close()
+        raise ConnectionError("Too many redirects")
+
+    async def _read_events(self, connection, headers):
+        """Parse events as they arrive, an empty line ends each one"""
+        buffer = b''
+        event_type = None
+        data = []
+        async for chunk in connection.chunks(headers):
+            buffer += chunk
+            *lines, buffer = buffer.split(b'\n')
+            for line in lines:
+                line = line.rstrip(b'\r')
+                if line.startswith(b'event:'):
+                    event_type = line[6:].strip().decode()
+                elif line.startswith(b'data:'):
+                    data.append(line[5:].strip())
+                elif not line and event_type is not None:
+                    self._dispatch(event_type, b'\n'.join(data))
+                    event_type = None
+                    data = []
+
+    def _dispatch(self, event_type, data):
+        if event_type in ('put', 'patch'):
+            payload = json.loads(data)
+            self.events += 1
+            self._callback(Event(event_type, payload['path'], payload['data']))
+        elif event_type == 'auth_revoked':
+            # The token expired, reconnect with a new one
+            if self._database._token is not None:
+                self._database._token.invalidate()
+            raise ConnectionError("Access token revoked")
+        elif event_type == 'cancel':
+            raise HttpError(403, f"Stream cancelled: {data.decode('utf-8', 'replace')}")
+        # keep-alive events only keep the connection open
+
+    async def aclose(self):
+        """Stop streaming"""
+        self.closed = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+class AsyncListener:
+    """Registration of an AsyncDatastore listener"""
+
+    def __init__(self, store, stream, executor):
+        self._store = store
+        self._stream = stream
+        self._executor = executor
+
+    def close(self):
+        """Stop receiving events"""
+        if self._stream is not None:
+            self._store.call(self._stream.aclose())
+            self._stream = None
+            self._executor.shutdown(wait=False)
+
+
+class AsyncQuery:
+    """Ordered/filtered read or stream of the children of an AsyncReference"""
+
+    def __init__(self, ref, order_by):
+        self._ref = ref
+        self._query = {'orderBy': json.dumps(order_by)}
+
+    def start_at(self, value):
+        self._query['startAt'] = json.dumps(value)
+        return self
+
+    def end_at(self, value):
+        self._query['endAt'] = json.dumps(value)
+        return self
+
+    def limit_to_first(self, limit):
+        self._query['limitToFirst'] = limit
+        return self
+
+    def limit_to_last(self, limit):
+        self._query['limitToLast'] = limit
+        return self
+
+    def get(self):
+        """Return the matching children, ordered like the query"""
+        return self._ref._store.call(self._ref._store.database.get(self._ref.path, query=self._query))
+
+    def listen(self, callback):
+        """Stream the matching children, the streaming API's orderBy/startAt"""
+        return self._ref._listen(callback, self._query)
+
+
+class AsyncReference:
+    """Reference into an AsyncDatastore, blocking the calling thread like firebase_admin"""
+
+    def __init__(self, store, path):
+        self._store = store
+        self.path = '/' + path.strip('/')
+
+    @property
+    def key(self):
+        return self.path.rsplit('/', 1)[-1] or None
+
+    def child(self, path):
+        return AsyncReference(self._store, f"{self.path.rstrip('/')}/{path.strip('/')}")
+
+    def get(self, shallow=False):
+        return self._store.call(self._store.database.get(self.path, shallow))
+
+    def set(self, value):
+        self._store.call(self._store.database.set(self.path, value))
+
+    def update(self, value):
+        if not value or not isinstance(value, dict):
+            raise ValueError('Value argument must be a non-empty dictionary.')
+        self._store.call(self._store.database.update(self.path, value))
+
+    def update_async(self, value):
+        """Start an update and return a concurrent.futures.Future, so writes can overlap"""
+        return asyncio.run_coroutine_threadsafe(self._store.database.update(self.path, value), self._store.loop)
+
+    def push(self, value=''):
+        if value == '':
+            # Like firebase_admin, an empty push only generates the key
+            return self.child(self._store.call(self._store.database.push(self.path, None)))
+        return self.child(self._store.call(self._store.database.push(self.path, value)))
+
+    def delete(self):
+        self._store.call(self._store.database.delete(self.path))
+
+    def listen(self, callback):
+        return self._listen(callback, None)
+
+    def order_by_child(self, path):
+        return AsyncQuery(self, path)
+
+    def order_by_key(self):
+        return AsyncQuery(self, '$key')
+
+    def _listen(self, callback, query):
+        # Callbacks run in order on their own thread, so they may use the
+        # blocking API without stalling the event loop
+        executor = ThreadPoolExecutor(1, thread_name_prefix='listener')
+        dispatch = lambda event: executor.submit(_deliver, callback, event)
+        stream = self._store.call(_start_stream(self._store.database, self.path, dispatch, query))
+        return AsyncListener(self._store, stream, executor)
+
+
+async def _start_stream(database, path, callback, query):
+    return database.listen(path, callback, query)
+
+
+def _deliver(callback, event):
+    try:
+        callback(event)
+    except Exception as e:
+        log.exception("Listener callback failed: %s", e)
+
+
+class AsyncDatastore:
+    """Reference API of chair_datastore over a RealtimeDatabase running on an event loop"""
+
+    name = 'rest'
+
+    # Listeners can stream a query, like orderBy/startAt from a command cursor
+    listens_to_queries = True
+
+    def __init__(self, database, loop, server=None):
+        # server is the RealtimeServer of a memory datastore, closed with the store
+        self.database = database
+        self.loop = loop
+        self.server = server
+
+    def reference(self, path='/'):
+        """Return a reference to a path"""
+        return AsyncReference(self, path)
+
+    def call(self, coroutine):
+        """Run a coroutine on the event loop and wait for its result, never from the loop itself"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def aclose(self):
+        """Close the client, and the local server of a memory datastore"""
+        await self.database.close()
+        if self.server is not None:
+            await self.server.close()
+
+    def close(self):
+        self.call(self.aclose())
+
+    def stats(self):
+        """Return the client counters"""
+        return self.database.stats()
+
+
+async def open_datastore(name, credentials_path=None, database_url=None, pool_size=POOL_SIZE, **options):
+    """
+    Connect the streaming client to the Realtime Database, or for 'memory' to a
+    RealtimeServer over a MemoryDatastore created with options.
+    """
+    loop = asyncio.get_running_loop()
+    if name == 'memory':
+        from chair_datastore import MemoryDatastore
+        server = RealtimeServer(MemoryDatastore(**options))
+        await server.start()
+        return AsyncDatastore(RealtimeDatabase(server.url, pool_size=pool_size), loop, server)
+    if name == 'firebase':
+        token = ServiceAccountToken(credentials_path)
+        return AsyncDatastore(RealtimeDatabase(database_url, token, pool_size), loop)
+    raise ValueError(f"Unknown datastore: {name} (expected firebase or memory)")
+
+
+class RealtimeServer:
+    """Serves a MemoryDatastore over the Realtime Database REST and streaming API, for testing"""
+
+    def __init__(self, store, workers=SERVER_WORKERS):
+        # Requests run on worker threads, so the store's injected latency
+        # overlaps between requests like it does on the real database
+        self.store = store
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='rtdb-server')
+        self._server = None
+        self._connections = set()
+        self.url = None
+        self.requests = 0
+
+    async def start(self, host='127.0.0.1', port=0):
+        self._server = await asyncio.start_server(self._serve, host, port, limit=1 << 20)
+        self.url = f'http://{host}:{self._server.sockets[0].getsockname()[1]}'
+        return self
+
+    async def close(self):
+        self._server.close()
+        for task in list(self._connections):
+            task.cancel()
+        await self._server.wait_closed()
+        self._executor.shutdown(wait=False)
+        self.store.close()
+
+    async def _serve(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                self.requests += 1
+
+                url = urlsplit(target)
+                path = unquote(url.path)[:-len('.json')] if url.path.endswith('.json') else unquote(url.path)
+                query = dict(parse_qsl(url.query))
+                if 'text/event-stream' in headers.get('accept', ''):
+                    await self._stream(writer, path, query)
+                    return
+                status, result = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, self._handle, method, path, query, body)
+                payload = b'' if status == 204 else json.dumps(result).encode()
+                writer.write(f'HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n'
+                             f'Content-Length: {len(payload)}\r\n\r\n'.encode() + payload)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError, ValueError):
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    def _handle(self, method, path, query, body):
+        """Apply one REST request to the store, on a worker thread"""
+        ref = self.store.reference(path)
+        value = json.loads(body) if body else None
+        silent = query.get('print') == 'silent'
+        try:
+            if method == 'GET':
+                if 'orderBy' in query:
+                    result = self._query(ref, query).get()
+                else:
+                    result = ref.get(shallow=query.get('shallow') == 'true')
+                return 200, result
+            if method == 'PUT':
+                ref.set(value)
+            elif method == 'PATCH':
+                ref.update(value)
+            elif method == 'POST':
+                return 200, {'name': ref.push(value).key}
+            elif method == 'DELETE':
+                ref.delete()
+            else:
+                return 405, {'error': f'Method {method} not allowed'}
+        except ValueError as e:
+            return 400, {'error': str(e)}
+        return (204, None) if silent else (200, value)
+
+    def _query(self, ref, query):
+        order_by = json.loads(query['orderBy'])
+        memory_query = ref.order_by_key() if order_by == '$key' else ref.order_by_child(order_by)
+        if 'startAt' in query:
+            memory_query.start_at(json.loads(query['startAt']))
+        if 'endAt' in query:
+            memory_query.end_at(json.loads(query['endAt']))
+        if 'limitToFirst' in query:
+            memory_query.limit_to_first(int(query['limitToFirst']))
+        if 'limitToLast' in query:
+            memory_query.limit_to_last(int(query['limitToLast']))
+        return memory_query
+
+    async def _stream(self, writer, path, query):
+        """Send the store's listener events as server-sent events until the client goes away"""
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        order_by = json.loads(query['orderBy']) if 'startAt' in query else None
+        start_at = json.loads(query['startAt']) if order_by is not None else None
+
+        def in_range(key, child):
+            value = key if order_by == '$key' else child.get(order_by) if isinstance(child, dict) else None
+            try:
+                return value is not None and value >= start_at
+            except TypeError:
+                return False
+
+        def forward(event):
+            # Runs on the store's delivery thread
+            loop.call_soon_threadsafe(events.put_nowait, event)
+
+        listener = self.store.reference(path).listen(forward)
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n'
+                     b'Transfer-Encoding: chunked\r\n\r\n')
+        try:
+            while True:
+                event = await events.get()
+                data = event.data
+                if order_by is not None:
+                    # Children outside the query are left out, their deletes and
+                    # deeper changes pass through
+                    parts = event.path.strip('/').split('/')
+                    if event.path == '/' and isinstance(data, dict):
+                        data = {key: child for key, child in data.items() if in_range(key, child)} or None
+                    elif len(parts) == 1 and data is not None and not in_range(parts[0], data):
+                        continue
+                message = (f'event: {event.event_type}\n'
+                           f'data: {json.dumps({"path": event.path, "data": data})}\n\n').encode()
+                writer.write(b'%x\r\n%s\r\n' % (len(message), message))
+                await writer.drain()
+        finally:
+            listener.close()
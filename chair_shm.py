@@ -0,0 +1,318 @@
+"""
+Shared memory between the network and control processes of a split chair.
+With CHAIR_PROCESSES=split the Firebase listener, LAN channel and telemetry
+run in the main process while a small control process owns the GPIO, so a
+slow network callback can never hold the GIL the motor code needs.
+
+One SharedMemory segment holds two seqlocked slots: the latest commands,
+written by the network process, and the chair state, written by the control
+process. Each slot has a single writer that makes its sequence number odd
+before writing and even after; a reader copies the slot and retries when the
+sequence was odd or moved while it copied, so neither side ever waits for
+the other. Python has no memory fences, so every record also carries a CRC32
+that rejects a copy the CPU reordered around the sequence number.
+"""
+import json
+import logging
+import multiprocessing
+import os
+import struct
+import threading
+import time
+import zlib
+from multiprocessing import shared_memory
+
+log = logging.getLogger('chair.shm')
+
+# Processes of a chair: 'single', or 'split' into network and control processes
+PROCESS_MODE = os.environ.get('CHAIR_PROCESSES', 'single')
+
+# Bytes per slot, header included
+SLOT_SIZE = 4096
+
+# How often the network process looks for a new chair state
+STATE_POLL_INTERVAL = 0.02  # 20ms
+
+# The control process writes its state at least this often, so its counters stay fresh
+STATE_REFRESH_INTERVAL = 1.0  # 1 second
+
+# Copies a reader attempts before giving up until its next poll
+READ_RETRIES = 100
+
+# Commands that set the speed, every other command sets the motion
+SPEED_COMMANDS = frozenset(('speed', 'full_speed', 'low_speed'))
+
+SEQUENCE = struct.Struct('<Q')
+RECORD = struct.Struct('<II')   # Payload length, payload CRC32
+HEADER_SIZE = SEQUENCE.size + RECORD.size
+
+
+class SeqlockSlot:
+    """Single-writer, many-reader record in a shared buffer"""
+
+    def __init__(self, buffer, offset, size=SLOT_SIZE):
+        self._buffer = buffer
+        self._offset = offset
+        self._payload = offset + HEADER_SIZE
+        self.capacity = size - HEADER_SIZE
+        self._sequence = SEQUENCE.unpack_from(buffer, offset)[0] & ~1
+
+        # Counters for monitoring
+        self.writes = 0
+        self.reads = 0
+        self.retries = 0    # Copies that overlapped a write
+        self.torn = 0       # Copies whose CRC did not match
+
+    def sequence(self):
+        """Current sequence number, changes with every write"""
+        return SEQUENCE.unpack_from(self._buffer, self._offset)[0]
+
+    def write(self, payload):
+        """Replace the record, only one process may write a slot"""
+        if len(payload) > self.capacity:
+            raise ValueError(f"Record of {len(payload)} bytes does not fit a {self.capacity} byte slot")
+        buffer = self._buffer
+        # Odd while the record changes
+        SEQUENCE.pack_into(buffer, self._offset, self._sequence + 1)
+        buffer[self._payload:self._payload + len(payload)] = payload
+        RECORD.pack_into(buffer, self._offset + SEQUENCE.size, len(payload), zlib.crc32(payload))
+        self._sequence += 2
+        SEQUENCE.pack_into(buffer, self._offset, self._sequence)
+        self.writes += 1
+
+    def read(self):
+        """Return (sequence, payload) of a consistent copy, or (None, None) when none was found"""
+        buffer = self._buffer
+        for _ in range(READ_RETRIES):
+            sequence = SEQUENCE.unpack_from(buffer, self._offset)[0]
+            if sequence == 0:
+                return None, None  # Never written
+            if not sequence & 1:
+                length, crc = RECORD.unpack_from(buffer, self._offset + SEQUENCE.size)
+                if length <= self.capacity:
+                    payload = bytes(buffer[self._payload:self._payload + length])
+                    if SEQUENCE.unpack_from(buffer, self._offset)[0] == sequence:
+                        if zlib.crc32(payload) == crc:
+                            self.reads += 1
+                            return sequence, payload
+                        self.torn += 1
+                        continue
+            self.retries += 1
+            time.sleep(0)  # Let the writer finish
+        return None, None
+
+    def stats(self):
+        """Return the slot counters"""
+        return {
+            'writes': self.writes,
+            'reads': self.reads,
+            'retries': self.retries,
+            'torn': self.torn
+        }
+
+
+class ChairSharedMemory:
+    """The commands and state slots of a chair in one shared memory segment"""
+
+    def __init__(self, name=None, slot_size=SLOT_SIZE):
+        # Created by the network process, attached to by name in the control process
+        self.owner = name is None
+        if self.owner:
+            self._memory = shared_memory.SharedMemory(create=True, size=2 * slot_size)
+        else:
+            self._memory = _attach(name)
+        self.name = self._memory.name
+        self.commands = SeqlockSlot(self._memory.buf, 0, slot_size)
+        self.state = SeqlockSlot(self._memory.buf, slot_size, slot_size)
+
+    def close(self):
+        """Detach, and remove the segment when this process created it"""
+        self.commands = self.state = None
+        self._memory.close()
+        if self.owner:
+            self._memory.unlink()
+
+
+def _attach(name):
+    """Attach to an existing segment, leaving its removal to the process that created it"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 attaching registers the segment again, which is
+        # harmless as a spawned process shares the resource tracker of its parent
+        return shared_memory.SharedMemory(name=name)
+
+
+class CommandMailbox:
+    """Network side: the latest motion and speed command, written to the commands slot"""
+
+    def __init__(self, slot):
+        self._slot = slot
+        self._serial = 0
+        self._latest = {'motion': None, 'speed': None, 'closed': False}
+
+    def submit(self, command, value=None, timestamp=None):
+        """Replace the latest command of its kind, only the scheduler thread submits"""
+        self._serial += 1
+        kind = 'speed' if command in SPEED_COMMANDS else 'motion'
+        self._latest[kind] = [self._serial, command, value, timestamp]
+        self._write()
+
+    def close(self):
+        """Tell the control process to stop the motors and exit"""
+        self._latest['closed'] = True
+        self._write()
+
+    def _write(self):
+        self._slot.write(json.dumps(self._latest, separators=(',', ':')).encode())
+
+
+class CommandInbox:
+    """Control side: reads the commands slot and returns the commands not run yet"""
+
+    def __init__(self, slot):
+        self._slot = slot
+        self._sequence = 0
+        self._applied = 0
+        self.closed = False
+        self.commands_skipped = 0   # Replaced in the mailbox before the control process saw them
+
+    def poll(self):
+        """Return new (command, value, timestamp) tuples, oldest first"""
+        if self._slot.sequence() == self._sequence:
+            return []
+        sequence, payload = self._slot.read()
+        if payload is None:
+            return []
+        self._sequence = sequence
+        latest = json.loads(payload)
+        self.closed = latest['closed']
+        entries = sorted(entry for entry in (latest['speed'], latest['motion'])
+                         if entry is not None and entry[0] > self._applied)
+        if not entries:
+            return []
+        self.commands_skipped += entries[-1][0] - self._applied - len(entries)
+        self._applied = entries[-1][0]
+        return [(command, value, timestamp) for _, command, value, timestamp in entries]
+
+
+class StateWriter:
+    """Control side: collects the chair fields and writes them with the movement state"""
+
+    def __init__(self, slot, refresh_interval=STATE_REFRESH_INTERVAL):
+        self._slot = slot
+        self._refresh_interval = refresh_interval
+        self._fields = {}
+        self._dirty = False
+        self._written = 0
+
+    def update(self, values):
+        """Record chair fields, the same call as TelemetryEncoder.update"""
+        self._fields.update(values)
+        self._dirty = True
+
+    def flush(self, snapshot, force=False, now=None):
+        """
+        Write the state when it changed or its counters are due, return whether it was written.
+        snapshot() returns the movement, duties and control counters, and is only called to write.
+        """
+        now = time.monotonic() if now is None else now
+        if not (self._dirty or force) and now - self._written < self._refresh_interval:
+            return False
+        movement, duties, stats = snapshot()
+        record = {'fields': self._fields, 'movement': movement, 'duties': duties, 'control': stats}
+        self._slot.write(json.dumps(record, separators=(',', ':')).encode())
+        self._dirty = False
+        self._written = now
+        return True
+
+
+class StateReader:
+    """Network side: polls the state slot and hands every new record to a callback"""
+
+    def __init__(self, slot, on_state, interval=STATE_POLL_INTERVAL):
+        self._slot = slot
+        self._on_state = on_state
+        self._interval = interval
+        self._sequence = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self.records = 0
+
+    def start(self):
+        """Start polling on a background thread"""
+        self._thread = threading.Thread(target=self._run, name='control-state', daemon=True)
+        self._thread.start()
+
+    def poll(self):
+        """Hand over the latest record if it is new, return whether there was one"""
+        if self._slot.sequence() == self._sequence:
+            return False
+        sequence, payload = self._slot.read()
+        if payload is None:
+            return False
+        self._sequence = sequence
+        self.records += 1
+        self._on_state(json.loads(payload))
+        return True
+
+    def close(self):
+        """Read the last record and stop polling"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.poll()
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            try:
+                self.poll()
+            except Exception:
+                log.exception("Could not apply the control state")
+
+
+class ControlProcess:
+    """Network side of a split chair: shared memory, the control process and its state"""
+
+    def __init__(self, target, on_state, *args):
+        # target(memory_name, *args) runs in a fresh interpreter, never a fork
+        # of this one with its network threads
+        self.memory = ChairSharedMemory()
+        self.mailbox = CommandMailbox(self.memory.commands)
+        self.reader = StateReader(self.memory.state, on_state)
+        context = multiprocessing.get_context('spawn')
+        self.process = context.Process(target=target, args=(self.memory.name,) + args,
+                                       name='chair-control', daemon=True)
+
+    def start(self):
+        """Start the control process and follow its state"""
+        self.process.start()
+        self.reader.start()
+
+    def submit(self, command, value=None, timestamp=None):
+        """Hand a command to the control process, from the scheduler thread"""
+        self.mailbox.submit(command, value, timestamp)
+
+    def stop(self):
+        """Stop the motors and let the control process exit, from the scheduler thread"""
+        self.mailbox.submit('stop')
+        self.mailbox.close()
+
+    def close(self, timeout=2.0):
+        """Wait for the control process to exit and release the shared memory"""
+        self.process.join(timeout)
+        if self.process.is_alive():
+            log.warning("Control process did not exit, terminating it")
+            self.process.terminate()
+            self.process.join(timeout)
+        self.reader.close()
+        self.memory.close()
+
+    def stats(self):
+        """Return the shared memory counters"""
+        stats = {'alive': int(self.process.is_alive()), 'state_records': self.reader.records}
+        for slot in ('commands', 'state'):
+            for key, value in getattr(self.memory, slot).stats().items():
+                stats[f'{slot}_{key}'] = value
+        return stats
@@ -0,0 +1,109 @@
+"""
+Movement state of the smart chair.
+MovementState is updated in place by every movement command and records
+each state in a MovementHistory: a ring buffer of the last states
+(x, y, signed wheel duties, time) in one preallocated buffer, so the command
+path never allocates for them and diagnostics read the recent history
+without stopping the chair.
+"""
+import struct
+import threading
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional, without it history reads return tuples
+    np = None
+
+# States kept in the history ring buffer
+HISTORY_SIZE = 512
+
+# Columns of a history row, duties are signed (negative = backward)
+HISTORY_FIELDS = ('x', 'y', 'left_duty', 'right_duty', 'timestamp')
+ROW = struct.Struct('<5d')
+
+
+class MovementHistory:
+    """Ring buffer of the last movement states, stored as packed rows of doubles"""
+
+    def __init__(self, size=HISTORY_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._rows = bytearray(ROW.size * size)
+        self._next = 0    # Row written next
+        self.count = 0    # Rows written since the start
+
+    def record(self, x, y, left, right, timestamp):
+        """Overwrite the oldest row with a new state"""
+        with self._lock:
+            # One C call packs the whole row in place
+            ROW.pack_into(self._rows, self._next * ROW.size, x, y, left, right, timestamp)
+            self._next = self._next + 1 if self._next + 1 < self.size else 0
+            self.count += 1
+
+    def rows(self, last=None):
+        """The last rows, oldest first, as tuples"""
+        with self._lock:
+            data = self._ordered()
+        rows = list(ROW.iter_unpack(data))
+        return rows if last is None else rows[max(0, len(rows) - last):]
+
+    def to_numpy(self, last=None):
+        """The last rows, oldest first, as an (n, 5) NumPy array, or None without NumPy"""
+        if np is None:
+            return None
+        with self._lock:
+            data = self._ordered()
+        rows = np.frombuffer(data, dtype='<f8').reshape(-1, len(HISTORY_FIELDS))
+        return rows if last is None else rows[max(0, len(rows) - last):]
+
+    def stats(self):
+        """Return history counters and the largest wheel duty step in the buffer"""
+        rows = self.rows()
+        step = 0.0
+        for previous, row in zip(rows, rows[1:]):
+            step = max(step, abs(row[2] - previous[2]), abs(row[3] - previous[3]))
+        return {
+            'states_recorded': self.count,
+            'states_kept': len(rows),
+            'span_seconds': round(rows[-1][4] - rows[0][4], 3) if rows else 0,
+            'max_duty_step': round(step, 1)
+        }
+
+    def _ordered(self):
+        """Copy of the filled rows, oldest first, called with the lock held"""
+        split = self._next * ROW.size
+        if self.count < self.size:
+            return bytes(self._rows[:split])
+        return bytes(self._rows[split:] + self._rows[:split])
+
+
+class MovementState:
+    """Current movement of one chair, updated in place"""
+
+    __slots__ = ('x', 'y', 'left_speed', 'right_speed', 'direction', 'angle', 'magnitude',
+                 'last_update_time', 'history')
+
+    def __init__(self, history=None):
+        self.history = history
+        self.x = 0
+        self.y = 0
+        self.left_speed = 0
+        self.right_speed = 0
+        self.direction = 'stop'
+        self.angle = 0
+        self.magnitude = 0
+        self.last_update_time = 0
+
+    def update(self, direction, x, y, left, right, angle, magnitude, timestamp):
+        """Set every field from signed wheel duties and record the state in the history"""
+        self.direction = direction
+        self.x = x
+        self.y = y
+        self.left_speed = left if left >= 0 else -left
+        self.right_speed = right if right >= 0 else -right
+        self.angle = angle
+        self.magnitude = magnitude
+        self.last_update_time = timestamp
+        if self.history is not None:
+            self.history.record(x, y, left, right, timestamp)
+
@@ -0,0 +1,414 @@
+"""
+Telemetry publishing for the smart chair.
+Merges the chair's status and movement_state writes into a single
+root-level multi-path update so each publish interval costs one round trip.
+Writes happen on a background worker so motor commands never wait on the network.
+Movement state goes through a TelemetryEncoder that only sends the fields
+that changed since the last acknowledged write, at a rate that follows how
+fast the state is changing, with a full keyframe at a fixed interval.
+"""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import CancelledError, Future
+from functools import partial
+
+log = logging.getLogger('chair.telemetry')
+
+# Minimum time between two multi-path updates
+PUBLISH_INTERVAL = 0.1  # 100ms
+
+# Maximum number of distinct paths waiting to be published
+MAX_PENDING_PATHS = 64
+
+# Publish interval of an encoder whose state barely changes, it shrinks to
+# PUBLISH_INTERVAL as the change since the last write reaches SIGNIFICANT_CHANGE
+IDLE_PUBLISH_INTERVAL = 1.0  # 1 second
+SIGNIFICANT_CHANGE = 20      # Joystick units, degrees or duty percentage points
+
+# Time between two full snapshots of an encoder's state, sent even when nothing changed
+KEYFRAME_INTERVAL = 30.0  # 30 seconds
+
+# Decimals kept for float values, finer changes are not worth sending
+VALUE_DECIMALS = 1
+
+# Window of the bytes per minute counter
+BYTES_WINDOW = 60.0  # 1 minute
+
+
+def payload_size(updates):
+    """Size in bytes of a multi-path update as sent to the database"""
+    return len(json.dumps(updates, separators=(',', ':'), default=str).encode())
+
+
+class TelemetryEncoder:
+    """Delta encoder for one chair's state fields with an adaptive publish rate"""
+
+    def __init__(self, publisher, path, urgent=(), min_interval=PUBLISH_INTERVAL,
+                 max_interval=IDLE_PUBLISH_INTERVAL, keyframe_interval=KEYFRAME_INTERVAL,
+                 significant_change=SIGNIFICANT_CHANGE, clock=time.monotonic):
+        # Fields are paths relative to path, changes to urgent fields (status,
+        # direction) go out with the next write regardless of the rate
+        self._publisher = publisher
+        self._path = path
+        self._urgent_fields = frozenset(urgent)
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._keyframe_interval = keyframe_interval
+        self._significant = significant_change
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = {}    # Latest value of every field
+        self._acked = {}    # Values the database is known to hold
+        self._sent = {}     # Acked values plus the write in flight
+        self._dirty = False
+        self._urgent = False
+        self._last_sent = 0
+        self._last_keyframe = clock()
+
+        # Counters for monitoring
+        self.deltas_sent = 0
+        self.keyframes_sent = 0
+        self.fields_sent = 0
+        self.values_unchanged = 0   # Values given again without a change, never sent
+        self.writes_failed = 0
+
+        publisher.add_source(self)
+
+    def update(self, values):
+        """Record new field values, only the ones that changed will be sent"""
+        wake = False
+        with self._lock:
+            state = self._state
+            for field, value in values.items():
+                if isinstance(value, float):
+                    value = round(value, VALUE_DECIMALS)
+                if state.get(field, _MISSING) == value:
+                    self.values_unchanged += 1
+                    continue
+                state[field] = value
+                if field in self._urgent_fields and not self._urgent:
+                    self._urgent = wake = True
+                if not self._dirty:
+                    self._dirty = wake = True
+        # The publisher lock is never taken while holding ours
+        if wake:
+            self._publisher.wake()
+
+    def acknowledge(self, values):
+        """Record values written to the database outside the encoder, like at startup"""
+        with self._lock:
+            values = {field: round(value, VALUE_DECIMALS) if isinstance(value, float) else value
+                      for field, value in values.items()}
+            self._state.update(values)
+            self._acked.update(values)
+            self._sent.update(values)
+            self._last_keyframe = self._clock()
+
+    def due(self, now, force=False):
+        """Time at which the encoder wants to send, or None when it has nothing to send"""
+        with self._lock:
+            if not self._state:
+                return None
+            keyframe_at = self._last_keyframe + self._keyframe_interval
+            if not self._dirty:
+                return keyframe_at
+            if self._urgent or force:
+                return now
+            # The interval shrinks as the change grows, so ask again soon
+            return min(keyframe_at, self._last_sent + self._interval(), now + self._min_interval)
+
+    def collect(self, now, force=False):
+        """Return the {path: value} updates to send now and count them as in flight"""
+        with self._lock:
+            keyframe = now - self._last_keyframe >= self._keyframe_interval
+            if not keyframe and not (self._dirty and (
+                    self._urgent or force or now >= self._last_sent + self._interval())):
+                return {}
+            if keyframe:
+                self._last_keyframe = now
+                if not self._state:
+                    return {}
+                changed = dict(self._state)
+                self.keyframes_sent += 1
+            else:
+                sent = self._sent
+                changed = {field: value for field, value in self._state.items()
+                           if sent.get(field, _MISSING) != value}
+                self.deltas_sent += 1
+            self._sent.update(changed)
+            self._dirty = self._urgent = False
+            self._last_sent = now
+            self.fields_sent += len(changed)
+            return {f'{self._path}/{field}': value for field, value in changed.items()}
+
+    def acked(self, updates):
+        """The publisher wrote the updates returned by collect()"""
+        prefix = len(self._path) + 1
+        with self._lock:
+            for path, value in updates.items():
+                self._acked[path[prefix:]] = value
+
+    def failed(self, updates):
+        """The publisher could not write them, they are sent again with the next delta"""
+        prefix = len(self._path) + 1
+        with self._lock:
+            for path in updates:
+                field = path[prefix:]
+                if field in self._acked:
+                    self._sent[field] = self._acked[field]
+                else:
+                    self._sent.pop(field, None)
+            self._dirty = True
+            self.writes_failed += 1
+
+    def stats(self):
+        """Return the encoder counters"""
+        with self._lock:
+            interval = self._interval() if self._dirty else self._max_interval
+        return {
+            'deltas_sent': self.deltas_sent,
+            'keyframes_sent': self.keyframes_sent,
+            'fields_sent': self.fields_sent,
+            'values_unchanged': self.values_unchanged,
+            'writes_failed': self.writes_failed,
+            'interval_ms': round(interval * 1000)
+        }
+
+    def _interval(self):
+        """Publish interval for the change since the last write, called with the lock held"""
+        change = 0
+        sent = self._sent
+        for field, value in self._state.items():
+            previous = sent.get(field)
+            if (isinstance(value, (int, float)) and isinstance(previous, (int, float))
+                    and not isinstance(value, bool)):
+                change = max(change, abs(value - previous))
+            elif value != previous:
+                change = self._significant  # A new field or a changed name
+        fraction = min(1.0, change / self._significant)
+        return self._max_interval - (self._max_interval - self._min_interval) * fraction
+
+
+# Marks a field the encoder has no value for
+_MISSING = object()
+
+
+class StatePublisher:
+    """Write-behind publisher that sends one multi-path update per interval"""
+
+    def __init__(self, write, interval=PUBLISH_INTERVAL, max_pending=MAX_PENDING_PATHS,
+                 on_write=None, max_in_flight=1):
+        # write() receives a {path: value} dict relative to the database root,
+        # on_write(seconds) is told how long each successful write took. A
+        # write() that returns a concurrent.futures.Future lets up to
+        # max_in_flight writes overlap, each with paths and encoders of its own.
+        self._write = write
+        self._on_write = on_write
+        self._interval = interval
+        self.max_pending = max_pending  # Raised when one publisher serves many chairs
+        self._cond = threading.Condition()
+        self._pending = OrderedDict()
+        self._sources = []      # Encoders asked for their updates at every write
+        self._flushing = 0      # flush() calls waiting, encoders send at once while set
+        self._last_flush = 0
+        self.max_in_flight = max_in_flight
+        self._in_flight = 0
+        self._in_flight_paths = set()
+        self._busy_sources = set()  # Encoders with a write in flight
+        self._running = False
+        self._thread = None
+
+        # Counters for monitoring
+        self.updates_sent = 0
+        self.values_coalesced = 0   # Values replaced by a newer value before sending
+        self.values_dropped = 0     # Values evicted because the queue was full
+        self.writes_failed = 0
+        self.bytes_sent = 0
+        self._bytes_window = deque()  # (time, bytes) of recent writes
+
+    def start(self):
+        """Start the background publishing worker"""
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name='telemetry', daemon=True)
+            self._thread.start()
+
+    def publish(self, updates):
+        """Stage {path: value} updates without blocking, latest value per path wins"""
+        with self._cond:
+            for path, value in updates.items():
+                if path in self._pending:
+                    self.values_coalesced += 1
+                    del self._pending[path]
+                elif len(self._pending) >= self.max_pending:
+                    # Queue is full, evict the oldest staged value
+                    self._pending.popitem(last=False)
+                    self.values_dropped += 1
+                self._pending[path] = value
+            self._cond.notify()
+
+        if not self._running:
+            self.start()
+
+    def add_source(self, source):
+        """Ask an encoder for its updates at every write, see TelemetryEncoder"""
+        with self._cond:
+            self._sources.append(source)
+
+    def wake(self):
+        """Tell the worker an encoder has something new to send"""
+        with self._cond:
+            self._cond.notify()
+        if not self._running:
+            self.start()
+
+    def flush(self, timeout=2.0):
+        """Wait until everything staged so far has been written"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._flushing += 1
+            try:
+                self._cond.notify()
+                while self._running and (self._pending or self._in_flight or self._dirty_sources()):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+            finally:
+                self._flushing -= 1
+        return True
+
+    def close(self, timeout=2.0):
+        """Publish what is left and stop the worker"""
+        self.flush(timeout)
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def stats(self):
+        """Return the publisher counters"""
+        with self._cond:
+            pending = len(self._pending)
+            self._trim_window(time.monotonic())
+            bytes_per_minute = sum(size for _, size in self._bytes_window)
+        return {
+            'updates_sent': self.updates_sent,
+            'values_coalesced': self.values_coalesced,
+            'values_dropped': self.values_dropped,
+            'writes_failed': self.writes_failed,
+            'pending': pending,
+            'bytes_sent': self.bytes_sent,
+            'bytes_per_minute': round(bytes_per_minute * 60 / BYTES_WINDOW)
+        }
+
+    def _trim_window(self, now):
+        """Forget writes older than the bytes window, called with the lock held"""
+        window = self._bytes_window
+        while window and now - window[0][0] > BYTES_WINDOW:
+            window.popleft()
+
+    def _dirty_sources(self):
+        """Whether an encoder has changes that flush() should wait for, called with the lock held"""
+        now = time.monotonic()
+        due = self._sources_due(True, now)
+        return due is not None and due <= now
+
+    def _sources_due(self, force, now=None, skip=()):
+        """Earliest time an encoder wants to send, called with the lock held"""
+        now = time.monotonic() if now is None else now
+        due = None
+        for source in self._sources:
+            if source in skip:
+                continue
+            source_due = source.due(now, force)
+            if source_due is not None and (due is None or source_due < due):
+                due = source_due
+        return due
+
+    def _run(self):
+        """Worker loop: wait for staged values and send them once per interval"""
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                force = self._flushing > 0 or not self._running
+                busy = self._busy_sources
+                # A path already in flight waits for its write, so writes to it stay in order
+                ready = [path for path in self._pending if path not in self._in_flight_paths]
+                source_due = self._sources_due(force, now, busy)
+                if not self._running and not self._in_flight and not self._pending and (
+                        source_due is None or source_due > now):
+                    return
+                if self._in_flight >= self.max_in_flight or (not ready and source_due is None):
+                    self._cond.wait()
+                    continue
+
+                send_at = self._last_flush + self._interval if self._running else now
+                if not ready:
+                    send_at = max(send_at, source_due)
+                if send_at > now:
+                    # Let more values coalesce until the interval is over
+                    self._cond.wait(send_at - now)
+                    continue
+
+                pending = {path: self._pending.pop(path) for path in ready}
+                collected = []
+                for source in self._sources:
+                    if source in busy:
+                        continue
+                    updates = source.collect(now, force)
+                    if updates:
+                        collected.append((source, updates))
+                        pending.update(updates)
+                if not pending:
+                    continue
+                self._last_flush = now
+                self._in_flight += 1
+                self._in_flight_paths.update(pending)
+                busy.update(source for source, _ in collected)
+
+            size = payload_size(pending)
+            start = time.perf_counter()
+            try:
+                result = self._write(pending)
+            except Exception as e:
+                self._written(pending, collected, size, start, e)
+                continue
+            if isinstance(result, Future):
+                # The write completes on the client's own thread while the next batch goes out
+                result.add_done_callback(partial(self._write_done, pending, collected, size, start))
+            else:
+                self._written(pending, collected, size, start, None)
+
+    def _write_done(self, pending, collected, size, start, future):
+        error = CancelledError('Write cancelled') if future.cancelled() else future.exception()
+        self._written(pending, collected, size, start, error)
+
+    def _written(self, pending, collected, size, start, error):
+        """Account for a finished write and let the paths and encoders it held go"""
+        if error is None:
+            self.updates_sent += 1
+            if self._on_write is not None:
+                self._on_write(time.perf_counter() - start)
+            for source, updates in collected:
+                source.acked(updates)
+        else:
+            self.writes_failed += 1
+            log.warning("Telemetry update failed: %s", error)
+            for source, updates in collected:
+                source.failed(updates)
+        with self._cond:
+            self.bytes_sent += size
+            self._bytes_window.append((time.monotonic(), size))
+            self._trim_window(time.monotonic())
+            self._in_flight -= 1
+            self._in_flight_paths.difference_update(pending)
+            self._busy_sources.difference_update(source for source, _ in collected)
+            self._cond.notify_all()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""
+Command traces for the smart chair.
+When CHAIR_TRACE is set, every command handed to the scheduler is appended
+to a compact binary log with its Firebase timestamp and local receive time.
+A trace can be replayed through handle_command against the simulated GPIO,
+at the original pace, faster, or as fast as possible. The movement state
+clock follows the recorded receive times and the motor ramp is stepped by
+the recorded gaps between commands, so a replay takes the same decisions at
+any speed and its motor output digest can be compared between runs and code
+versions.
+
+Usage:
+    python3 chair_trace.py show trace.bin [--limit N]
+    python3 chair_trace.py replay trace.bin [--speed 1|10|max] [--expect DIGEST]
+
+File: 6-byte header (b'CTRC', version), then one record per command:
+    received (f64, s since epoch), timestamp (f64, ms, NaN when missing),
+    source (u8), command length (u8), value length (u16), command, value JSON
+"""
+import argparse
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+log = logging.getLogger('chair.trace')
+
+# Trace file to record to (empty to disable)
+TRACE_PATH = os.environ.get('CHAIR_TRACE', '')
+
+# Buffered records are written to the file at least this often
+TRACE_FLUSH_INTERVAL = 1.0  # 1 second
+
+MAGIC = b'CTRC'
+VERSION = 1
+HEADER = struct.Struct('<4sH')
+RECORD = struct.Struct('<ddBBH')
+
+# Where a record came from
+SOURCE_FIREBASE = 0
+SOURCE_LAN = 1
+SOURCE_STATE = 2   # Chair state when the trace started, like the current speed
+SOURCES = ('firebase', 'lan', 'state')
+
+TraceRecord = namedtuple('TraceRecord', 'received timestamp source command value')
+
+
+class TraceRecorder:
+    """Append-only writer of command records"""
+
+    def __init__(self, path, flush_interval=TRACE_FLUSH_INTERVAL, clock=time.time):
+        self.path = path
+        self._flush_interval = flush_interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(HEADER.pack(MAGIC, VERSION))
+        else:
+            read_header(path)  # Only append to a trace of the same format
+        self._last_flush = clock()
+
+        # Counters for monitoring
+        self.records = 0
+        self.bytes_written = 0
+        self.values_dropped = 0   # Values too large for a record, written as missing
+
+    def record(self, command, value=None, timestamp=None, source=SOURCE_FIREBASE):
+        """Append one command, stamped with the local receive time"""
+        received = self._clock()
+        # Cut at a character boundary so the reader can decode it
+        command_bytes = str(command).encode()[:255].decode('utf-8', 'ignore').encode()
+        value_bytes = b'' if value is None else json.dumps(value, separators=(',', ':')).encode()
+        if len(value_bytes) > 0xFFFF:
+            value_bytes = b''
+            self.values_dropped += 1
+        if not isinstance(timestamp, (int, float)) or isinstance(timestamp, bool):
+            timestamp = math.nan
+        data = (RECORD.pack(received, timestamp, source, len(command_bytes), len(value_bytes))
+                + command_bytes + value_bytes)
+
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(data)
+            self.records += 1
+            self.bytes_written += len(data)
+            if received - self._last_flush >= self._flush_interval:
+                self._file.flush()
+                self._last_flush = received
+
+    def close(self):
+        """Write out buffered records and close the file"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def stats(self):
+        """Return the recorder counters"""
+        return {
+            'records': self.records,
+            'bytes_written': self.bytes_written,
+            'values_dropped': self.values_dropped
+        }
+
+
+def read_header(path):
+    """Check the header of a trace file and return its version"""
+    with open(path, 'rb') as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise ValueError(f"Not a chair trace: {path}")
+    magic, version = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Not a version {VERSION} chair trace: {path}")
+    return version
+
+
+class TraceReader:
+    """Iterate the records of a trace file through a memory map"""
+
+    def __init__(self, path):
+        read_header(path)
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __iter__(self):
+        data = self._map
+        end = len(data)
+        offset = HEADER.size
+        while offset + RECORD.size <= end:
+            received, timestamp, source, command_size, value_size = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+            if offset + command_size + value_size > end:
+                break  # Cut off by a crash while writing, the rest is unusable
+            command = data[offset:offset + command_size].decode()
+            offset += command_size
+            value = json.loads(data[offset:offset + value_size]) if value_size else None
+            offset += value_size
+            yield TraceRecord(received, None if math.isnan(timestamp) else timestamp,
+                              source, command, value)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ReplayClock:
+    """Clock that reads the receive time of the record being replayed"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+
+def replay(records, wheelchair, speed=1.0, histogram=None):
+    """
+    Feed trace records to a chair's handle_command.
+    speed is a multiple of the original pace, 0 replays as fast as possible.
+    Returns (records replayed, hex digest of the motor duties after each one).
+    """
+    clock = ReplayClock()
+    wheelchair.clock = clock.time
+    digest = hashlib.sha256()
+    first = None
+    start = time.perf_counter()
+    count = 0
+    for record in records:
+        if first is None:
+            first = record.received
+        if speed > 0:
+            delay = (record.received - first) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+        if wheelchair.ramp is not None and clock.now:
+            # The control loop ticks that ran between the two commands
+            wheelchair.ramp.advance(record.received - clock.now)
+        clock.now = record.received
+        if record.source == SOURCE_STATE:
+            if record.command == 'speed' and isinstance(record.value, int):
+                wheelchair.current_speed = record.value
+            continue
+
+        call_start = time.perf_counter()
+        wheelchair.handle_command(record.command, record.value)
+        if histogram is not None:
+            histogram.record(time.perf_counter() - call_start)
+        digest.update(json.dumps(sorted(wheelchair.motors.duties().items())).encode())
+        count += 1
+    return count, digest.hexdigest()
+
+
+def show(args):
+    """Print the records of a trace as JSON lines"""
+    with TraceReader(args.trace) as reader:
+        for index, record in enumerate(reader):
+            if args.limit and index >= args.limit:
+                break
+            entry = record._asdict()
+            entry['source'] = SOURCES[record.source] if record.source < len(SOURCES) else record.source
+            print(json.dumps(entry))
+
+
+def replay_trace(args):
+    """Replay a trace against the simulated GPIO and print a JSON summary"""
+    import chair
+    from chair_metrics import LatencyHistogram
+
+    speed = 0.0 if args.speed == 'max' else float(args.speed)
+    chair.kinematics.load()
+    # Without a chair id nothing is published, the chair only drives its motors
+    wheelchair = chair.Chair(os.path.join(tempfile.mkdtemp(prefix='chair-replay-'), 'chair_info.json'))
+    wheelchair.init_motors('sim')
+
+    histogram = LatencyHistogram('replay')
+    started = time.perf_counter()
+    with TraceReader(args.trace) as reader:
+        count, digest = replay(reader, wheelchair, speed, histogram)
+    elapsed = time.perf_counter() - started
+
+    result = {
+        'trace': args.trace,
+        'speed': args.speed,
+        'records': count,
+        'seconds': round(elapsed, 4),
+        'handle_command': histogram.summary(),
+        'motors': wheelchair.motors.stats(),
+        'final_duties': wheelchair.motors.duties(),
+        'movement': wheelchair.movement_history.stats(),
+        'digest': digest
+    }
+    print(json.dumps(result, indent=2))
+    if args.expect and args.expect != digest:
+        print(f"Digest mismatch, expected {args.expect}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def main():
+    """Inspect or replay a command trace"""
+    parser = argparse.ArgumentParser(description='Inspect or replay a chair command trace')
+    sub = parser.add_subparsers(dest='action', required=True)
+
+    show_parser = sub.add_parser('show', help='print records as JSON lines')
+    show_parser.add_argument('trace')
+    show_parser.add_argument('--limit', type=int, default=0)
+
+    replay_parser = sub.add_parser('replay', help='feed the trace through handle_command')
+    replay_parser.add_argument('trace')
+    replay_parser.add_argument('--speed', default='1', help="multiple of the original pace, or 'max'")
+    replay_parser.add_argument('--expect', default=None, help='digest the replay has to produce')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.action == 'show':
+        show(args)
+        return 0
+    return replay_trace(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,3 @@
+# test_integrated_system.py and test_light.py are scripts for real hardware and
+# Firebase, they run on import and are not pytest modules
+collect_ignore = ['test_integrated_system.py', 'test_light.py']
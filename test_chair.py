@@ -0,0 +1,54 @@
+"""
+Tests for the Chair in chair.py, on the simulated GPIO.
+Run with: python -m pytest -q
+"""
+import pytest
+
+import chair
+from chair_motors import CHANNELS
+
+
+@pytest.fixture
+def wheelchair(tmp_path):
+    wheelchair = chair.Chair(str(tmp_path / 'chair_info.json'), name='test')
+    wheelchair.init_motors('sim')
+    return wheelchair
+
+
+def test_close_stops_the_motors_when_the_control_thread_is_stuck(wheelchair, monkeypatch):
+    def stuck(fn, preempt=None, timeout=2.0):
+        raise TimeoutError('control thread busy')
+
+    monkeypatch.setattr(chair.scheduler, 'call', stuck)
+    wheelchair.handle_command('forward')
+    if wheelchair.ramp is not None:
+        wheelchair.ramp.advance(1.0)
+    assert wheelchair.motors.duties()['L_L'] > 0
+
+    wheelchair.close()
+    assert wheelchair.motors.duties() == {name: 0 for name in CHANNELS}
+    assert wheelchair.closed
+    assert not any(channel.running for channel in wheelchair.gpio.channels.values())
+
+
+def test_close_releases_the_pins_when_stopping_fails(wheelchair, monkeypatch):
+    def broken(fn, preempt=None, timeout=2.0):
+        raise RuntimeError('actor failed')
+
+    monkeypatch.setattr(chair.scheduler, 'call', broken)
+    with pytest.raises(RuntimeError):
+        wheelchair.close()
+    assert not any(channel.running for channel in wheelchair.gpio.channels.values())
+
+
+def test_command_cursor_survives_a_restart(tmp_path):
+    info_path = str(tmp_path / 'chair_info.json')
+    first = chair.Chair(info_path)
+    assert first.load_command_cursor() == (None, 0)
+    first.save_chair_info('ABCD1234', 'c1')
+    first.save_command_cursor('-N0002', 2000)
+
+    restarted = chair.Chair(info_path)
+    assert restarted.load_command_cursor() == ('-N0002', 2000)
+    assert restarted.load_chair_info() == ('ABCD1234', 'c1')
+    assert not (tmp_path / 'chair_info.json.tmp').exists()
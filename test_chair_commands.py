@@ -0,0 +1,310 @@
+"""
+Tests for the command scheduler, compactor and cursor in chair_commands.py.
+Run with: python -m pytest -q
+"""
+import threading
+import time
+
+import pytest
+
+from chair_commands import CommandCompactor, CommandCursor, CommandDecoder, CommandScheduler
+
+
+class Recorder:
+    """Command handler that remembers what it was called with"""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, command, value, timestamp):
+        self.calls.append((command, value))
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def handler():
+    return Recorder()
+
+
+@pytest.fixture
+def scheduler(handler):
+    scheduler = CommandScheduler(handler, max_age=2.0, clock=FakeClock())
+    yield scheduler
+    scheduler.close()
+
+
+def run_queued(scheduler, handler):
+    """Start the worker after queueing, so the queue is seen as one backlog"""
+    scheduler.start()
+    assert scheduler.wait_idle()
+    return handler.calls
+
+
+def test_commands_are_not_expired_before_the_clock_is_synced(scheduler, handler):
+    scheduler.submit('forward', timestamp=1)
+
+    assert scheduler.server_time_ms() is None
+    assert run_queued(scheduler, handler) == [('forward', None)]
+    assert scheduler.stats()['clock_synced'] == 0
+
+
+def test_old_commands_expire_once_the_clock_is_synced(scheduler, handler):
+    # Server clock 5s ahead of the local one, measured over a 20ms round trip
+    assert scheduler.sync_clock(1005000 + 10, 1000.0, 1000.02)
+    assert scheduler.clock_offset_ms == pytest.approx(5000)
+
+    scheduler.submit('forward', timestamp=1005000 - 3000)
+    scheduler.submit('backward', timestamp=1005000 - 1000)
+
+    assert run_queued(scheduler, handler) == [('backward', None)]
+    assert scheduler.stats()['expired'] == 1
+
+
+def test_late_stop_still_runs(scheduler, handler):
+    scheduler.sync_clock(1000000, 1000.0, 1000.0)
+    scheduler.submit('stop', timestamp=1)
+
+    assert run_queued(scheduler, handler) == [('stop', None)]
+
+
+def test_sync_clock_keeps_the_shortest_round_trip(scheduler):
+    assert scheduler.sync_clock(1000000, 999.99, 1000.01)
+    assert not scheduler.sync_clock(1009000, 999.9, 1000.1)
+    assert scheduler.sync_clock(1000500, 1000.0, 1000.002)
+    assert scheduler.clock_offset_ms == pytest.approx(499, abs=1e-6)
+    assert not scheduler.sync_clock(None, 1000.0, 1000.0)
+
+
+def test_latest_joystick_wins(scheduler, handler):
+    for x in range(5):
+        scheduler.submit('joystick', {'x': x, 'y': 50})
+    scheduler.submit('speed', 40)
+    scheduler.submit('speed', 60)
+
+    assert run_queued(scheduler, handler) == [('joystick', {'x': 4, 'y': 50}), ('speed', 60)]
+    assert scheduler.stats()['coalesced'] == 5
+
+
+def test_stop_preempts_queued_motion(scheduler, handler):
+    scheduler.submit('forward')
+    scheduler.submit('joystick', {'x': 0, 'y': 80})
+    scheduler.submit('speed', 70)
+    scheduler.submit('stop')
+
+    assert run_queued(scheduler, handler) == [('stop', None), ('speed', 70)]
+    assert scheduler.stats()['preempted'] == 2
+
+
+class FakeDatabase:
+    """Applies multi-path updates to a flat {path: value} dict"""
+
+    def __init__(self, paths=()):
+        self.values = dict(paths)
+        self.updates = []
+        self.failing = False
+        self.written = threading.Event()
+
+    def update(self, updates):
+        if self.failing:
+            raise ConnectionError('offline')
+        self.updates.append(updates)
+        for path, value in updates.items():
+            if value is None:
+                self.values.pop(path, None)
+            else:
+                self.values[path] = value
+        self.written.set()
+
+    def children(self, path):
+        return sorted(key[len(path) + 1:] for key in self.values if key.startswith(path + '/'))
+
+
+def seed_commands(database, compactor, count):
+    """Store count commands with ids that sort like push ids, oldest first"""
+    command_ids = [f'-N{i:04d}' for i in range(count)]
+    for i, command_id in enumerate(command_ids):
+        database.values[f'chairs/c1/commands/{command_id}'] = {'command': 'forward', 'timestamp': i}
+    compactor.seed(command_ids)
+    return command_ids
+
+
+def test_compact_keeps_the_newest_commands():
+    database = FakeDatabase()
+    compactor = CommandCompactor(database.update, 'chairs/c1/commands', window=10, batch=5)
+    command_ids = seed_commands(database, compactor, 30)
+
+    assert compactor.compact() == 20
+    assert len(database.updates) == 1
+    assert database.children('chairs/c1/commands') == command_ids[-10:]
+    assert database.values['chairs/c1/commands_ack'] == command_ids[-1]
+    assert compactor.stats() == {'commands_pruned': 20, 'compactions': 1, 'writes_failed': 0, 'stored': 10}
+
+
+def test_failed_prune_is_retried():
+    database = FakeDatabase()
+    compactor = CommandCompactor(database.update, 'chairs/c1/commands', window=5, batch=5)
+    command_ids = seed_commands(database, compactor, 15)
+    database.failing = True
+
+    assert compactor.compact() == 0
+    assert compactor.stats() == {'commands_pruned': 0, 'compactions': 0, 'writes_failed': 1, 'stored': 15}
+
+    database.failing = False
+    assert compactor.compact() == 10
+    assert database.children('chairs/c1/commands') == command_ids[-5:]
+
+
+def test_processed_prunes_on_the_worker_once_a_batch_is_full():
+    database = FakeDatabase()
+    compactor = CommandCompactor(database.update, 'chairs/c1/commands', window=5, batch=5)
+    command_ids = seed_commands(database, compactor, 9)
+
+    compactor.processed(command_ids[-1])
+    assert not database.written.wait(0.1)
+    compactor.processed('-N0009')
+    assert database.written.wait(2.0)
+    compactor.close()
+
+    assert compactor.stats()['commands_pruned'] == 5
+    assert database.values['chairs/c1/commands_ack'] == '-N0009'
+    assert not compactor._worker.is_alive()
+
+
+def test_restore_ignores_other_paths_of_a_combined_update():
+    compactor = CommandCompactor(lambda updates: None, 'chairs/c1/commands', window=1, batch=1)
+    compactor.seed(['a', 'b', 'c'])
+    updates = compactor.prune_updates()
+    updates['chairs/c1/status'] = 'ready'
+    updates['chairs/c1/commands_extra'] = None
+
+    compactor.restore(updates)
+    assert compactor.stats()['stored'] == 3
+    assert compactor.stats()['commands_pruned'] == 0
+
+
+class Event:
+    """Listener event with the fields of firebase_admin.db.Event"""
+
+    def __init__(self, event_type, path, data):
+        self.event_type = event_type
+        self.path = path
+        self.data = data
+
+
+def no_fetch(command_id):
+    return None
+
+
+def test_cursor_only_moves_forward_and_saves_when_it_moved():
+    saves = []
+    cursor = CommandCursor(lambda key, timestamp: saves.append((key, timestamp)), save_interval=60)
+    assert cursor.is_new('-N0001')
+
+    cursor.advance('-N0002', 2000)
+    cursor.advance('-N0001', 1000)
+    assert (cursor.key, cursor.timestamp) == ('-N0002', 2000)
+    assert not cursor.is_new('-N0002')
+    assert cursor.is_new('-N0003')
+
+    cursor.save()
+    assert saves[-1] == ('-N0002', 2000)
+    # Within the save interval, and a command without a timestamp keeps the last one
+    cursor.advance('-N0003', None)
+    assert saves[-1] == ('-N0002', 2000)
+    cursor.save()
+    cursor.save()
+    assert saves[-2:] == [('-N0002', 2000), ('-N0003', 2000)]
+
+
+def test_failed_cursor_save_is_not_raised():
+    def fail(key, timestamp):
+        raise OSError('read-only file system')
+
+    cursor = CommandCursor(fail)
+    cursor.advance('-N0001', 1000)
+    cursor.save()
+    assert cursor.key == '-N0001'
+
+
+def test_restart_does_not_rerun_the_handled_command():
+    commands = {
+        '-N0001': {'command': 'stop', 'timestamp': 1000},
+        '-N0002': {'command': 'forward', 'timestamp': 2000}
+    }
+    saved = {}
+    cursor = CommandCursor(lambda key, timestamp: saved.update(key=key, timestamp=timestamp))
+    decoder = CommandDecoder(no_fetch, cursor=cursor)
+    for command_id, command in decoder.decode(Event('put', '/', commands)):
+        cursor.advance(command_id, command['timestamp'])
+    cursor.save()
+    assert saved == {'key': '-N0002', 'timestamp': 2000}
+
+    # Without the cursor the snapshot after a restart starts the chair again
+    ready = CommandDecoder(no_fetch).decode(Event('put', '/', commands))
+    assert [command_id for command_id, _ in ready] == ['-N0002']
+
+    restarted = CommandDecoder(no_fetch, cursor=CommandCursor(lambda key, timestamp: None,
+                                                              saved['key'], saved['timestamp']))
+    assert restarted.decode(Event('put', '/', commands)) == []
+    assert restarted.decode(Event('put', '/-N0002', commands['-N0002'])) == []
+    assert restarted.decode(Event('put', '/-N0003', {'command': 'left', 'timestamp': 3000})) == [
+        ('-N0003', {'command': 'left', 'timestamp': 3000})]
+
+
+def test_coalescing_stays_within_a_handler(scheduler, handler):
+    other = Recorder()
+    scheduler.submit('joystick', {'x': 1, 'y': 0})
+    scheduler.submit('joystick', {'x': 2, 'y': 0}, handler=other)
+    scheduler.submit('stop')
+    run_queued(scheduler, handler)
+
+    assert handler.calls == [('stop', None)]
+    assert other.calls == [('joystick', {'x': 2, 'y': 0})]
+
+
+def test_call_runs_on_the_actor_thread(scheduler):
+    scheduler.start()
+    assert scheduler.call(threading.current_thread) is scheduler._thread
+    with pytest.raises(ZeroDivisionError):
+        scheduler.call(lambda: 1 / 0)
+    assert scheduler.stats()['calls'] == 2
+
+
+def test_call_preempts_queued_motion_of_its_handler(scheduler, handler):
+    # Hold the actor so everything below is queued when it drains
+    held, release = threading.Event(), threading.Event()
+    scheduler.submit('start', handler=lambda command, value, timestamp: held.set() or release.wait())
+    scheduler.start()
+    assert held.wait(2)
+    other = Recorder()
+    scheduler.submit('forward')
+    scheduler.submit('speed', 30)
+    scheduler.submit('left', handler=other)
+    caller = threading.Thread(target=scheduler.call, args=(lambda: None,), kwargs={'preempt': handler})
+    caller.start()
+    while len(scheduler._ingest) < 4:
+        time.sleep(0.001)
+    release.set()
+    caller.join(2)
+    assert scheduler.wait_idle()
+
+    assert handler.calls == [('speed', 30)]
+    assert other.calls == [('left', None)]
+    assert scheduler.stats()['preempted'] == 1
+
+
+def test_call_times_out_while_the_actor_is_stuck(scheduler):
+    release = threading.Event()
+    scheduler.submit('forward', handler=lambda command, value, timestamp: release.wait())
+    scheduler.start()
+    with pytest.raises(TimeoutError):
+        scheduler.call(lambda: None, timeout=0.1)
+    release.set()
+    assert scheduler.wait_idle()
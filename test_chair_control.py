@@ -0,0 +1,71 @@
+"""
+Tests for the motor ramp and control loop in chair_control.py, on the simulated GPIO.
+Run with: python -m pytest -q
+"""
+import threading
+
+import pytest
+
+from chair_control import ControlLoop, RampedMotors, slew
+from chair_gpio import SimulatedGPIOBackend
+from chair_motors import CHANNELS, MotorDriver
+
+
+@pytest.fixture
+def ramp():
+    gpio = SimulatedGPIOBackend()
+    driver = MotorDriver({name: gpio.pwm(pin, 1000) for pin, name in enumerate(CHANNELS)})
+    return RampedMotors(driver, rate=100, acceleration=200, deceleration=400)
+
+
+def test_slew_accelerates_at_the_limit():
+    assert slew(0, 50, 200, 400, 0.01) == 2
+    assert slew(49, 50, 200, 400, 0.01) == 50
+    assert slew(-10, -50, 200, 400, 0.01) == -12
+
+
+def test_slew_brakes_through_zero_before_reversing():
+    assert slew(50, 20, 200, 400, 0.01) == 46
+    assert slew(3, -40, 200, 400, 0.01) == 0
+    assert slew(0, -40, 200, 400, 0.01) == -2
+
+
+def test_ramp_reaches_targets_at_the_acceleration_limit(ramp):
+    ramp.drive(40, -20)
+    ramp.step(0.1)
+    assert ramp.duties() == {'L_R': 0, 'L_L': 20, 'R_R': 0, 'R_L': 20}
+    ramp.advance(0.1)
+    assert ramp.duties() == {'L_R': 0, 'L_L': 40, 'R_R': 0, 'R_L': 20}
+    assert ramp.stats()['limited_steps'] == 10
+
+
+def test_stop_brakes_and_halt_stops_at_once(ramp):
+    ramp.drive(60, 60)
+    ramp.advance(1.0)
+    ramp.stop()
+    ramp.step(0.05)
+    assert ramp.duties()['L_L'] == 40
+    ramp.halt()
+    assert ramp.duties() == {name: 0 for name in CHANNELS}
+    assert ramp.targets() == (0, 0)
+
+
+def test_control_loop_halts_the_motors_when_a_step_raises(ramp):
+    ramp.drive(50, 50)
+    ticks = []
+
+    def step(seconds):
+        ticks.append(seconds)
+        if len(ticks) == 3:
+            raise RuntimeError('encoder fault')
+        ramp.step(seconds)
+
+    loop = ControlLoop(step, rate=200, halt=ramp.halt)
+    thread = threading.Thread(target=loop.run)
+    thread.start()
+    thread.join(2)
+
+    assert not thread.is_alive()
+    assert len(ticks) == 3
+    assert loop.stats()['step_errors'] == 1
+    assert ramp.duties() == {name: 0 for name in CHANNELS}
@@ -0,0 +1,92 @@
+"""
+Tests for the in-memory datastore in chair_datastore.py.
+Run with: python -m pytest -q
+"""
+import time
+
+import pytest
+
+from chair_datastore import create_datastore
+
+
+@pytest.fixture
+def store():
+    store = create_datastore('memory', latency=0, jitter=0)
+    yield store
+    store.close()
+
+
+def listen(store, path):
+    """Listen at path and return the list the events are appended to"""
+    events = []
+    store.reference(path).listen(events.append)
+    assert store.wait_idle()
+    return events
+
+
+def test_server_timestamps_are_resolved_on_write(store):
+    before = int(time.time() * 1000)
+    store.reference('chairs/c1').set({'status': 'online', 'created_at': {'.sv': 'timestamp'}})
+    store.reference('chairs/c1').update({'last_seen': {'.sv': 'timestamp'}})
+    after = int(time.time() * 1000)
+
+    chair = store.reference('chairs/c1').get()
+    assert chair['status'] == 'online'
+    assert before <= chair['created_at'] <= after
+    assert before <= chair['last_seen'] <= after
+
+
+def test_multi_path_update_sends_a_patch_to_the_parent_listener(store):
+    commands = store.reference('chairs/c1/commands')
+    commands.child('a').set({'command': 'forward', 'timestamp': 1})
+    commands.child('b').set({'command': 'stop', 'timestamp': 2})
+    events = listen(store, 'chairs/c1/commands')
+    assert [(e.event_type, e.path) for e in events] == [('put', '/')]
+
+    store.reference('/').update({
+        'chairs/c1/commands/a': None,
+        'chairs/c1/commands/c': {'command': 'left', 'timestamp': 3},
+        'chairs/c1/commands_ack': 'b',
+        'chairs/c1/status': 'ready'
+    })
+    assert store.wait_idle()
+
+    assert len(events) == 2
+    assert events[1].event_type == 'patch'
+    assert events[1].path == '/'
+    assert events[1].data == {'a': None, 'c': {'command': 'left', 'timestamp': 3}}
+    assert sorted(commands.get()) == ['b', 'c']
+
+
+def test_deleting_the_last_child_removes_empty_parents(store):
+    store.reference('chairs/c1/commands/a').set({'command': 'forward'})
+    store.reference('/').update({'chairs/c1/commands/a': None})
+    assert store.reference('chairs').get() is None
+
+
+def test_shallow_get_returns_only_the_keys(store):
+    commands = store.reference('chairs/c1/commands')
+    commands.child('a').set({'command': 'forward', 'timestamp': 1})
+    commands.child('b').set({'command': 'stop', 'timestamp': 2})
+    store.reference('chairs/c1/status').set('online')
+
+    assert commands.get(shallow=True) == {'a': True, 'b': True}
+    assert store.reference('chairs/c1').get(shallow=True) == {'commands': True, 'status': 'online'}
+
+
+def test_order_by_child_start_at(store):
+    commands = store.reference('chairs/c1/commands')
+    for key, timestamp in (('d', 40), ('a', 10), ('c', 30), ('b', 20), ('e', 30)):
+        commands.child(key).set({'command': 'forward', 'timestamp': timestamp})
+    commands.child('f').set({'command': 'stop'})
+
+    result = commands.order_by_child('timestamp').start_at(30).get()
+    assert list(result) == ['c', 'e', 'd']
+    assert result['d'] == {'command': 'forward', 'timestamp': 40}
+
+
+def test_push_keys_sort_in_creation_order(store):
+    commands = store.reference('chairs/c1/commands')
+    keys = [commands.push({'command': 'forward', 'timestamp': i}).key for i in range(20)]
+    assert keys == sorted(keys)
+    assert list(commands.order_by_key().get()) == keys
@@ -0,0 +1,107 @@
+"""
+Tests for the sysfs hardware PWM backend in chair_gpio.py, on a fake sysfs tree.
+Run with: python -m pytest -q
+"""
+import os
+import shutil
+
+import pytest
+
+import chair_gpio
+from chair_gpio import SimulatedGPIOBackend, SysfsPWMBackend, create_fake_sysfs_pwm, read_attribute
+
+FREQUENCY = 1000     # Hz
+PERIOD_NS = 1000000  # 1ms
+
+
+@pytest.fixture
+def sysfs(tmp_path, monkeypatch):
+    """Fake pwmchip0 with 4 channels, none exported, that exports like the kernel does"""
+    root = create_fake_sysfs_pwm(str(tmp_path), chips=(4,))
+    chip_path = os.path.join(root, 'pwmchip0')
+    for channel in range(4):
+        shutil.rmtree(os.path.join(chip_path, f'pwm{channel}'))
+
+    writes = []
+    write_attribute = chair_gpio.write_attribute
+
+    def kernel_write(path, name, value):
+        writes.append((os.path.relpath(path, root), name, str(value)))
+        write_attribute(path, name, value)
+        if name == 'export':
+            channel_path = os.path.join(path, f'pwm{value}')
+            os.makedirs(channel_path)
+            for attribute, initial in (('period', 0), ('duty_cycle', 0), ('enable', 0)):
+                write_attribute(channel_path, attribute, initial)
+
+    monkeypatch.setattr(chair_gpio, 'write_attribute', kernel_write)
+    return root, writes
+
+
+@pytest.fixture
+def backend(sysfs):
+    root, _ = sysfs
+    backend = SysfsPWMBackend(root, channels={17: (0, 0), 27: (0, 1)}, outputs=SimulatedGPIOBackend())
+    yield backend
+    backend.cleanup()
+
+
+def channel(root, number):
+    return os.path.join(root, 'pwmchip0', f'pwm{number}')
+
+
+def test_start_exports_the_channel_and_sets_period_then_enable(sysfs, backend):
+    root, writes = sysfs
+    pwm = backend.pwm(27, FREQUENCY)
+    pwm.start(0)
+
+    assert writes == [
+        ('pwmchip0', 'export', '1'),
+        ('pwmchip0/pwm1', 'duty_cycle', '0'),
+        ('pwmchip0/pwm1', 'period', str(PERIOD_NS)),
+        ('pwmchip0/pwm1', 'enable', '1')
+    ]
+    assert read_attribute(channel(root, 1), 'period') == str(PERIOD_NS)
+    assert read_attribute(channel(root, 1), 'enable') == '1'
+    assert not os.path.exists(channel(root, 0))
+
+
+@pytest.mark.parametrize('duty, duty_ns', [(0, 0), (50, PERIOD_NS // 2), (100, PERIOD_NS), (120, PERIOD_NS)])
+def test_change_duty_cycle_writes_nanoseconds(sysfs, backend, duty, duty_ns):
+    root, _ = sysfs
+    pwm = backend.pwm(17, FREQUENCY)
+    pwm.start(30)
+    pwm.ChangeDutyCycle(duty)
+
+    assert read_attribute(channel(root, 0), 'duty_cycle') == str(duty_ns)
+    assert pwm.duty == min(duty, 100)
+
+
+def test_stop_disables_the_channel_and_cleanup_unexports_it(sysfs, backend):
+    root, writes = sysfs
+    pwm = backend.pwm(17, FREQUENCY)
+    pwm.start(80)
+    pwm.stop()
+
+    assert read_attribute(channel(root, 0), 'duty_cycle') == '0'
+    assert read_attribute(channel(root, 0), 'enable') == '0'
+    assert not pwm.running
+
+    backend.cleanup()
+    assert writes[-1] == ('pwmchip0', 'unexport', '0')
+
+
+def test_exported_channels_are_not_exported_again(tmp_path):
+    root = create_fake_sysfs_pwm(str(tmp_path), chips=(4,))
+    backend = SysfsPWMBackend(root, channels={17: (0, 2)}, outputs=SimulatedGPIOBackend())
+    backend.pwm(17, FREQUENCY).start(50)
+
+    with open(os.path.join(root, 'pwmchip0', 'export')) as f:
+        assert f.read() == '\n'
+    assert read_attribute(channel(root, 2), 'duty_cycle') == str(PERIOD_NS // 2)
+    backend.cleanup()
+
+
+def test_pins_without_a_channel_are_rejected(backend):
+    with pytest.raises(ValueError):
+        backend.pwm(5, FREQUENCY)
@@ -0,0 +1,76 @@
+"""
+Tests for the kinematics lookup table in chair_kinematics.py.
+Run with: python -m pytest -q
+"""
+import pytest
+
+from chair_kinematics import DIRECTION_COORDS, KinematicsTable, direction_duties, mix_joystick
+
+# Without NumPy there is no table, lookups compute the mix themselves
+pytest.importorskip('numpy')
+
+MIN_SPEED = 20
+MAX_SPEED = 100
+SPEEDS = (MIN_SPEED, 37, 50, 83, MAX_SPEED)
+
+
+@pytest.fixture(scope='module')
+def cache_path(tmp_path_factory):
+    return str(tmp_path_factory.mktemp('kinematics') / 'table.npz')
+
+
+@pytest.fixture(scope='module')
+def table(cache_path):
+    return KinematicsTable(MIN_SPEED, MAX_SPEED, cache_path=cache_path)
+
+
+def test_lookup_matches_mix_on_every_integer_position(table):
+    mismatches = []
+    for x in range(-100, 101):
+        for y in range(-100, 101):
+            for speed in SPEEDS:
+                left, right, direction, angle, magnitude = table.lookup(x, y, speed)
+                expected = mix_joystick(x, y, speed, MIN_SPEED)
+                # Duties are stored rounded to hundredths
+                if (direction != expected[2] or abs(left - expected[0]) > 0.0051
+                        or abs(right - expected[1]) > 0.0051
+                        or angle != pytest.approx(expected[3]) or magnitude != pytest.approx(expected[4])):
+                    mismatches.append((x, y, speed))
+    assert mismatches == []
+
+
+def test_cached_table_matches_the_built_one(table, cache_path):
+    cached = KinematicsTable(MIN_SPEED, MAX_SPEED, cache_path=cache_path)
+    for x, y in ((5, 0), (-100, 1), (37, -64), (0, -5)):
+        assert cached.lookup(x, y, 50) == table.lookup(x, y, 50)
+
+
+def test_lookup_before_the_table_is_loaded_computes_the_mix():
+    cold = KinematicsTable(MIN_SPEED, MAX_SPEED, cache_path=None, preload=False)
+    for x, y in ((5, 0), (-5, 0), (0, 5), (5, 5), (4, 4), (-100, -1)):
+        assert cold.lookup(x, y, 50) == mix_joystick(x, y, 50, MIN_SPEED)
+
+
+@pytest.mark.parametrize('x, y', [(4.9, 4.9), (5.2, 0.0), (-0.4, 7.5), (99.6, -0.2), (150, 3)])
+def test_off_grid_positions_keep_direction_and_deadzone(table, x, y):
+    left, right, direction, _, _ = table.lookup(x, y, 50)
+    expected = mix_joystick(x, y, 50, MIN_SPEED)
+    assert direction == expected[2]
+    assert left == pytest.approx(expected[0], abs=1.0)
+    assert right == pytest.approx(expected[1], abs=1.0)
+
+
+def test_coarse_grid_keeps_directions():
+    coarse = KinematicsTable(MIN_SPEED, MAX_SPEED, step=4, cache_path=None)
+    for x in range(-100, 101):
+        for y in (-7, -5, -1, 0, 1, 3, 5, 50):
+            assert coarse.lookup(x, y, 50)[2] == mix_joystick(x, y, 50, MIN_SPEED)[2], (x, y)
+
+
+def test_direction_duties_keep_the_tuned_turns():
+    assert direction_duties('forward', 60) == (60, 60)
+    assert direction_duties('right', 60) == (30, 60)
+    assert direction_duties('forward-left', 60) == (60, pytest.approx(18))
+    assert direction_duties('backward-right', 60) == (pytest.approx(-18), -60)
+    assert set(DIRECTION_COORDS) == {'stop', 'forward', 'backward', 'left', 'right', 'forward-left',
+                                     'forward-right', 'backward-left', 'backward-right'}
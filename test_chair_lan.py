@@ -0,0 +1,164 @@
+"""
+Tests for the LAN command channel in chair_lan.py, on loopback.
+Run with: python -m pytest -q
+"""
+import socket
+import time
+
+import pytest
+
+import chair_lan
+from chair_lan import LanClient, LanCommandServer, load_pairing_secret, pairing_key, seal
+
+KEY = pairing_key('chair-1', '00' * 32)
+
+
+def wait_for(condition, timeout=2.0):
+    """Poll until condition() holds, False when it never did"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+class Chair:
+    """Records what the server hands to the chair"""
+
+    def __init__(self):
+        self.commands = []
+        self.links = []
+
+    def submit(self, command, value=None):
+        self.commands.append((command, value))
+
+    def link_changed(self, up):
+        self.links.append(up)
+
+
+@pytest.fixture
+def chair():
+    return Chair()
+
+
+@pytest.fixture
+def server(chair):
+    server = LanCommandServer(KEY, chair.submit, port=0, host='127.0.0.1', link_timeout=0.3,
+                              on_link_change=chair.link_changed)
+    server.start()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def raw():
+    """Socket for sending hand-made datagrams"""
+    raw = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    raw.settimeout(0.2)
+    yield raw
+    raw.close()
+
+
+def connect(server, key=KEY):
+    client = LanClient(key, server.address)
+    client.connect()
+    return client
+
+
+def test_commands_are_acked_and_submitted(server, chair):
+    client = connect(server)
+    assert client.request('joystick', {'x': 10, 'y': 50}) > 0
+    client.close()
+
+    assert chair.commands == [('joystick', {'x': 10, 'y': 50})]
+    assert server.stats()['commands_received'] == 1
+
+
+def test_datagrams_with_a_bad_mac_are_dropped(server, chair, raw):
+    client = connect(server)
+    # Right session and sequence, but sealed with the pairing key instead of the session key
+    raw.sendto(seal(KEY, {'type': 'command', 'session': client.session_id, 'seq': 1,
+                          'command': 'forward'}), server.address)
+    raw.sendto(seal(pairing_key('chair-1', 'ff' * 32), {'type': 'hello', 'nonce': 'aa' * 16}),
+               server.address)
+    raw.sendto(b'not a datagram', server.address)
+    with pytest.raises(socket.timeout):
+        raw.recvfrom(2048)
+    client.close()
+
+    assert wait_for(lambda: server.stats()['rejected_auth'] == 3)
+    assert chair.commands == []
+    assert server.stats()['sessions'] == 1
+
+
+def test_replayed_commands_are_dropped(server, chair, raw):
+    client = connect(server)
+    client.wait_ack(client.send('forward'))
+    client.wait_ack(client.send('left'))
+    client.close()
+
+    # A copy of the first command, from another address
+    raw.sendto(seal(client._session_key, {'type': 'command', 'command': 'forward',
+                                          'session': client.session_id, 'seq': 1}), server.address)
+    assert wait_for(lambda: server.stats()['rejected_sequence'] == 1)
+    assert chair.commands == [('forward', None), ('left', None)]
+
+
+def test_replayed_hello_opens_no_session(server, raw):
+    hello = seal(KEY, {'type': 'hello', 'nonce': 'ab' * 16})
+    raw.sendto(hello, server.address)
+    raw.recvfrom(2048)
+    raw.sendto(hello, server.address)
+    with pytest.raises(socket.timeout):
+        raw.recvfrom(2048)
+
+    assert server.stats()['sessions'] == 1
+    assert server.stats()['rejected_sequence'] == 1
+
+
+def test_new_sessions_do_not_evict_one_in_use(server, chair, raw, monkeypatch):
+    monkeypatch.setattr(chair_lan, 'MAX_SESSIONS', 2)
+    driver = connect(server)
+    driver.wait_ack(driver.ping())
+    idle = connect(server)
+
+    # The idle session is the oldest one without traffic, the next hello replaces it
+    driver.wait_ack(driver.ping())
+    connect(server).close()
+    assert server.stats()['sessions'] == 2
+
+    # Now the driving session is the least recently used one, but still active
+    raw.sendto(seal(KEY, {'type': 'hello', 'nonce': 'cd' * 16}), server.address)
+    with pytest.raises(socket.timeout):
+        raw.recvfrom(2048)
+    assert server.stats()['rejected_busy'] == 1
+
+    assert driver.request('stop') > 0
+    assert chair.commands == [('stop', None)]
+    driver.close()
+    idle.close()
+
+
+def test_link_falls_back_when_the_client_goes_quiet(server, chair):
+    client = connect(server)
+    client.wait_ack(client.ping())
+    assert server.active()
+    assert server.claims('forward')
+    assert not server.claims('stop', priority_commands=('stop', 'start'))
+
+    assert wait_for(lambda: chair.links == [True, False])
+    assert not server.active()
+    assert not server.claims('forward')
+    assert server.stats()['link_drops'] == 1
+    assert server.stats()['firebase_ignored'] == 1
+    client.close()
+
+
+def test_pairing_secret_is_created_once_and_owner_only(tmp_path):
+    path = str(tmp_path / 'lan_secret')
+    secret, created = load_pairing_secret(path)
+    assert created
+    assert len(bytes.fromhex(secret)) == 32
+    assert (tmp_path / 'lan_secret').stat().st_mode & 0o777 == 0o600
+    assert load_pairing_secret(path) == (secret, False)
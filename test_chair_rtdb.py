@@ -0,0 +1,213 @@
+"""
+Tests for the streaming Realtime Database client in chair_rtdb.py, against
+RealtimeServer and a scripted local server.
+Run with: python -m pytest -q
+"""
+import asyncio
+import json
+import time
+
+import pytest
+
+import chair_rtdb
+from chair_datastore import create_datastore
+from chair_rtdb import HttpError, RealtimeDatabase, RealtimeServer
+
+
+async def wait_for(condition, timeout=2.0):
+    """Poll until condition() holds, False when it never did"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.005)
+    return True
+
+
+class ScriptedServer:
+    """Answers each request with the next response of a script, None drops the connection"""
+
+    def __init__(self, script):
+        self._script = list(script)
+        self.requests = []  # (method, target)
+        self._server = None
+        self.url = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, '127.0.0.1', 0)
+        self.url = f'http://127.0.0.1:{self._server.sockets[0].getsockname()[1]}'
+        return self
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+                method, target, _ = request_line.decode().split(' ', 2)
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b''):
+                        break
+                    name, _, value = line.decode().partition(':')
+                    if name.lower() == 'content-length':
+                        length = int(value)
+                await reader.readexactly(length)
+                self.requests.append((method, target))
+
+                response = self._script.pop(0)
+                if response is None:
+                    return
+                status, result = response
+                payload = json.dumps(result).encode()
+                writer.write(f'HTTP/1.1 {status} OK\r\nContent-Length: {len(payload)}\r\n\r\n'.encode()
+                             + payload)
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+def run(scenario):
+    """Run scenario(database) against a RealtimeServer over an empty memory datastore"""
+    async def main():
+        store = create_datastore('memory', latency=0, jitter=0)
+        server = await RealtimeServer(store).start()
+        database = RealtimeDatabase(server.url)
+        try:
+            return await scenario(database, store)
+        finally:
+            await database.close()
+            await server.close()
+    return asyncio.run(main())
+
+
+def test_rest_requests_reach_the_store():
+    async def scenario(database, store):
+        await database.set('/chairs/c1', {'name': 'one', 'current_speed': 50})
+        await database.update('/chairs/c1', {'current_speed': 70, 'status': 'online'})
+        key = await database.push('/chairs/c1/commands', {'command': 'stop', 'timestamp': 1})
+        await database.delete('/chairs/c1/name')
+        return key, await database.get('/chairs/c1'), await database.get('/chairs/c1', shallow=True)
+
+    key, chair, shallow = run(scenario)
+    assert chair == {'current_speed': 70, 'status': 'online',
+                     'commands': {key: {'command': 'stop', 'timestamp': 1}}}
+    assert shallow == {'current_speed': 70, 'status': 'online', 'commands': True}
+
+
+def test_requests_reuse_pooled_connections():
+    async def scenario(database, store):
+        for speed in range(5):
+            await database.update('/chairs/c1', {'current_speed': speed})
+        return database.stats()
+
+    stats = run(scenario)
+    assert stats['connections_opened'] == 1
+    assert stats['requests_reused'] == 4
+
+
+def test_stream_starts_at_the_cursor():
+    async def scenario(database, store):
+        store.reference('/chairs/c1/commands').set({
+            'a': {'command': 'forward', 'timestamp': 10},
+            'b': {'command': 'left', 'timestamp': 20},
+            'c': {'command': 'stop', 'timestamp': 30}
+        })
+        events = []
+        database.listen('/chairs/c1/commands', events.append,
+                        {'orderBy': json.dumps('timestamp'), 'startAt': json.dumps(20)})
+        assert await wait_for(lambda: len(events) == 1)
+
+        commands = store.reference('/chairs/c1/commands')
+        commands.child('old').set({'command': 'right', 'timestamp': 5})
+        commands.child('d').set({'command': 'forward', 'timestamp': 40})
+        commands.update({'e': {'command': 'backward', 'timestamp': 50}})
+        assert await wait_for(lambda: len(events) == 3)
+        await asyncio.sleep(0.05)
+        return events
+
+    snapshot, put, patch = run(scenario)
+    assert (snapshot.event_type, snapshot.path) == ('put', '/')
+    assert sorted(snapshot.data) == ['b', 'c']
+    assert (put.event_type, put.path, put.data) == ('put', '/d', {'command': 'forward', 'timestamp': 40})
+    assert (patch.event_type, patch.path) == ('patch', '/')
+    assert patch.data == {'e': {'command': 'backward', 'timestamp': 50}}
+
+
+@pytest.mark.parametrize('method, call, sent', [
+    ('POST', lambda database: database.push('/commands', {'command': 'stop'}), 1),
+    ('PUT', lambda database: database.set('/current_speed', 50), 2),
+])
+def test_only_safe_requests_are_repeated_after_a_dropped_connection(method, call, sent):
+    async def main():
+        # The first request leaves an idle connection, which drops the next one
+        server = await ScriptedServer([(200, 'ok'), None, (200, {'name': 'k'})]).start()
+        database = RealtimeDatabase(server.url)
+        try:
+            await database.get('/')
+            try:
+                await call(database)
+            except ConnectionError:
+                pass
+        finally:
+            await database.close()
+            await server.close()
+        return [request for request, _ in server.requests[1:]]
+
+    assert asyncio.run(main()) == [method] * sent
+
+
+@pytest.fixture
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(chair_rtdb, 'REQUEST_RETRIES', 2)
+    monkeypatch.setattr(chair_rtdb, 'RETRY_DELAY', 0.001)
+
+
+def run_scripted(script, call):
+    """Run call(database) against a ScriptedServer, return (result or error, methods sent, stats)"""
+    async def main():
+        server = await ScriptedServer(script).start()
+        database = RealtimeDatabase(server.url)
+        try:
+            result = await call(database)
+        except (HttpError, ConnectionError) as e:
+            result = e
+        finally:
+            await database.close()
+            await server.close()
+        return result, [method for method, _ in server.requests], database.stats()
+    return asyncio.run(main())
+
+
+def test_unavailable_responses_are_retried_up_to_the_limit(fast_retries):
+    unavailable = (503, {'error': 'unavailable'})
+    result, sent, stats = run_scripted([unavailable] * 3, lambda database: database.set('/speed', 50))
+    assert isinstance(result, HttpError) and result.status == 503
+    assert sent == ['PUT'] * 3
+    assert (stats['requests_retried'], stats['requests_failed']) == (2, 1)
+
+    result, sent, stats = run_scripted([unavailable, unavailable, (200, 50)],
+                                       lambda database: database.get('/speed'))
+    assert result == 50
+    assert sent == ['GET'] * 3
+
+
+def test_client_errors_are_not_retried(fast_retries):
+    result, sent, _ = run_scripted([(400, {'error': 'bad'})], lambda database: database.set('/speed', 50))
+    assert isinstance(result, HttpError) and result.status == 400
+    assert sent == ['PUT']
+
+
+def test_push_is_retried_only_when_refused(fast_retries):
+    push = lambda database: database.push('/commands', {'command': 'stop'})
+    result, sent, _ = run_scripted([(503, {'error': 'unavailable'}), (200, {'name': 'k'})], push)
+    assert (result, sent) == ('k', ['POST', 'POST'])
+
+    result, sent, _ = run_scripted([None, (200, {'name': 'k'})], push)
+    assert isinstance(result, ConnectionError)
+    assert sent == ['POST']
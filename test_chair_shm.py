@@ -0,0 +1,106 @@
+"""
+Tests for the seqlocked shared memory slots in chair_shm.py.
+Run with: python -m pytest -q
+"""
+import pytest
+
+import chair_shm
+from chair_shm import SEQUENCE, SLOT_SIZE, ChairSharedMemory, CommandInbox, CommandMailbox, SeqlockSlot
+
+
+class TearingBuffer(bytearray):
+    """Buffer whose next payload copies come back corrupted, like a copy overlapping a write"""
+
+    tears = 0
+
+    def __getitem__(self, index):
+        data = super().__getitem__(index)
+        if isinstance(index, slice) and self.tears:
+            self.tears -= 1
+            return bytes([data[0] ^ 0xFF]) + data[1:]
+        return data
+
+
+@pytest.fixture
+def slot():
+    return SeqlockSlot(TearingBuffer(SLOT_SIZE), 0)
+
+
+def test_write_read_round_trip(slot):
+    assert slot.read() == (None, None)
+    slot.write(b'{"motion":null}')
+    slot.write(b'second')
+
+    assert slot.read() == (4, b'second')
+    assert slot.sequence() == 4
+    assert slot.stats() == {'writes': 2, 'reads': 1, 'retries': 0, 'torn': 0}
+    with pytest.raises(ValueError):
+        slot.write(b'x' * SLOT_SIZE)
+
+
+def test_torn_copy_is_counted_and_read_again(slot):
+    slot.write(b'payload')
+    slot._buffer.tears = 2
+
+    assert slot.read() == (2, b'payload')
+    assert slot.stats()['torn'] == 2
+    assert slot.stats()['reads'] == 1
+
+
+def test_read_gives_up_while_the_writer_never_finishes(slot, monkeypatch):
+    monkeypatch.setattr(chair_shm, 'READ_RETRIES', 5)
+    slot.write(b'payload')
+    SEQUENCE.pack_into(slot._buffer, 0, 3)  # A write in progress
+
+    assert slot.read() == (None, None)
+    assert slot.stats()['retries'] == 5
+
+
+def test_a_new_writer_continues_the_sequence(slot):
+    slot.write(b'first')
+    slot.write(b'second')
+    restarted = SeqlockSlot(slot._buffer, 0)
+    restarted.write(b'third')
+    assert slot.read() == (6, b'third')
+
+
+def test_mailbox_keeps_the_latest_motion_and_speed(slot):
+    mailbox, inbox = CommandMailbox(slot), CommandInbox(slot)
+    mailbox.submit('forward')
+    mailbox.submit('speed', 30)
+    mailbox.submit('joystick', {'x': 10, 'y': 60}, 1700000000000)
+    mailbox.submit('speed', 40)
+    mailbox.submit('left')
+
+    assert inbox.poll() == [('speed', 40, None), ('left', None, None)]
+    assert inbox.commands_skipped == 3
+    assert inbox.poll() == []
+
+    mailbox.submit('stop')
+    assert inbox.poll() == [('stop', None, None)]
+    assert inbox.commands_skipped == 3
+    assert not inbox.closed
+
+
+def test_close_reaches_the_inbox(slot):
+    mailbox, inbox = CommandMailbox(slot), CommandInbox(slot)
+    mailbox.submit('forward')
+    mailbox.submit('stop')
+    mailbox.close()
+
+    assert inbox.poll() == [('stop', None, None)]
+    assert inbox.closed
+
+
+def test_slots_are_shared_between_attached_segments():
+    owner = ChairSharedMemory()
+    attached = ChairSharedMemory(owner.name)
+    try:
+        CommandMailbox(owner.commands).submit('backward')
+        attached.state.write(b'state')
+
+        assert CommandInbox(attached.commands).poll() == [('backward', None, None)]
+        assert owner.state.read()[1] == b'state'
+    finally:
+        attached.close()
+        owner.close()
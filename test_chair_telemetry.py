@@ -0,0 +1,38 @@
+"""
+Tests for the telemetry publisher in chair_telemetry.py.
+Run with: python -m pytest -q
+"""
+import time
+
+from chair_telemetry import StatePublisher
+
+
+def wait_for(condition, timeout=2.0):
+    """Poll until condition() holds, False when it never did"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+def test_updates_within_an_interval_are_sent_as_one_update():
+    writes = []
+    publisher = StatePublisher(writes.append, interval=0.2)
+    publisher.publish({'chairs/c1/status': 'ready'})
+    assert wait_for(lambda: len(writes) == 1)
+
+    # The interval started with the first write, these all wait for its end
+    publisher.publish({'chairs/c1/status': 'moving', 'chairs/c1/movement_state': {'direction': 'forward'}})
+    publisher.publish({'chairs/c1/movement_state': {'direction': 'left'}})
+    publisher.publish({'chairs/c1/status': 'stopped', 'chairs/c1/movement_state': {'direction': 'stop'}})
+    assert len(writes) == 1
+
+    assert wait_for(lambda: len(writes) == 2)
+    assert writes[1] == {'chairs/c1/status': 'stopped', 'chairs/c1/movement_state': {'direction': 'stop'}}
+    assert publisher.values_coalesced == 3
+
+    time.sleep(0.3)
+    assert len(writes) == 2
+    publisher.close()
@@ -0,0 +1,89 @@
+"""
+Tests for command traces in chair_trace.py.
+Run with: python -m pytest -q
+"""
+import math
+import os
+
+import pytest
+
+from chair_trace import (HEADER, RECORD, SOURCE_FIREBASE, SOURCE_LAN, SOURCE_STATE, TraceReader,
+                         TraceRecorder, replay)
+
+
+class FakeClock:
+    def __init__(self, now=1000.0, step=0.005):
+        self.now = now
+        self.step = step
+
+    def __call__(self):
+        self.now += self.step
+        return self.now
+
+
+def read(path):
+    with TraceReader(path) as reader:
+        return list(reader)
+
+
+def test_records_round_trip(tmp_path):
+    path = str(tmp_path / 'trace.bin')
+    recorder = TraceRecorder(path, clock=FakeClock())
+    recorder.record('speed', 60, source=SOURCE_STATE)
+    recorder.record('joystick', {'x': -12.5, 'y': 80}, 1700000000123, source=SOURCE_LAN)
+    recorder.record('stop', None, math.nan)
+    recorder.record('é' * 200, [1, 2], 5.5)
+    recorder.close()
+
+    records = read(path)
+    # The recorder read the clock once when it opened the file
+    assert [record.received for record in records] == pytest.approx([1000.010, 1000.015, 1000.020, 1000.025])
+    assert [record[1:] for record in records[:3]] == [
+        (None, SOURCE_STATE, 'speed', 60),
+        (1700000000123, SOURCE_LAN, 'joystick', {'x': -12.5, 'y': 80}),
+        (None, SOURCE_FIREBASE, 'stop', None)
+    ]
+    # 400 bytes of two-byte characters, cut to the 127 that fit in 255 bytes
+    assert records[3].command == 'é' * 127
+    assert records[3].value == [1, 2]
+    assert records[3].timestamp == 5.5
+    assert recorder.stats()['records'] == 4
+
+
+def test_record_cut_off_mid_write_is_skipped(tmp_path):
+    path = str(tmp_path / 'trace.bin')
+    recorder = TraceRecorder(path, clock=FakeClock())
+    for x in range(3):
+        recorder.record('joystick', {'x': x, 'y': 50}, 1000 + x)
+    recorder.close()
+    size = os.path.getsize(path)
+    record_size = (size - HEADER.size) // 3
+
+    # Cut in the command and value of the last record, then in its fixed fields
+    for cut in (3, record_size - RECORD.size + 2):
+        with open(path, 'r+b') as f:
+            f.truncate(size - cut)
+        assert [record.value for record in read(path)] == [{'x': 0, 'y': 50}, {'x': 1, 'y': 50}]
+
+
+def test_replay_digest_does_not_depend_on_speed(tmp_path):
+    chair = pytest.importorskip('chair')
+    path = str(tmp_path / 'trace.bin')
+    recorder = TraceRecorder(path, clock=FakeClock(step=0.002))
+    recorder.record('speed', 70, source=SOURCE_STATE)
+    for i in range(60):
+        recorder.record('joystick', {'x': (i * 7) % 201 - 100, 'y': (i * 13) % 201 - 100})
+        if i % 15 == 14:
+            recorder.record('stop')
+            recorder.record('forward' if i % 30 == 14 else 'left')
+    recorder.close()
+
+    digests = []
+    for speed in (0, 10):
+        wheelchair = chair.Chair(str(tmp_path / f'chair_info_{speed}.json'), name=f'replay{speed}')
+        wheelchair.init_motors('sim')
+        with TraceReader(path) as reader:
+            count, digest = replay(reader, wheelchair, speed)
+        assert count == 68
+        digests.append(digest)
+    assert digests[0] == digests[1]
@@ -7,11 +7,10 @@ import time
 import json
 import os
 import sys
-import firebase_admin
-from firebase_admin import credentials, db
+from chair_datastore import DATASTORE, create_datastore
 
-# Check if serviceAccountKey.json exists
-if not os.path.exists('serviceAccountKey.json'):
+# Check if serviceAccountKey.json exists (not needed with CHAIR_DATASTORE=memory)
+if DATASTORE == 'firebase' and not os.path.exists('serviceAccountKey.json'):
     print("Error: serviceAccountKey.json not found!")
     print("Please create a serviceAccountKey.json file with your Firebase credentials.")
     sys.exit(1)
@@ -19,11 +18,9 @@ if not os.path.exists('serviceAccountKey.json'):
 # Firebase configuration
 FIREBASE_URL = "https://smarthub-60812-default-rtdb.firebaseio.com"
 
-# Initialize Firebase Admin SDK
-cred = credentials.Certificate('serviceAccountKey.json')
-firebase_app = firebase_admin.initialize_app(cred, {
-    'databaseURL': FIREBASE_URL
-})
+# Connect to the Realtime Database (or the in-memory stand-in)
+db = create_datastore(DATASTORE, credentials_path='serviceAccountKey.json',
+                      database_url=FIREBASE_URL)
 
 def create_test_room():
     """Create a test room in Firebase"""
@@ -165,4 +162,4 @@ if __name__ == "__main__":
     run_tests()
     
     # Clean up Firebase app
-    firebase_admin.delete_app(firebase_app) 
\ No newline at end of file
+    db.close()
\ No newline at end of file